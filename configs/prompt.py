@@ -112,6 +112,37 @@ Dựa trên thông tin trong JSON được cung cấp ở trên, bạn cần t
 )
 
 
+# Prompt gom nhiều sản phẩm vào 1 request. Dùng lại đúng phần định nghĩa key + nguyên tắc của
+# CREATE_EXTRA_COLUMN_PROMPT để 2 chế độ luôn cho cùng cách trích xuất.
+_EXTRA_COLUMN_RULES = CREATE_EXTRA_COLUMN_PROMPT.template.split("*Nhiệm vụ*")[1].split("*Ví dụ*")[0]
+
+CREATE_EXTRA_COLUMN_BATCH_PROMPT = PromptTemplate(
+    input_variables=["json_data"],
+    template_format="jinja2",
+    template="""
+*Vai trò và khả năng*
+Bạn là một trợ lý AI chuyên phân tích dữ liệu, hỗ trợ người dùng tạo cột mới trong bảng dữ liệu dựa trên thông tin JSON đã cho.
+Bạn là chuyên gia về các bộ dữ liệu sản phẩm của Viettel, có khả năng truy vấn và tổng hợp thông tin một cách nhanh chóng.
+
+*Nhiệm vụ*
+Bạn sẽ nhận một mảng JSON gồm nhiều sản phẩm, mỗi phần tử có dạng {"item": <số thứ tự>, "product": <JSON sản phẩm>}.
+Với TỪNG sản phẩm, thực hiện độc lập yêu cầu dưới đây (mỗi sản phẩm chỉ dùng thông tin của chính nó):
+""" + _EXTRA_COLUMN_RULES + """
+*Định dạng trả lời khi có nhiều sản phẩm*
+1. Trả về DUY NHẤT một mảng JSON, mỗi sản phẩm đầu vào đúng 1 phần tử, giữ nguyên "item":
+   [{"item": 0, "columns": {...}}, {"item": 1, "columns": {...}}]
+2. "columns" là JSON các key ở trên của sản phẩm đó. Nếu không tạo được cột nào, trả về "columns": {}.
+3. Không giải thích, không tạo khối ```json ... ```.
+
+*Nguồn dữ liệu*
+Dưới đây là mảng JSON (nằm giữa 2 thẻ <context> </context>) về các sản phẩm:
+<context>
+{{ json_data }}
+</context>
+"""
+)
+
+
 PRODUCT_COLUMN_INFO = """
 id (keyword): ID định danh duy nhất của sản phẩm.
 name (text): Tên sản phẩm (dùng để tìm theo loại, ví dụ "chảo", "đèn năng lượng mặt trời").
@@ -187,7 +218,9 @@ PRODUCT_SQL_SAMPLES = """
 
 PRODUCT_SELECTED_COLUMNS = """name, sku, price, thumbnail, weight, description, salient_features, attributes, length, width, height, drying_washing_capacity, volume, power, lighting_time, charging_time, battery_capacity_mAh, battery_capacity_W, solar_panel_power, warranty, dish_diameter, min_operating_temperature, max_operating_temperature, water_resistance, shock_resistance, warranty_time"""
 
-# Prompt để sinh SQL 
+# Prompt để sinh SQL / sửa SQL lỗi, dùng cho cả prompt đầy đủ và prompt chọn động truy vấn mẫu / cột (SQLPromptBuilder):
+# phần hướng dẫn cố định đặt trước để tận dụng prompt caching của OpenAI,
+# phần thay đổi theo câu hỏi (cột, truy vấn mẫu, câu hỏi) đặt cuối.
 PRODUCT_SQL_GENERATION_PROMPT = PromptTemplate(
     input_variables=["question", "table_name", "table_description", "sql_samples", "columns_info", "selected_columns"],
     template="""
@@ -196,15 +229,6 @@ Bạn là một trợ lý AI chuyên viết truy vấn **SQL cho Elasticsearch**
 Dưới đây là thông tin về bảng dữ liệu:
 - Tên bảng (index): `{table_name}`
 - Mô tả bảng: {table_description}
-- Danh sách các cột (tên cột, kiểu dữ liệu, mô tả):
-{columns_info}
-
-Câu hỏi: "{question}"
-
-Dưới đây là một số truy vấn mẫu (nếu có):
-{sql_samples}
-
----
 
 # Yêu cầu
 
@@ -225,6 +249,7 @@ Dưới đây là một số truy vấn mẫu (nếu có):
    - `LIMIT <số_lượng>`
 
 5. Không SELECT `*`. Luôn SELECT tất cả các cột sau: {selected_columns}.
+   Nếu truy vấn mẫu viết tắt `SELECT <SELECTED_COLUMNS>` thì đó là danh sách cột này, câu SQL trả về phải ghi đầy đủ các cột.
 
 6. Nếu không thể sinh truy vấn do câu hỏi không liên quan dữ liệu, trả về:  
    **"Câu hỏi không liên quan đến bảng dữ liệu đã cung cấp."**
@@ -248,26 +273,26 @@ Dưới đây là một số truy vấn mẫu (nếu có):
 4. **Không thêm cột hoặc bảng không tồn tại**
 
 5. **Nếu người dùng hỏi sản phẩm nhất về khía cạnh nào đó, hãy LIMIT 5 sản phẩm đầu tiên
+
+---
+
+Danh sách các cột (tên cột, kiểu dữ liệu, mô tả):
+{columns_info}
+
+Dưới đây là một số truy vấn mẫu (nếu có):
+{sql_samples}
+
+Câu hỏi: "{question}"
 """
 )
 
 PRODUCT_SQL_DOUBLE_CHECK_GENERATION = PromptTemplate(
-    input_variables=["question", "table_name", "table_description","previous_sql", "columns_info", "sql_error", "selected_columns", "sql_samples"],
+    input_variables=["question", "table_name", "table_description","previous_sql", "columns_info", "sql_error", "selected_columns"],
     template="""Em là một chuyên gia ElasticSearch SQL và có nhiệm vụ kiểm tra câu sql bị lỗi hoặc không có kết quả sau đó chuyển đổi câu hỏi từ ngôn ngữ tự nhiên thành truy vấn SQL. 
     Dưới đây là thông tin về bảng dữ liệu:
     - Tên bảng: `{table_name}`
     - Mô tả bảng: {table_description}
-    - Danh sách các cột (tên cột, kiểu dữ liệu, mô tả):
-    {columns_info}
-
-    Câu SQL trước đó:
-    {previous_sql}
-    
-    Lỗi câu SQL cũ gặp phải:
-    {sql_error} 
 
-    Câu hỏi: "{question}"
-    
     # Các quy tắc quan trọng:
 
     0. Quan trọng nhất: không SELECT `*`. Luôn SELECT tất cả các cột sau: {selected_columns}.
@@ -292,6 +317,19 @@ PRODUCT_SQL_DOUBLE_CHECK_GENERATION = PromptTemplate(
     6. Nếu không thể sinh truy vấn do câu hỏi không liên quan dữ liệu, trả về:  **"Câu hỏi không liên quan đến bảng dữ liệu đã cung cấp."**
     
     7. **Không giải thích, không cần tạo khối ```sql .. ```, chỉ trả về duy nhất câu lệnh SQL.**
+
+    ---
+
+    Danh sách các cột (tên cột, kiểu dữ liệu, mô tả):
+    {columns_info}
+
+    Câu SQL trước đó:
+    {previous_sql}
+    
+    Lỗi câu SQL cũ gặp phải:
+    {sql_error} 
+
+    Câu hỏi: "{question}"
     """
 )
 
@@ -1,14 +1,20 @@
 from fastapi import FastAPI, Header, HTTPException, Response, Depends
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 
 import json
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 from configs.config import load_config
 from configs.logging_config import setup_logging
 
 from source.models.vector_indexing import MilvusVectorStore
 from source.models.vector_search import MilvusVectorRetriever
 from source.models.elastic_search import ProductElasticSQLRetriever
+from source.utils.embedding_cache import CachedQueryEmbeddings
+from source.utils.sql_stream import SQLResultStream, iter_result_text
 from configs.config import load_config
 from configs.logging_config import setup_logging
 from langchain_openai import OpenAIEmbeddings
@@ -34,27 +40,47 @@ milvus_embedding_model = OpenAIEmbeddings(
                         dimensions=milvus_embedding_dimension,
                     )
 
+# Cache embedding của câu truy vấn, dùng chung cho cả 2 collection product / service
+embedding_cache_config = config.get("embedding_cache", {})
+query_embedding_cache = CachedQueryEmbeddings(
+    milvus_embedding_model,
+    model_name=embedding_model_name,
+    dimensions=milvus_embedding_dimension,
+    max_size=embedding_cache_config.get("max_size", 5000),
+    ttl_seconds=embedding_cache_config.get("ttl_seconds"),
+    persist_path=embedding_cache_config.get("persist_path"),
+    logger=logger,
+)
+
+# Thread pool dùng chung cho các truy vấn Milvus đồng bộ, giới hạn bởi milvus.max_concurrency
+milvus_max_concurrency = config["milvus"].get("max_concurrency", 8)
+milvus_search_executor = ThreadPoolExecutor(max_workers=milvus_max_concurrency, thread_name_prefix="milvus_search")
+
 product_vectorstore = MilvusVectorStore(
     milvus_uri=milvus_uri,
     collection_name=config["milvus"]["product_collection_name"],
-    embeddings=milvus_embedding_model,
+    embeddings=query_embedding_cache,
     dimensions=milvus_embedding_dimension,
     openai_key=openai_key,
     recreate_collection=False,
     logger=logger,
 ).vectorstore
-milvus_product_vector_retriever = MilvusVectorRetriever(product_vectorstore, logger)
+milvus_product_vector_retriever = MilvusVectorRetriever(product_vectorstore, logger, query_embedding_cache,
+                                                        max_concurrency=milvus_max_concurrency,
+                                                        executor=milvus_search_executor)
 
 service_vectorstore = MilvusVectorStore(
     milvus_uri=milvus_uri,
     collection_name=config["milvus"]["service_collection_name"],
-    embeddings=milvus_embedding_model,
+    embeddings=query_embedding_cache,
     dimensions=milvus_embedding_dimension,
     openai_key=openai_key,
     recreate_collection=False,
     logger=logger,
 ).vectorstore
-milvus_service_vector_retriever = MilvusVectorRetriever(service_vectorstore, logger)
+milvus_service_vector_retriever = MilvusVectorRetriever(service_vectorstore, logger, query_embedding_cache,
+                                                        max_concurrency=milvus_max_concurrency,
+                                                        executor=milvus_search_executor)
 
 
 es_host = config['elasticsearch']['host']
@@ -91,6 +117,15 @@ class SQLRetrievalResponse(BaseModel):
     results: str
     sql_query: str
 
+class SQLRowsResponse(BaseModel):
+    columns: List[str]
+    rows: List[Dict[str, Any]]
+    truncated: bool
+    sql_query: str
+
+class SqlStreamRequest(SqlRetrievalRequest):
+    sse: bool = False  # True: text/event-stream, False: text/plain chunked
+
 app = FastAPI(title="Retrieval API")
 
 def verify_api_key(authorization: str = Header(...)):
@@ -108,6 +143,41 @@ def verify_api_key(authorization: str = Header(...)):
 def secure_endpoint(_: bool = Depends(verify_api_key)):
     return {"message": "✅ Access granted"}
 
+@app.get("/embedding_cache/stats")
+def embedding_cache_stats(_: bool = Depends(verify_api_key)):
+    return query_embedding_cache.stats()
+
+@app.get("/sql_cache/stats")
+def sql_cache_stats(_: bool = Depends(verify_api_key)):
+    stats = {"exact": elastic_sql_retriever.cache.stats() if elastic_sql_retriever.cache else {}}
+    if elastic_sql_retriever.semantic_cache is not None:
+        stats["semantic"] = elastic_sql_retriever.semantic_cache.stats()
+    if elastic_sql_retriever.validator is not None:
+        stats["validation"] = elastic_sql_retriever.validator.stats()
+    stats["cascade"] = elastic_sql_retriever.cascade.stats()
+    stats["prompt"] = elastic_sql_retriever.prompt_builder.stats()
+    if elastic_sql_retriever.candidate_llms:
+        stats["speculative"] = {
+            "candidates": elastic_sql_retriever.candidate_stats,
+            "win_rates": elastic_sql_retriever.candidate_win_rates(),
+        }
+    return stats
+
+@app.on_event("startup")
+async def build_sql_prompt_index():
+    # Dựng trước index embedding truy vấn mẫu / cột để request đầu tiên không phải chờ
+    if not elastic_sql_retriever.prompt_builder.dynamic:
+        return
+    try:
+        await elastic_sql_retriever.prompt_builder.abuild_index()
+    except Exception as e:
+        logger.warning(f"⚠️ Không dựng được index embedding cho prompt SQL: {e}")
+
+@app.on_event("shutdown")
+def save_embedding_cache():
+    query_embedding_cache.save()
+    milvus_search_executor.shutdown(wait=False)
+
 def filter_results_by_threshold(results: list, threshold: Optional[float] = None):
     if threshold is None:
         return results
@@ -139,7 +209,7 @@ async def service_vector_retrieval(request: RetrievalRequest,
         raise HTTPException(status_code=500, detail="Vector store not initialized")
 
     try:
-        results = milvus_service_vector_retriever.retrieve(
+        results = await milvus_service_vector_retriever.aretrieve(
             query=request.query, 
             top_k=request.retrieval_setting.top_k
         )
@@ -162,7 +232,7 @@ async def product_vector_retrieval(request: RetrievalRequest,
         raise HTTPException(status_code=500, detail="Vector store not initialized")
     
     try:
-        results = milvus_product_vector_retriever.retrieve(
+        results = await milvus_product_vector_retriever.aretrieve(
             query=request.query, 
             top_k=request.retrieval_setting.top_k
         )
@@ -194,6 +264,71 @@ async def sql_retrieval(request: SqlRetrievalRequest):
         raise HTTPException(status_code=500, detail=f"Retrieval error: {str(e)}")
 
 
+@app.post("/sql_retrieval/rows", response_model=SQLRowsResponse)
+async def sql_retrieval_rows(request: SqlRetrievalRequest):
+    try:
+        search_result = await elastic_sql_retriever.search_rows(request.query)
+    except Exception as e:
+        logger.info(f'Retrieval error: {str(e)}')
+        raise HTTPException(status_code=500, detail=f"Retrieval error: {str(e)}")
+
+    if not search_result:
+        raise HTTPException(status_code=404, detail="Không tìm thấy kết quả phù hợp")
+
+    result, sql_query = search_result
+    return SQLRowsResponse(**result, sql_query=sql_query)
+
+def sse_data(text: str) -> str:
+    # Mỗi dòng của text là 1 dòng "data:", client ghép lại bằng "\n"
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+def sse_events(sql_query: str, chunks):
+    yield "event: sql\n" + sse_data(sql_query)
+    for chunk in chunks:
+        yield sse_data(chunk)
+    yield "event: end\n" + sse_data("")
+
+async def close_after(chunks, result: SQLResultStream):
+    """
+    Trả dần các đoạn của chunks (đọc trong threadpool) và luôn đóng cursor khi response kết thúc.
+    Starlette không đóng iterator đồng bộ của StreamingResponse, và bỏ qua background task khi client ngắt kết nối.
+    """
+    try:
+        async for chunk in iterate_in_threadpool(chunks):
+            yield chunk
+    finally:
+        result.close()
+
+@app.post("/sql_retrieval/stream")
+async def sql_retrieval_stream(request: SqlStreamRequest):
+    """
+    Trả kết quả /sql_retrieval theo từng đoạn ngay khi đọc được từng trang cursor.
+    Câu SQL nằm trong header X-SQL-Query (URL-encoded) hoặc event "sql" khi dùng SSE.
+    """
+    try:
+        search_result = await elastic_sql_retriever.search_stream(request.query)
+    except Exception as e:
+        logger.info(f'Retrieval error: {str(e)}')
+        raise HTTPException(status_code=500, detail=f"Retrieval error: {str(e)}")
+
+    if not search_result:
+        raise HTTPException(status_code=404, detail="Không tìm thấy kết quả phù hợp")
+
+    result, sql_query = search_result
+    is_stream = isinstance(result, SQLResultStream)
+    chunks = result.iter_text() if is_stream else iter_result_text(result)
+    if request.sse:
+        chunks = sse_events(sql_query, chunks)
+    if is_stream:
+        # Đóng cursor kể cả khi client ngắt kết nối trước khi đọc hết
+        chunks = close_after(chunks, result)
+
+    if request.sse:
+        return StreamingResponse(chunks, media_type="text/event-stream")
+    return StreamingResponse(chunks, media_type="text/plain; charset=utf-8",
+                             headers={"X-SQL-Query": quote(sql_query)})
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
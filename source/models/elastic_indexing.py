@@ -1,25 +1,50 @@
-from configs.prompt import CREATE_EXTRA_COLUMN_PROMPT
+from configs.prompt import CREATE_EXTRA_COLUMN_PROMPT, CREATE_EXTRA_COLUMN_BATCH_PROMPT
 from langchain_core.messages import HumanMessage
-from source.utils.llm_invoker import invoke_llm_for_full_response
+from source.utils.llm_invoker import invoke_llm_with_retry
+from source.utils.rate_limiter import AsyncRateLimiter
+from source.utils.enrichment_cache import EnrichmentCache, prompt_version
 from langchain_openai import ChatOpenAI 
 from elasticsearch import Elasticsearch, helpers
 from configs.config import load_config
 from configs.logging_config import setup_logging
+from source.utils.index_generation import IndexGeneration
+from concurrent.futures import ThreadPoolExecutor
 import json
 import asyncio
 import logging
 
 class Elastic_Indexing:
-    def __init__(self, index_name: str, es: Elasticsearch, fields: list, llm: ChatOpenAI,recreate_index: bool = False, logger = None):
+    def __init__(self, index_name: str, es: Elasticsearch, fields: list, llm: ChatOpenAI,recreate_index: bool = False, logger = None,
+                 enrichment_config: dict = None, settle_seconds: float = 2.0):
         self.create_extra_column_prompt = CREATE_EXTRA_COLUMN_PROMPT
         self.index_name = index_name
         self.es = es
         self.fields = fields
         self.logger = logger or logging.getLogger(__name__)   
         self.llm = llm
+        # Cấu hình gọi LLM song song khi tạo cột mới (mục `enrichment` trong config.yaml)
+        self.enrichment_config = enrichment_config or {}
+        self.rate_limiter = AsyncRateLimiter(
+            requests_per_minute=self.enrichment_config.get("requests_per_minute"),
+            tokens_per_minute=self.enrichment_config.get("tokens_per_minute"),
+        )
+        # Cache kết quả trích xuất theo hash nội dung, sản phẩm không đổi mô tả thì không gọi lại LLM
+        self.enrichment_cache = None
+        if self.enrichment_config.get("cache_path"):
+            self.enrichment_cache = EnrichmentCache(
+                self.enrichment_config["cache_path"],
+                prompt_version=self.enrichment_config.get("prompt_version") or prompt_version(CREATE_EXTRA_COLUMN_PROMPT.template),
+                model_name=getattr(self.llm, "model_name", ""),
+            )
+        # Đánh dấu index thay đổi để retrieval_app xóa cache /sql_retrieval
+        self.generation = IndexGeneration(self.es, self.index_name, settle_seconds=settle_seconds, logger=self.logger)
         if recreate_index or not self.es.indices.exists(index=self.index_name):
             self.create_index()
-    def create_extra_column_json(self, products) -> list:
+            self.legacy_ids = False
+        else:
+            # Index tạo trước khi dùng _id = SKU: upsert sẽ tạo bản sao, cần xóa bản cũ cho tới khi build lại index
+            self.legacy_ids = self._has_legacy_ids()
+    def create_extra_column_json(self, products, return_failed: bool = False) -> list:
         """
         Từ 1 list các file json thuộc tính của products, trích xuất ra các thuộc tính chung nhất (chỉ sử dụng cho products)
         Input:
@@ -27,25 +52,172 @@ class Elastic_Indexing:
         - llm: ChatOpenAI model để gọi LLM
         Output:
         - list các json thuộc tính chung nhất
+        - return_failed=True: trả về thêm list vị trí các sản phẩm trích xuất thất bại
+        Có thể gọi cả khi đang ở trong 1 event loop (khi đó chạy trong thread riêng).
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.acreate_extra_column_json(products, return_failed))
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.acreate_extra_column_json(products, return_failed)).result()
+
+    async def acreate_extra_column_json(self, products, return_failed: bool = False) -> list:
         """
+        Gọi LLM song song cho từng sản phẩm, giới hạn bởi max_concurrency và RPM/TPM.
+        Sản phẩm lỗi (parse JSON / gọi API thất bại) được giữ nguyên, không ảnh hưởng sản phẩm khác.
+        Thứ tự output giống thứ tự input.
+        """
+        keys, cached_columns = [], {}
+        if self.enrichment_cache is not None:
+            keys = [self.enrichment_cache.make_key(product) for product in products]
+            cached_columns = self.enrichment_cache.get_many(keys)
+
+        pending = [i for i in range(len(products)) if not keys or keys[i] not in cached_columns]
+        if keys:
+            self.logger.info(f"Enrichment cache: {len(products) - len(pending)} hit, {len(pending)} miss")
+
+        semaphore = asyncio.Semaphore(self.enrichment_config.get("max_concurrency", 8))
+        if self.enrichment_config.get("batch_mode", False):
+            results = await self._aextract_columns_batched([products[i] for i in pending], semaphore)
+        else:
+            results = await asyncio.gather(*[self._aextract_columns(products[i], semaphore) for i in pending])
+        extracted = dict(zip(pending, results))
+
+        if self.enrichment_cache is not None:
+            new_items = [(keys[i], products[i].get("sku"), columns) for i, columns in extracted.items() if columns is not None]
+            if new_items:
+                self.enrichment_cache.set_many(new_items)
+
         extra_col_products = []
-        for product in products:
-            product_json = json.dumps(product, ensure_ascii=False, indent=2)
+        for i, product in enumerate(products):
+            columns = extracted[i] if i in extracted else cached_columns[keys[i]]
+            extra_col_products.append({**product, **columns} if columns is not None else product.copy())
+        if return_failed:
+            return extra_col_products, [i for i, columns in extracted.items() if columns is None]
+        return extra_col_products
 
-            prompt_input = {"json_data": product_json}
-            create_extra_column_prompt = CREATE_EXTRA_COLUMN_PROMPT.format(**prompt_input)
+    def _pack_batches(self, products) -> list:
+        """
+        Chia products thành các batch theo số sản phẩm tối đa và ngân sách token của phần dữ liệu.
+        Output: list các batch, mỗi batch là list index trong products.
+        """
+        max_items = self.enrichment_config.get("batch_max_items", 10)
+        max_tokens = self.enrichment_config.get("batch_max_tokens", 12000)
 
-            response = asyncio.run(invoke_llm_for_full_response(self.llm, [HumanMessage(content=create_extra_column_prompt)]))
+        batches, current, current_tokens = [], [], 0
+        for i, product in enumerate(products):
+            tokens = len(json.dumps(product, ensure_ascii=False)) // 3
+            if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    @staticmethod
+    def _parse_batch_response(response: str) -> dict:
+        """
+        Parse mảng [{"item": i, "columns": {...}}, ...] do LLM trả về, từng phần tử độc lập:
+        phần tử nào hỏng thì bỏ qua, các phần tử còn lại vẫn được dùng.
+        Output: {item: columns}
+        """
+        text = response.strip()
+        if text.startswith("```"):
+            text = text.strip("`")
+            text = text[text.find("["):] if "[" in text else text
+
+        decoder = json.JSONDecoder()
+        parsed = {}
+        pos = text.find("{")
+        while pos != -1:
             try:
-                response = json.loads(response)
-                merged = {**product, **response}
-            except:
-                product_sku = product['sku']
-                self.logger.info(f"Không thể parse JSON ở sản phẩm: {product_sku}")
-                merged = product.copy()
-                
-            extra_col_products.append(merged)
-        return extra_col_products
+                obj, end = decoder.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                pos = text.find('{"item"', pos + 1)
+                continue
+            if isinstance(obj, dict) and isinstance(obj.get("item"), int) and isinstance(obj.get("columns"), dict):
+                parsed[obj["item"]] = obj["columns"]
+            pos = text.find("{", end)
+        return parsed
+
+    async def _aextract_columns_batched(self, products, semaphore) -> list:
+        """
+        Gom nhiều sản phẩm vào 1 request (CREATE_EXTRA_COLUMN_BATCH_PROMPT) để không lặp lại phần hướng dẫn.
+        Sản phẩm không parse được / thiếu trong kết quả sẽ được gọi lại từng sản phẩm một.
+        Output: list các cột mới, cùng thứ tự với products (None nếu thất bại).
+        """
+        async def run_batch(indices):
+            payload = [{"item": item, "product": products[i]} for item, i in enumerate(indices)]
+            prompt = CREATE_EXTRA_COLUMN_BATCH_PROMPT.format(json_data=json.dumps(payload, ensure_ascii=False, indent=2))
+            estimated_tokens = len(prompt) // 3 + 150 * len(indices)
+
+            async with semaphore:
+                await self.rate_limiter.acquire(estimated_tokens)
+                try:
+                    response = await invoke_llm_with_retry(
+                        self.llm,
+                        [HumanMessage(content=prompt)],
+                        max_retries=self.enrichment_config.get("max_retries", 5),
+                        base_delay=self.enrichment_config.get("retry_base_delay", 1.0),
+                    )
+                    parsed = self._parse_batch_response(response)
+                except Exception as e:
+                    self.logger.error(f"Lỗi khi gọi LLM cho batch {len(indices)} sản phẩm: {e}")
+                    parsed = {}
+            return {i: parsed.get(item) for item, i in enumerate(indices)}
+
+        results = {}
+        for batch_result in await asyncio.gather(*[run_batch(indices) for indices in self._pack_batches(products)]):
+            results.update(batch_result)
+
+        failed = [i for i, columns in results.items() if columns is None]
+        if failed:
+            self.logger.info(f"Batch enrichment: {len(failed)} sản phẩm không parse được, gọi lại từng sản phẩm")
+            retried = await asyncio.gather(*[self._aextract_columns(products[i], semaphore) for i in failed])
+            results.update(zip(failed, retried))
+
+        return [results[i] for i in range(len(products))]
+
+    async def _aextract_columns(self, product, semaphore):
+        """
+        Gọi LLM trích xuất các cột mới cho 1 sản phẩm.
+        Output: dict các cột mới ({} nếu LLM trả về "None"), None nếu gọi API / parse JSON thất bại.
+        """
+        product_json = json.dumps(product, ensure_ascii=False, indent=2)
+
+        prompt_input = {"json_data": product_json}
+        create_extra_column_prompt = CREATE_EXTRA_COLUMN_PROMPT.format(**prompt_input)
+        # Ước lượng token (~3 ký tự / token với tiếng Việt) + phần output
+        estimated_tokens = len(create_extra_column_prompt) // 3 + 200
+
+        async with semaphore:
+            await self.rate_limiter.acquire(estimated_tokens)
+            try:
+                response = await invoke_llm_with_retry(
+                    self.llm,
+                    [HumanMessage(content=create_extra_column_prompt)],
+                    max_retries=self.enrichment_config.get("max_retries", 5),
+                    base_delay=self.enrichment_config.get("retry_base_delay", 1.0),
+                )
+            except Exception as e:
+                self.logger.error(f"Lỗi khi gọi LLM cho sản phẩm {product.get('sku')}: {e}")
+                return None
+
+        if response.strip('"') == "None":
+            return {}
+        try:
+            response = json.loads(response)
+            if not isinstance(response, dict):
+                raise ValueError("LLM không trả về JSON object")
+            return response
+        except:
+            product_sku = product['sku']
+            self.logger.info(f"Không thể parse JSON ở sản phẩm: {product_sku}")
+            return None
     
 
     def create_index(self) -> None:
@@ -69,24 +241,29 @@ class Elastic_Indexing:
             self.es.indices.delete(index=self.index_name)
             
         self.es.indices.create(index=self.index_name, body=mapping)
+        self.generation.bump()
         self.logger.info(f"Đã tạo index {self.index_name}")
         
-    def add_documents(self, products: list) -> None:
+    def add_documents(self, products: list, id_field: str = None) -> list:
         """
         Thêm documents vào index Elasticsearch.
+        - id_field: trường dùng làm _id của document (vd: "sku"), None thì ES tự sinh _id
+        Output: list lỗi của các documents index thất bại
         """
         for product in products:
             for key, value in product.items():
                 if type(value) == dict:
                     product[key] = json.dumps(value, ensure_ascii=False)
         
-        actions = [
-        {
-            "_index": self.index_name,
-            "_source": product if isinstance(product, dict) else product.to_dict(),
-        }
-            for product in products
-        ]
+        actions = []
+        for product in products:
+            action = {
+                "_index": self.index_name,
+                "_source": product if isinstance(product, dict) else product.to_dict(),
+            }
+            if id_field and product.get(id_field):
+                action["_id"] = str(product[id_field])
+            actions.append(action)
     
         
         success, errors = helpers.bulk(
@@ -97,6 +274,7 @@ class Elastic_Indexing:
             raise_on_exception=False
         )
 
+        self.generation.bump()
         failed_items = [e for e in errors if "index" in e and e["index"].get("status", 200) >= 300]
 
         self.logger.info(f"Đã index thành công {success} documents vào index {self.index_name}.")
@@ -105,10 +283,69 @@ class Elastic_Indexing:
             for err in failed_items:  
                 error_detail = err["index"].get("error", {})
                 self.logger.error(f"Lỗi: {error_detail}")
+        return failed_items
+
+    def _has_legacy_ids(self, id_field: str = "sku") -> bool:
+        """
+        Kiểm tra index có document dùng _id tự sinh (_id khác SKU) hoặc SKU bị trùng hay không.
+        """
+        try:
+            resp = self.es.search(
+                index=self.index_name,
+                size=20,
+                sort=["_doc"],
+                query={"exists": {"field": id_field}},
+                source=[id_field],
+                track_total_hits=True,
+                aggs={"distinct": {"cardinality": {"field": id_field, "precision_threshold": 40000}}},
+            )
+        except Exception as e:
+            self.logger.warning(f"⚠️ Không kiểm tra được _id của index {self.index_name}, coi như index cũ: {e}")
+            return True
+
+        hits = resp["hits"]["hits"]
+        mismatched = any(hit["_id"] != str(hit["_source"].get(id_field)) for hit in hits)
+        duplicated = resp["hits"]["total"]["value"] > resp["aggregations"]["distinct"]["value"]
+        if mismatched or duplicated:
+            self.logger.warning(
+                f"⚠️ Index {self.index_name} có document với _id tự sinh: mỗi lần upsert sẽ xóa bản cũ (_id khác {id_field}) "
+                f"của sản phẩm. Build lại index 1 lần (recreate_index=True) để bỏ bước này."
+            )
+        return mismatched or duplicated
+
+    def _delete_legacy_copies(self, skus: list, id_field: str = "sku") -> None:
+        """
+        Xóa các bản của cùng SKU có _id khác SKU (document cũ với _id tự sinh), giữ lại bản vừa upsert.
+        """
+        if not skus:
+            return
+        response = self.es.delete_by_query(
+            index=self.index_name,
+            query={"bool": {"filter": [{"terms": {id_field: skus}}], "must_not": [{"ids": {"values": skus}}]}},
+            conflicts="proceed",
+        )
+        if response.get("deleted", 0):
+            self.generation.bump()
+            self.logger.info(f"Đã xóa {response.get('deleted', 0)} document cũ (_id tự sinh) trong index {self.index_name}.")
+
+    def upsert_documents(self, products: list, id_field: str = "sku") -> list:
+        """
+        Thêm mới hoặc ghi đè documents với _id = SKU trong 1 lần bulk, không ép refresh index.
+        Gọi lại nhiều lần với cùng dữ liệu không tạo document trùng, không cần xóa trước khi cập nhật.
+        Index cũ dùng _id tự sinh (legacy_ids): xóa thêm bản cũ của các SKU vừa ghi để không bị trùng.
+        """
+        failed_items = self.add_documents(products, id_field=id_field)
+        if self.legacy_ids:
+            failed_ids = {str(err["index"].get("_id")) for err in failed_items}
+            skus = [str(product[id_field]) for product in products if product.get(id_field)]
+            self._delete_legacy_copies([sku for sku in skus if sku not in failed_ids], id_field)
+        return failed_items
   
     def delete_by_sku(self, sku: str) -> None:
         """
         Xóa tất cả documents trong index có trường 'sku' bằng giá trị đầu vào.
+        Luồng đồng bộ Kafka chỉ upsert (không có sự kiện xóa sản phẩm), hàm này dùng để xóa thủ công
+        sản phẩm ngừng bán.
         """
         if not sku or not sku.strip():
             self.logger.warning(f"⚠️ SKU đầu vào không hợp lệ: '{sku}' — Hủy thao tác xóa.")
@@ -127,6 +364,7 @@ class Elastic_Indexing:
             },
             refresh=True 
         )
+        self.generation.bump()
         self.logger.info(f"Đã xóa {response.get("deleted", 0)} document(s) với SKU = {sku} trong index {self.index_name}.")
 
     
@@ -152,9 +390,10 @@ if __name__ == "__main__":
     with open("data/products.json", "r", encoding="utf-8") as f:
         product_documents = json.load(f)   
     
-    product_indexer = Elastic_Indexing("test_products", es, config["product_fields"], llm, recreate_index=False, logger=logger)
+    product_indexer = Elastic_Indexing("test_products", es, config["product_fields"], llm, recreate_index=False, logger=logger,
+                                       enrichment_config=config.get("enrichment"))
     extra_col_product_documents = product_indexer.create_extra_column_json(product_documents)
-    product_indexer.add_documents(extra_col_product_documents)
+    product_indexer.upsert_documents(extra_col_product_documents)
 
     
     
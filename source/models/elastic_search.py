@@ -1,90 +1,388 @@
 from configs.logging_config import load_config
 from configs.prompt import PRODUCT_SQL_GENERATION_PROMPT, PRODUCT_SELECTED_COLUMNS, PRODUCT_SQL_SAMPLES, PRODUCT_TABLE_DESCRIPTION, PRODUCT_COLUMN_INFO, PRODUCT_SQL_DOUBLE_CHECK_GENERATION
 
-from source.utils.llm_invoker import invoke_llm_for_full_response
+from source.utils.llm_invoker import invoke_llm_with_usage
+from source.utils.sql_cache import SQLResultCache
+from source.utils.index_generation import IndexGeneration
+from source.utils.semantic_cache import SemanticSQLCache
+from source.utils.embedding_cache import CachedQueryEmbeddings
+from source.utils.sql_stream import SQLResultStream, format_result
+from source.utils.sql_validator import SQLValidator, parse_column_info
+from source.utils.model_cascade import ModelCascade
+from source.utils.sql_prompt_builder import SQLPromptBuilder
+from source.utils.embedding_store import EmbeddingStore
 import asyncio
+import logging
+import time
 from langchain_core.messages import HumanMessage
-from langchain_openai import ChatOpenAI 
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 
 config = load_config()
-llm = ChatOpenAI(
-    model=config['llm']['model_4_1'],
-    openai_api_key=config['llm']['openai_api_key'],
-    temperature=0.1,
+llm_config = config['llm']
+
+# Embedding câu hỏi cho semantic cache (cache lại vector để không embed lại câu hỏi lặp)
+question_embeddings = CachedQueryEmbeddings(
+    OpenAIEmbeddings(
+        openai_api_key=config['llm']['openai_api_key'],
+        model=config['milvus']['embedding_model'],
+        dimensions=config['milvus']['embedding_dimension'],
+    ),
+    model_name=config['milvus']['embedding_model'],
+    dimensions=config['milvus']['embedding_dimension'],
+    max_size=config.get('sql_cache', {}).get('max_size', 2000),
 )
 
 class BaseElasticSQLRetriever:
-    def __init__(self, es, logger, config):
+    def __init__(self, es, logger, config, cache: SQLResultCache = None, index_generation: IndexGeneration = None,
+                 semantic_cache: SemanticSQLCache = None, validator: SQLValidator = None, candidate_llms: dict = None,
+                 cascade: ModelCascade = None, prompt_builder: SQLPromptBuilder = None):
         self.es = es
-        self.logger = logger
+        self.logger = logger or logging.getLogger(__name__)
         self.config = config  # chứa các thông tin cấu hình riêng của từng bảng (product/service)
-        
-    async def create_sql(self, query):
-        sql_genration_prompt = self.config['SQL_GENERATION_PROMPT'].format(
-            question=query,
-            table_name=self.config['TABLE_NAME'],
-            table_description=self.config['TABLE_DESCRIPTION'],
-            columns_info=self.config['COLUMN_INFO'],
-            sql_samples=self.config['SQL_SAMPLES'],
-            selected_columns=self.config['SELECTED_COLUMNS']
-        )
-        response = await invoke_llm_for_full_response(llm, [HumanMessage(content=sql_genration_prompt)])
-        return response
-
-    async def create_sql_double_check(self, query, previous_sql, sql_error):
-        sql_double_check_prompt = self.config['SQL_DOUBLE_CHECK_PROMPT'].format(
-            question=query,
-            table_name=self.config['TABLE_NAME'],
-            table_description=self.config['TABLE_DESCRIPTION'],
-            columns_info=self.config['COLUMN_INFO'],
-            sql_samples=self.config['SQL_SAMPLES'],
-            selected_columns=self.config['SELECTED_COLUMNS'],
-            previous_sql=previous_sql,
-            sql_error=sql_error
-        )
-        response = await invoke_llm_for_full_response(llm, [HumanMessage(content=sql_double_check_prompt)])
-        return response
+        self.cache = cache  # cache câu hỏi -> SQL -> kết quả, None nếu không dùng cache
+        self.index_generation = index_generation  # dùng để xóa cache khi dữ liệu index thay đổi
+        self.semantic_cache = semantic_cache  # tái sử dụng SQL của câu hỏi tương tự, None nếu không dùng
+        self.validator = validator  # kiểm tra / sửa SQL trước khi chạy, None nếu không dùng
+        # Sinh song song nhiều câu SQL ứng viên (tên -> LLM), None / rỗng = sinh tuần tự 1 câu như cũ
+        self.candidate_llms = candidate_llms or {}
+        self.candidate_stats = {name: {"launched": 0, "valid": 0, "wins": 0} for name in self.candidate_llms}
+        # Các tầng model sinh SQL: model nhỏ trước, lỗi / không có kết quả mới dùng model lớn
+        self.cascade = cascade or ModelCascade.from_config(llm_config, logger=self.logger)
+        # Ghép prompt sinh SQL + thống kê token, mặc định dùng nguyên prompt đầy đủ
+        self.prompt_builder = prompt_builder or SQLPromptBuilder(config, logger=self.logger)
+
+        # Giới hạn số dòng / dung lượng kết quả đọc qua cursor ES SQL
+        retrieval_config = config.get("SQL_RETRIEVAL", {})
+        self.fetch_size = retrieval_config.get("fetch_size", 100)
+        self.max_rows = retrieval_config.get("max_rows", 500)
+        self.max_bytes = retrieval_config.get("max_bytes", 262144)
+
+    async def _invoke_sql_llm(self, model, prompt):
+        response, usage = await invoke_llm_with_usage(model, [HumanMessage(content=prompt)])
+        self.prompt_builder.record_usage(usage)
+        return self.prompt_builder.expand_sql(response)
+
+    async def create_sql(self, query, model=None):
+        sql_genration_prompt = await self.prompt_builder.generation_prompt(query)
+        return await self._invoke_sql_llm(model or self.cascade.first, sql_genration_prompt)
+
+    async def create_sql_double_check(self, query, previous_sql, sql_error, model=None):
+        sql_double_check_prompt = await self.prompt_builder.double_check_prompt(query, previous_sql, sql_error)
+        return await self._invoke_sql_llm(model or self.cascade.last, sql_double_check_prompt)
 
     def check_sql(self, sql_query):
         try:
             resp = self.es.sql.query(
                 query=sql_query,
                 format="json",
-                fetch_size=10
+                fetch_size=self.fetch_size
             )
             return True, resp
         except Exception as e:
             return False, e
 
+    def prepare_sql(self, sql_query):
+        """
+        Kiểm tra câu SQL do LLM sinh ra trước khi chạy (SQLValidator).
+        Output: (câu SQL đã sửa, None) hoặc (câu SQL, lỗi) - khi có lỗi không cần chạy câu SQL.
+        """
+        if self.validator is None:
+            return sql_query, None
+        repaired_sql, error = self.validator.validate(sql_query)
+        if error:
+            self.logger.warning(f"⚠️ SQL không hợp lệ, bỏ qua bước chạy thử: {error}")
+        elif repaired_sql != sql_query:
+            self.logger.info(f"🔁 Đã sửa SQL: {sql_query!r} -> {repaired_sql!r}")
+        return repaired_sql, error
+
+    def open_sql(self, sql_query):
+        """
+        Chạy câu SQL (trang đầu tiên) và trả về SQLResultStream để đọc tiếp các trang còn lại.
+        Câu SQL đã translate trước đó được chạy qua _search (shard request cache) nếu kết quả chỉ gồm các cột của document.
+        Output: (status, SQLResultStream hoặc lỗi)
+        """
+        resp = None
+        if self.validator is not None:
+            try:
+                resp = self.validator.search(sql_query, self.max_rows)
+            except Exception as e:
+                self.logger.warning(f"⚠️ Lỗi khi chạy SQL qua _search, dùng ES SQL: {e}")
+
+        if resp is None:
+            status, resp = self.check_sql(sql_query)
+            if not status:
+                return False, resp
+            if self.validator is not None:
+                self.validator.remember_columns(sql_query, [c["name"] for c in resp["columns"]])
+        return True, SQLResultStream(self.es, resp, max_rows=self.max_rows, max_bytes=self.max_bytes,
+                                     logger=self.logger)
+
     def paser_resp(self, resp):
-        cols = [c['name'] for c in resp['columns']]
-        result_lines = ["Các kết quả được lấy ra từ database:\n"]
+        with SQLResultStream(self.es, resp, max_rows=self.max_rows, max_bytes=self.max_bytes,
+                             logger=self.logger) as stream:
+            return format_result(stream.collect())
 
-        for idx, row in enumerate(resp['rows'], 1):
-            item = dict(zip(cols, row))
-            item = {k: v for k, v in item.items() if v is not None}
+    def current_generation(self):
+        if self.index_generation is None:
+            return 0
+        return self.index_generation.current()
 
-            result_lines.append(f"Mục {idx}:")
-            for k, v in item.items():
-                result_lines.append(f"{k}: {v}")
-            result_lines.append("")
+    def run_sql(self, sql_query, generation):
+        """
+        Chạy câu SQL và đọc hết kết quả (trong giới hạn max_rows / max_bytes),
+        dùng cache kết quả theo (SQL, generation) nếu có.
+        Output: (status, {"columns", "rows", "truncated"} hoặc lỗi)
+        """
+        if self.cache is not None:
+            cached_result = self.cache.get_result(sql_query, generation)
+            if cached_result is not None:
+                return True, cached_result
 
-        return "\n".join(result_lines)
+        status, stream = self.open_sql(sql_query)
+        if not status:
+            return False, stream
 
-    async def search(self, query):
-        sql_query = await self.create_sql(query)
-        status, resp = self.check_sql(sql_query)
+        result = stream.collect()
+        if result["truncated"]:
+            self.logger.info(f"📊 Kết quả SQL bị cắt bớt ở {stream.count} dòng / {stream.bytes} bytes ({stream.pages} trang)")
+        # Không cache kết quả đọc ngay sau khi index thay đổi (index có thể chưa refresh)
+        if self.cache is not None and (self.index_generation is None or self.index_generation.is_settled(generation)):
+            self.cache.set_result(sql_query, generation, result)
+        return True, result
+
+    def open_result(self, sql_query, generation):
+        """
+        Giống run_sql nhưng không đọc trước toàn bộ kết quả: trả về kết quả trong cache (dict)
+        hoặc SQLResultStream để đọc dần khi trả về dạng stream.
+        """
+        if self.cache is not None:
+            cached_result = self.cache.get_result(sql_query, generation)
+            if cached_result is not None:
+                return True, cached_result
+        return self.open_sql(sql_query)
 
+    @staticmethod
+    def _is_empty(result):
+        if isinstance(result, SQLResultStream):
+            return result.is_empty()
+        return not result["rows"]
+
+    @staticmethod
+    def _close_result(result):
+        if isinstance(result, SQLResultStream):
+            result.close()
+
+    def _check_and_run(self, sql_query, generation, run):
+        # Chạy trong thread: translate + chạy SQL đều là lời gọi ES đồng bộ
+        sql_query, error = self.prepare_sql(sql_query)
+        if error:
+            return sql_query, False, error
+        status, result = run(sql_query, generation)
+        return sql_query, status, result
+
+    def _close_finished_candidate(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        _, status, result = future.result()
         if status:
-            return self.paser_resp(resp), sql_query
-        else:
-            sql_query_v2 = await self.create_sql_double_check(query, sql_query, resp)
-            status_v2, resp_v2 = self.check_sql(sql_query_v2)
+            self._close_result(result)
+
+    async def _run_candidate(self, name, model, query, generation, run):
+        sql_query = await self.create_sql(query, model)
+        if not sql_query:
+            return name, sql_query, False, "LLM không trả về SQL"
+
+        future = asyncio.ensure_future(asyncio.to_thread(self._check_and_run, sql_query, generation, run))
+        try:
+            sql_query, status, result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Ứng viên thua cuộc: thread vẫn chạy tiếp, đóng cursor khi có kết quả
+            future.add_done_callback(self._close_finished_candidate)
+            raise
+        return name, sql_query, status, result
+
+    async def create_sql_speculative(self, query, generation, run):
+        """
+        Sinh K câu SQL song song (mỗi LLM trong candidate_llms 1 câu), kiểm tra và chạy song song,
+        lấy kết quả hợp lệ và không rỗng đầu tiên, hủy các ứng viên còn lại.
+        Không có ứng viên nào cho kết quả: dùng kết quả rỗng hợp lệ (nếu có), hoặc lỗi của ứng viên đầu tiên.
+        Output: (status, kết quả hoặc lỗi, câu SQL)
+        """
+        tasks = []
+        for name, model in self.candidate_llms.items():
+            self.candidate_stats[name]["launched"] += 1
+            tasks.append(asyncio.create_task(self._run_candidate(name, model, query, generation, run)))
+
+        winner = None
+        empty = None
+        failed = None
+        outcome = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    name, sql_query, status, result = await next_done
+                except Exception as e:
+                    self.logger.warning(f"⚠️ Lỗi khi sinh SQL ứng viên: {e}")
+                    continue
+                if not status:
+                    failed = failed or (False, result, sql_query)
+                    continue
+                self.candidate_stats[name]["valid"] += 1
+                if self._is_empty(result):
+                    empty = empty or (True, result, sql_query)
+                    continue
+                winner = name
+                self.candidate_stats[name]["wins"] += 1
+                outcome = (True, result, sql_query)
+                break
+        finally:
+            outcome = outcome or empty or failed or (False, "Không sinh được SQL", None)
+            for task in tasks:
+                task.cancel()
+                # Ứng viên đã chạy xong nhưng không được dùng: đóng cursor
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    _, _, status, result = task.result()
+                    if status and result is not outcome[1]:
+                        self._close_result(result)
+
+        if winner is not None:
+            self.logger.info(f"📊 SQL ứng viên {winner} thắng, tỉ lệ thắng: {self.candidate_win_rates()}")
+        return outcome
 
-            if status_v2:
-                return self.paser_resp(resp_v2), sql_query_v2
+    async def create_sql_cascade(self, query, generation, run):
+        """
+        Sinh SQL lần lượt theo các tầng model của cascade, dừng ở tầng đầu tiên cho kết quả hợp lệ và không rỗng.
+        Tầng trước lỗi (kiểm tra / chạy SQL): tầng sau sửa lại câu SQL đó (create_sql_double_check).
+        Tầng trước không có kết quả: tầng sau sinh lại từ đầu (create_sql).
+        Output: (status, kết quả hoặc lỗi, câu SQL)
+        """
+        sql_query, error = None, None
+        empty = None
+        for i, tier in enumerate(self.cascade.tiers):
+            start = time.perf_counter()
+            if error is not None and sql_query:
+                raw_sql = await self.create_sql_double_check(query, sql_query, error, tier.llm)
             else:
-                return None
+                raw_sql = await self.create_sql(query, tier.llm)
+
+            if not raw_sql:
+                error = "LLM không trả về SQL"
+                self.cascade.record(tier, "error", time.perf_counter() - start)
+                continue
+            # translate + chạy SQL là lời gọi ES đồng bộ, không chạy trên event loop
+            sql_query, status, result = await asyncio.to_thread(self._check_and_run, raw_sql, generation, run)
+            error = None if status else result
+            if error is not None:
+                self.cascade.record(tier, "error", time.perf_counter() - start)
+                if i + 1 < len(self.cascade.tiers):
+                    self.logger.info(f"🔁 SQL của tầng {tier.name} lỗi, chuyển lên tầng tiếp theo")
+                continue
+
+            is_empty = self._is_empty(result)
+            self.cascade.record(tier, "empty" if is_empty else "success", time.perf_counter() - start)
+            if is_empty and i + 1 < len(self.cascade.tiers):
+                self.logger.info(f"🔁 SQL của tầng {tier.name} không có kết quả, chuyển lên tầng tiếp theo")
+                if empty is not None:
+                    self._close_result(empty[1])
+                empty = (True, result, sql_query)
+                continue
+
+            if empty is not None:
+                self._close_result(empty[1])
+            return True, result, sql_query
+
+        # Không tầng nào có kết quả: dùng kết quả rỗng hợp lệ gần nhất nếu có
+        return empty or (False, error, sql_query)
+
+    def candidate_win_rates(self) -> dict:
+        return {
+            name: round(stats["wins"] / stats["launched"], 4) if stats["launched"] else 0.0
+            for name, stats in self.candidate_stats.items()
+        }
+
+    async def _resolve(self, query, run):
+        """
+        Tìm câu SQL cho câu hỏi (cache → semantic cache → LLM → LLM sửa lỗi) và chạy bằng run(sql, generation).
+        Output: (kết quả của run, câu SQL) hoặc None
+        """
+        usage = self.prompt_builder.begin_request()
+        try:
+            return await self._resolve_sql(query, run)
+        finally:
+            self.prompt_builder.end_request(usage, query)
+
+    async def _resolve_sql(self, query, run):
+        # Các lời gọi ES (đọc generation, chạy SQL) đều đồng bộ: chạy trong thread để không chặn event loop
+        generation = await asyncio.to_thread(self.current_generation)
+        if self.cache is not None:
+            self.cache.sync_generation(generation)
+            cached_sql = self.cache.get_sql(query)
+            if cached_sql is not None:
+                status, result = await asyncio.to_thread(run, cached_sql, generation)
+                if status:
+                    return result, cached_sql
+                self.cache.invalidate_sql(query)
+
+        if self.semantic_cache is not None:
+            try:
+                similar_sql = await self.semantic_cache.alookup(query)
+            except Exception as e:
+                self.logger.warning(f"⚠️ Lỗi khi tra semantic cache: {e}")
+                similar_sql = None
+
+            if similar_sql is not None:
+                status, result = await asyncio.to_thread(run, similar_sql, generation)
+                if status:
+                    if self.cache is not None:
+                        self.cache.set_sql(query, similar_sql)
+                    return result, similar_sql
+                self.semantic_cache.report_false_hit(query, similar_sql, result)
+
+        if self.candidate_llms:
+            status, result, sql_query = await self.create_sql_speculative(query, generation, run)
+            # Không ứng viên nào sinh được SQL: không có câu SQL để sửa
+            if not status and sql_query is not None:
+                raw_sql = await self.create_sql_double_check(query, sql_query, result)
+                if not raw_sql:
+                    self.logger.warning("⚠️ LLM sửa SQL không trả về SQL")
+                else:
+                    sql_query, status, result = await asyncio.to_thread(
+                        self._check_and_run, raw_sql, generation, run
+                    )
+        else:
+            status, result, sql_query = await self.create_sql_cascade(query, generation, run)
+
+        if not status:
+            return None
+
+        if self.cache is not None:
+            self.cache.set_sql(query, sql_query)
+        if self.semantic_cache is not None:
+            try:
+                await self.semantic_cache.aadd(query, sql_query)
+            except Exception as e:
+                self.logger.warning(f"⚠️ Lỗi khi lưu semantic cache: {e}")
+        return result, sql_query
+
+    async def search(self, query):
+        found = await self._resolve(query, self.run_sql)
+        if found is None:
+            return None
+        result, sql_query = found
+        return format_result(result), sql_query
+
+    async def search_rows(self, query):
+        """
+        Như search nhưng trả về kết quả dạng {"columns", "rows", "truncated"} thay cho text.
+        """
+        return await self._resolve(query, self.run_sql)
+
+    async def search_stream(self, query):
+        """
+        Như search nhưng kết quả là SQLResultStream (đọc dần theo cursor) hoặc dict nếu đã có trong cache.
+        Người gọi cần đọc hết hoặc close() stream để đóng cursor.
+        """
+        return await self._resolve(query, self.open_result)
             
 class ProductElasticSQLRetriever(BaseElasticSQLRetriever):
     def __init__(self, es, logger):
@@ -95,9 +393,82 @@ class ProductElasticSQLRetriever(BaseElasticSQLRetriever):
             "SQL_SAMPLES": PRODUCT_SQL_SAMPLES,
             "SELECTED_COLUMNS": PRODUCT_SELECTED_COLUMNS,
             "SQL_GENERATION_PROMPT": PRODUCT_SQL_GENERATION_PROMPT,
-            "SQL_DOUBLE_CHECK_PROMPT": PRODUCT_SQL_DOUBLE_CHECK_GENERATION
+            "SQL_DOUBLE_CHECK_PROMPT": PRODUCT_SQL_DOUBLE_CHECK_GENERATION,
+            "SQL_RETRIEVAL": config.get("sql_retrieval", {}),
         }
-        super().__init__(es, logger, product_config)
+        cache_config = config.get("sql_cache", {})
+        cache = SQLResultCache(
+            max_size=cache_config.get("max_size", 2000),
+            ttl_seconds=cache_config.get("ttl_seconds", 3600),
+        )
+        # Đọc generation ở đúng index mà Kafka consumer ghi (TABLE_NAME là alias dùng trong câu SQL)
+        index_generation = IndexGeneration(
+            es,
+            config["elasticsearch"].get("product_index", product_config["TABLE_NAME"]),
+            check_interval=cache_config.get("generation_check_interval", 5),
+            settle_seconds=cache_config.get("settle_seconds", 2),
+            logger=logger,
+        )
+        semantic_cache = None
+        if cache_config.get("semantic_enabled", True):
+            semantic_cache = SemanticSQLCache(
+                question_embeddings,
+                threshold=cache_config.get("semantic_threshold", 0.95),
+                max_size=cache_config.get("max_size", 2000),
+                logger=logger,
+                audit_logger=logger.getChild("semantic_sql_audit") if logger else None,
+            )
+        validator = None
+        validation_config = config.get("sql_validation", {})
+        if validation_config.get("enabled", True):
+            # Cột trong mapping index (product_fields) và cột mô tả trong prompt
+            columns = parse_column_info(PRODUCT_COLUMN_INFO)
+            columns.update({field["name"]: field["type"] for field in config.get("product_fields", [])})
+            validator = SQLValidator(
+                es,
+                product_config["TABLE_NAME"],
+                columns,
+                max_size=cache_config.get("max_size", 2000),
+                ttl_seconds=validation_config.get("ttl_seconds"),
+                close_match_cutoff=validation_config.get("close_match_cutoff", 0.85),
+                search_enabled=validation_config.get("search_enabled", True),
+                logger=logger,
+            )
+        candidate_llms = None
+        speculative_config = config.get("sql_speculative", {})
+        if speculative_config.get("enabled", False):
+            candidate_llms = {
+                candidate["name"]: ChatOpenAI(
+                    model=config['llm'][candidate["model"]],
+                    openai_api_key=config['llm']['openai_api_key'],
+                    temperature=candidate.get("temperature", 0.1),
+                )
+                for candidate in speculative_config.get("candidates", [])
+            }
+        cascade = ModelCascade.from_config(config['llm'], config.get("sql_cascade", {}).get("tiers"), logger)
+        super().__init__(es, logger, product_config, cache, index_generation, semantic_cache, validator, candidate_llms,
+                         cascade, product_prompt_builder(product_config, logger))
+
+
+def product_prompt_builder(product_config: dict, logger=None) -> SQLPromptBuilder:
+    """
+    SQLPromptBuilder theo mục sql_prompt trong config: embedding câu hỏi dùng chung với semantic cache,
+    embedding truy vấn mẫu / mô tả cột lưu trong embedding store của milvus_ingest (nếu có).
+    """
+    prompt_config = config.get("sql_prompt", {})
+    store_path = config.get("milvus_ingest", {}).get("embedding_store_path")
+    return SQLPromptBuilder(
+        product_config,
+        embeddings=question_embeddings,
+        model_name=config['milvus']['embedding_model'],
+        dimensions=config['milvus']['embedding_dimension'],
+        dynamic=prompt_config.get("dynamic", True),
+        top_k_samples=prompt_config.get("top_k_samples", 3),
+        top_k_columns=prompt_config.get("top_k_columns", 10),
+        always_columns=prompt_config.get("always_columns"),
+        embedding_store=EmbeddingStore(store_path) if store_path else None,
+        logger=logger,
+    )
 
 # 
 if __name__ == "__main__":
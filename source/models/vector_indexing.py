@@ -1,9 +1,19 @@
 from langchain_milvus import Milvus, BM25BuiltInFunction
 from pymilvus import MilvusClient, DataType, Function, FunctionType
 from langchain_openai import OpenAIEmbeddings
+from source.utils.embedding_store import EmbeddingStore
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import time
+
+# Tăng khi đổi cách tạo text embedding (_embedding_text): hash cũ không còn khớp, mọi pk cần embedding lại 1 lần
+# bằng reembed_outdated (python -m source.utils.product_consumer --reembed)
+EMBEDDING_TEXT_VERSION = 2
 
 class MilvusVectorStore:
-    def __init__(self, milvus_uri, collection_name, embeddings, dimensions, openai_key, recreate_collection = False, logger = None):
+    def __init__(self, milvus_uri, collection_name, embeddings, dimensions, openai_key, recreate_collection = False, logger = None,
+                 ingest_config = None, embedding_exclude_fields = None):
         self.uri = milvus_uri
         self.collection_name = collection_name
         self.embeddings = embeddings
@@ -11,7 +21,24 @@ class MilvusVectorStore:
         self.openai_key = openai_key
         self.recreate_collection = recreate_collection
         self.logger = logger
+        # Cấu hình pipeline embedding + insert (mục `milvus_ingest` trong config.yaml)
+        self.ingest_config = ingest_config or {}
+        # Các trường không đưa vào text embedding của collection này (vd: price, thumbnail của sản phẩm)
+        self.embedding_exclude_fields = list(embedding_exclude_fields or [])
         self.vectorstore = self.create_vectorstore()
+        self.client = MilvusClient(uri=self.uri, token="root:Milvus")
+        # Lưu embedding theo hash của text, text không đổi thì dùng lại vector cũ
+        self.embedding_store = None
+        if self.ingest_config.get("embedding_store_path"):
+            self.embedding_store = EmbeddingStore(self.ingest_config["embedding_store_path"])
+            stored_version = self.embedding_store.get_meta(self._version_key())
+            if self.recreate_collection:
+                self.embedding_store.set_meta(self._version_key(), self._text_version())
+            elif stored_version != self._text_version() and self.logger:
+                self.logger.warning(
+                    f"⚠️ Cách tạo text embedding của {self.collection_name} đã đổi ({stored_version} → {self._text_version()}): "
+                    f"collection đang trộn vector cũ và mới, chạy `python -m source.utils.product_consumer --reembed`"
+                )
 
         
     def create_vectorstore(self):
@@ -102,20 +129,244 @@ class MilvusVectorStore:
         client.close()
         return vector_store
     
-    def add_documents(self, documents):
+    def _with_retry(self, func, description):
+        max_retries = self.ingest_config.get("max_retries", 3)
+        for attempt in range(max_retries + 1):
+            try:
+                return func()
+            except Exception as e:
+                if attempt >= max_retries:
+                    raise
+                delay = self.ingest_config.get("retry_base_delay", 1.0) * (2 ** attempt)
+                self.logger.warning(f"⚠️ {description} lỗi ({e}), thử lại {attempt + 1}/{max_retries} sau {delay:.1f}s")
+                time.sleep(delay)
+
+    def _embedding_text(self, doc) -> str:
+        """
+        Phần text dùng để embedding: bỏ các trường hay thay đổi nhưng không mang ngữ nghĩa
+        (embedding_exclude_fields, vd: price, thumbnail) để cập nhật giá không cần embedding lại.
+        Trường "text" lưu trong Milvus (dùng cho BM25 và trả về kết quả) vẫn là nội dung đầy đủ.
+        """
+        exclude_fields = self.embedding_exclude_fields
+        if not exclude_fields:
+            return doc.page_content
         try:
-            texts = [doc.page_content for doc in documents]
-            metadatas = [doc.metadata for doc in documents]
-            ids = [doc.metadata["pk"] for doc in documents]  
-            self.vectorstore.add_texts(texts, metadatas=metadatas, ids=ids)
-            
-            self.logger.info(f"✅ Thêm {len(documents)} documents vào vectorstore: {self.collection_name}")
-        except Exception as e:
-            self.logger.error(f"❌ Lỗi khi thêm documents: {e}")
+            item = json.loads(doc.page_content)
+        except (TypeError, ValueError):
+            return doc.page_content
+        if not isinstance(item, dict):
+            return doc.page_content
+        return json.dumps({k: v for k, v in item.items() if k not in exclude_fields}, ensure_ascii=False)
+
+    def _text_hash(self, text: str) -> str:
+        model_name = getattr(self.embeddings, "model", None) or getattr(self.embeddings, "model_name", "")
+        return hashlib.sha256(f"{model_name}|{self.dimensions}|v{EMBEDDING_TEXT_VERSION}|{text}".encode("utf-8")).hexdigest()
+
+    def _text_version(self) -> str:
+        return f"{EMBEDDING_TEXT_VERSION}|{','.join(sorted(self.embedding_exclude_fields))}"
+
+    def _version_key(self) -> str:
+        return f"text_version:{self.collection_name}"
+
+    def reembed_outdated(self, batch_size: int = 500) -> int:
+        """
+        Embedding lại các document trong collection có vector không khớp cách tạo text embedding hiện tại
+        (pk chưa có hash trong embedding_store hoặc hash khác), dùng trường "text" đang lưu trong Milvus.
+        Chạy 1 lần sau khi đổi EMBEDDING_TEXT_VERSION / embedding_exclude_fields. Output: số document được embedding lại.
+        """
+        from langchain_core.documents import Document
+
+        iterator = self.client.query_iterator(
+            collection_name=self.collection_name, batch_size=batch_size, filter="", output_fields=["pk", "text"]
+        )
+        reembedded, failed = 0, []
+        try:
+            while True:
+                rows = iterator.next()
+                if not rows:
+                    break
+                documents = [Document(page_content=row["text"], metadata={"pk": row["pk"]}) for row in rows]
+                stored_hashes = {}
+                if self.embedding_store is not None:
+                    stored_hashes = self.embedding_store.get_pk_hashes(self.collection_name, [str(row["pk"]) for row in rows])
+                outdated = [
+                    doc for doc in documents
+                    if stored_hashes.get(str(doc.metadata["pk"])) != self._text_hash(self._embedding_text(doc))
+                ]
+                if outdated:
+                    result = self.add_documents(outdated, upsert=True)
+                    reembedded += result["inserted"]
+                    failed.extend(result["failed"])
+        finally:
+            iterator.close()
+
+        if failed:
+            self.logger.error(f"❌ Còn {len(failed)} document của {self.collection_name} chưa embedding lại được, cần chạy lại")
+        elif self.embedding_store is not None:
+            self.embedding_store.set_meta(self._version_key(), self._text_version())
+        self.logger.info(f"✅ Đã embedding lại {reembedded} document của {self.collection_name}")
+        return reembedded
+
+    def _make_embedding_batches(self, documents):
+        """
+        Chia documents thành các batch embedding theo số document và số token (ước lượng) mỗi request.
+        """
+        max_items = self.ingest_config.get("embedding_batch_size", 256)
+        max_tokens = self.ingest_config.get("embedding_batch_tokens", 200000)
+
+        batches, current, current_tokens = [], [], 0
+        for doc in documents:
+            tokens = len(doc.page_content) // 3 + 1
+            if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(doc)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _embed_batch(self, batch):
+        start = time.perf_counter()
+        vectors = self._with_retry(
+            lambda: self.embeddings.embed_documents([self._embedding_text(doc) for doc in batch]),
+            f"Embedding {len(batch)} documents",
+        )
+        return batch, vectors, time.perf_counter() - start
+
+    def _insert_rows(self, rows, upsert = False):
+        """
+        Insert (hoặc upsert theo pk) rows vào Milvus theo từng chunk; chunk lỗi (sau khi retry) được
+        ghi lại từng row để 1 document lỗi không làm hỏng cả chunk. Output: list pk bị lỗi.
+        Các lần ghi lại luôn dùng upsert: insert bị timeout có thể đã được ghi ở server, insert lại sẽ nhân đôi pk.
+        """
+        insert_batch_size = self.ingest_config.get("insert_batch_size", 500)
+        failed = []
+        for i in range(0, len(rows), insert_batch_size):
+            chunk = rows[i:i + insert_batch_size]
+            start = time.perf_counter()
+            attempts = 0
+
+            def write_chunk():
+                nonlocal attempts
+                write = self.client.upsert if upsert or attempts else self.client.insert
+                attempts += 1
+                return write(collection_name=self.collection_name, data=chunk)
+
+            try:
+                self._with_retry(write_chunk, f"Insert {len(chunk)} rows")
+            except Exception as e:
+                self.logger.error(f"❌ Lỗi khi insert chunk {len(chunk)} rows, upsert lại từng row: {e}")
+                for row in chunk:
+                    try:
+                        self.client.upsert(collection_name=self.collection_name, data=[row])
+                    except Exception as row_error:
+                        self.logger.error(f"❌ Lỗi khi insert pk = {row['pk']}: {row_error}")
+                        failed.append(row["pk"])
+            self.logger.info(f"Insert {len(chunk)} rows vào {self.collection_name} trong {time.perf_counter() - start:.2f}s")
+        return failed
+
+    def add_documents(self, documents, upsert = False):
+        """
+        Pipeline thêm documents vào Milvus:
+        - Chia batch embedding theo số document / token, embedding song song (giới hạn embedding_concurrency)
+        - Batch nào embedding xong thì insert ngay theo chunk insert_batch_size (sparse BM25 do Milvus tự tính)
+        - Batch / chunk lỗi được retry, document lỗi không làm hỏng các document khác
+        - Document có text embedding không đổi (theo hash) dùng lại vector trong embedding_store
+        - upsert=True: ghi đè theo pk thay vì insert (không cần xóa document cũ trước)
+        Output: dict thống kê, gồm list pk bị lỗi ("failed")
+        """
+        start = time.perf_counter()
+        max_text_length = self.ingest_config.get("max_text_length", 32768)
+        failed = []
+        valid_documents = []
+        for doc in documents:
+            pk = doc.metadata.get("pk")
+            if pk is None or pk == "":
+                self.logger.error(f"❌ Document không có pk, bỏ qua: {doc.page_content[:100]}")
+                failed.append(pk)
+            elif len(doc.page_content.encode("utf-8")) > max_text_length:
+                # max_length của VARCHAR trong Milvus tính theo byte UTF-8, không phải số ký tự
+                self.logger.error(f"❌ Document pk = {pk} dài quá {max_text_length} bytes (UTF-8), bỏ qua")
+                failed.append(str(pk))
+            else:
+                valid_documents.append(doc)
+
+        text_hashes = {id(doc): self._text_hash(self._embedding_text(doc)) for doc in valid_documents}
+        stored_vectors = {}
+        if self.embedding_store is not None:
+            stored_vectors = self.embedding_store.get_vectors(list(text_hashes.values()))
+        reused_documents = [doc for doc in valid_documents if text_hashes[id(doc)] in stored_vectors]
+        new_documents = [doc for doc in valid_documents if text_hashes[id(doc)] not in stored_vectors]
+
+        inserted = 0
+        inserted_hashes = {}
+
+        def write_rows(docs, vectors):
+            nonlocal inserted
+            rows = [
+                {"pk": str(doc.metadata["pk"]), "text": doc.page_content, "dense": vector}
+                for doc, vector in zip(docs, vectors)
+            ]
+            failed_pks = set(self._insert_rows(rows, upsert=upsert))
+            failed.extend(failed_pks)
+            inserted += len(rows) - len(failed_pks)
+            for doc in docs:
+                if str(doc.metadata["pk"]) not in failed_pks:
+                    inserted_hashes[str(doc.metadata["pk"])] = text_hashes[id(doc)]
+
+        if reused_documents:
+            self.logger.info(f"Dùng lại embedding của {len(reused_documents)} documents có text không đổi")
+            write_rows(reused_documents, [stored_vectors[text_hashes[id(doc)]] for doc in reused_documents])
+
+        batches = self._make_embedding_batches(new_documents)
+        with ThreadPoolExecutor(max_workers=self.ingest_config.get("embedding_concurrency", 4)) as executor:
+            futures = {executor.submit(self._embed_batch, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    batch, vectors, elapsed = future.result()
+                except Exception as e:
+                    self.logger.error(f"❌ Lỗi khi embedding batch {len(batch)} documents: {e}")
+                    failed.extend(str(doc.metadata["pk"]) for doc in batch)
+                    continue
+
+                self.logger.info(f"Embedding {len(batch)} documents trong {elapsed:.2f}s")
+                if self.embedding_store is not None:
+                    self.embedding_store.set_vectors({text_hashes[id(doc)]: vector for doc, vector in zip(batch, vectors)})
+                write_rows(batch, vectors)
+
+        if self.embedding_store is not None and inserted_hashes:
+            self.embedding_store.set_pk_hashes(self.collection_name, inserted_hashes)
+
+        elapsed = time.perf_counter() - start
+        throughput = inserted / elapsed if elapsed > 0 else 0.0
+        self.logger.info(
+            f"✅ Thêm {inserted}/{len(documents)} documents vào vectorstore: {self.collection_name} "
+            f"trong {elapsed:.2f}s ({throughput:.1f} docs/s), dùng lại embedding: {len(reused_documents)}, lỗi: {len(failed)}"
+        )
+        return {
+            "inserted": inserted,
+            "reused": len(reused_documents),
+            "failed": failed,
+            "elapsed": elapsed,
+            "throughput": throughput,
+        }
         
+    def upsert_documents(self, documents):
+        """
+        Thêm mới hoặc ghi đè documents theo pk (Milvus upsert), idempotent, 1 lượt ghi cho cả batch.
+        """
+        return self.add_documents(documents, upsert=True)
+
     def delete_by_id(self, id):
+        """
+        Xóa document theo pk. Luồng đồng bộ Kafka chỉ upsert, hàm này dùng để xóa thủ công sản phẩm / dịch vụ ngừng bán.
+        """
         try:
             self.vectorstore.delete(ids=[id])
+            if self.embedding_store is not None:
+                self.embedding_store.delete_pk(self.collection_name, str(id))
 
             self.logger.info(f"✅ Đã xóa document với id = {id} khỏi collection {self.collection_name}")
         except Exception as e:
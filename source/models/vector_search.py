@@ -1,3 +1,7 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 hybrid_search_params = [
     {
         "anns_field": "dense",    
@@ -11,10 +15,15 @@ hybrid_search_params = [
     }
 ]
 class MilvusVectorRetriever:
-    def __init__(self, vectorstore, logger):
+    def __init__(self, vectorstore, logger, embedding_cache = None, max_concurrency = 8, executor = None):
         self.vectorstore = vectorstore        
         self.hybrid_search_params = hybrid_search_params
         self.logger = logger 
+        # CachedQueryEmbeddings dùng chung cho vectorstore (nếu có), dùng để theo dõi hit/miss
+        self.embedding_cache = embedding_cache
+        # Giới hạn số truy vấn Milvus chạy đồng thời ngoài event loop
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="milvus_search")
         
     def retrieve(self, query, top_k=5):
         try:
@@ -27,6 +36,36 @@ class MilvusVectorRetriever:
         except Exception as e:
             self.logger.info(f"Error retrieving documents from vector store: {e}")
             return []
+
+    async def aretrieve(self, query, top_k=5):
+        """
+        Bản async của retrieve, không chặn event loop:
+        - Embedding câu hỏi bằng aembed_query (HTTP async), kết quả được đưa vào cache
+        - Truy vấn Milvus (gRPC đồng bộ) chạy trong thread pool có giới hạn,
+          vectorstore đọc lại vector từ cache mà không tính thêm 1 lần hit
+        """
+        async with self.semaphore:
+            prefetched = False
+            if self.embedding_cache is not None:
+                try:
+                    await self.embedding_cache.aembed_query(query)
+                    prefetched = True
+                except Exception as e:
+                    self.logger.info(f"Error embedding query asynchronously: {e}")
+
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(self._retrieve, query, top_k, prefetched))
+
+    def _retrieve(self, query, top_k, prefetched):
+        if not prefetched:
+            return self.retrieve(query, top_k)
+        with self.embedding_cache.prefetched():
+            return self.retrieve(query, top_k)
+
+    def cache_stats(self):
+        if self.embedding_cache is None:
+            return {}
+        return self.embedding_cache.stats()
         
 # if __name__ == "__main__":
 #     from source.models.vector_indexing import MilvusVectorStore
@@ -0,0 +1,42 @@
+import hashlib
+import json
+import math
+from datetime import date, datetime
+from decimal import Decimal
+
+
+def _normalize(value):
+    """
+    Đưa giá trị về dạng chuẩn để 2 nguồn dữ liệu (Kafka payload, Postgres, CSV) cho ra cùng 1 chuỗi JSON:
+    - Decimal / float nguyên → int, NaN → None
+    - datetime / date → ISO format
+    - dict / list được chuẩn hóa đệ quy
+    """
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, Decimal):
+        value = float(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        return int(value) if value.is_integer() else value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def canonical_json(value) -> str:
+    return json.dumps(_normalize(value), sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def content_hash(record: dict, fields: list = None, extra: str = "") -> str:
+    """
+    Hash SHA-256 của các trường `fields` trong record (toàn bộ record nếu fields = None).
+    `extra` dùng để gắn thêm phiên bản prompt / model vào hash.
+    """
+    data = record if fields is None else {field: record.get(field) for field in fields}
+    return hashlib.sha256((extra + canonical_json(data)).encode("utf-8")).hexdigest()
@@ -4,7 +4,37 @@ from bs4 import BeautifulSoup
 import pandas as pd
 import json
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from source.utils.markdown_cache import MarkdownCache
+from source.utils.fast_markdown import fast_markdownify
+
+
+def _safe_not_null(val):
+    if isinstance(val, float):
+        return not pd.isna(val)
+    return val is not None
+
+
+def _convert_chunk(args):
+    # Chạy trong process con của convert(workers > 1)
+    records, html_columns, json_columns, list_columns, markdown_cache_config, fast_html = args
+    markdown_cache = MarkdownCache(**markdown_cache_config) if markdown_cache_config else None
+    converter = convert_df_to_document(markdown_cache=markdown_cache, fast_html=fast_html)
+    documents = converter.convert_records(records, html_columns, json_columns, list_columns)
+    if markdown_cache is not None:
+        markdown_cache.flush()
+    return documents
+
+
 class convert_df_to_document:
+    def __init__(self, markdown_cache: MarkdownCache = None, fast_html: bool = True):
+        # Cache HTML → Markdown theo hash nội dung (None = luôn chuyển đổi lại)
+        self.markdown_cache = markdown_cache
+        # Thử parser 1 lần (fast_markdown) trước, HTML chưa hỗ trợ mới dùng BeautifulSoup + markdownify
+        self.fast_html = fast_html
+        self.fast_html_hits = 0
+        self.fast_html_fallbacks = 0
+
     def normalize_datetime_columns(self, df: pd.DataFrame, datetime_columns: list) -> pd.DataFrame:
         """
         Chuyển định dạng các cột ngày tháng về format: yyyy-MM-dd HH:mm:ss.SSS
@@ -20,6 +50,31 @@ class convert_df_to_document:
         """
         if not html_content or isinstance(html_content, float) and pd.isna(html_content):
             return "NULL"
+        if self.markdown_cache is None:
+            return self._convert_html_to_markdown(html_content)
+
+        key = self.markdown_cache.make_key(html_content)
+        markdown_text = self.markdown_cache.get(key)
+        if markdown_text is None:
+            markdown_text = self._convert_html_to_markdown(html_content)
+            self.markdown_cache.set(key, markdown_text)
+        return markdown_text
+
+    def _convert_html_to_markdown(self, html_content: str) -> str:
+        markdown_text = fast_markdownify(html_content) if self.fast_html else None
+        if markdown_text is None:
+            markdown_text = self._markdownify_bs(html_content)
+            self.fast_html_fallbacks += 1
+        else:
+            self.fast_html_hits += 1
+        markdown_text = re.sub(r'!\[.*?\]\(.*?\)', '', markdown_text)
+        markdown_text = "\n".join(line for line in markdown_text.splitlines() if line.strip())
+        return markdown_text or "NULL"
+
+    def _markdownify_bs(self, html_content: str) -> str:
+        """
+        Đường chuyển đổi gốc: làm sạch bằng BeautifulSoup rồi markdownify.
+        """
         soup = BeautifulSoup(html_content, "html.parser")
 
         for style in soup.find_all("style"):
@@ -36,10 +91,7 @@ class convert_df_to_document:
             del tag["data-pb-style"]
 
         clean_html = str(soup)
-        markdown_text = md(clean_html, heading_style="ATX", bullets="-")
-        markdown_text = re.sub(r'!\[.*?\]\(.*?\)', '', markdown_text)
-        markdown_text = "\n".join(line for line in markdown_text.splitlines() if line.strip())
-        return markdown_text or "NULL"
+        return md(clean_html, heading_style="ATX", bullets="-")
 
     def convert_list_dict_to_json(self, cell_value):
         """
@@ -84,48 +136,77 @@ class convert_df_to_document:
         return []
 
     def convert_df_to_list_json(self, df: pd.DataFrame) -> list:
-        def safe_not_null(val):
-            if isinstance(val, float):
-                return not pd.isna(val)
-            return val is not None
-
         result_series = df.apply(
             lambda row: json.dumps(
-                {col: row[col] for col in df.columns if safe_not_null(row[col])},
+                {col: row[col] for col in df.columns if _safe_not_null(row[col])},
                 ensure_ascii=False
             ),
             axis=1
         )
         return result_series.dropna().tolist()
 
-    def convert(self, df, html_columns=[], json_columns=[], list_columns=[], drop_columns=[], datetime_columns=[]):
+    def convert_records(self, records, html_columns=[], json_columns=[], list_columns=[]) -> list:
+        """
+        Chuyển đổi list các dòng (dict) sang list dict, không qua DataFrame.apply.
+        Kết quả giống hệt convert_df_to_list_json sau các bước chuyển đổi cột trong convert.
+        """
+        documents = []
+        for row in records:
+            for col in html_columns:
+                row[col] = self.convert_html_to_markdown(row[col])
+            for col in json_columns:
+                row[col] = self.convert_list_dict_to_json(row[col])
+            for col in list_columns:
+                row[col] = self.parse_list_string(row[col])
+            documents.append({col: value for col, value in row.items() if _safe_not_null(value)})
+        return documents
+
+    def convert(self, df, html_columns=[], json_columns=[], list_columns=[], drop_columns=[], datetime_columns=[],
+                workers=None, chunk_size=500, as_dict=False):
         """
         Chuyển đổi DataFrame sang danh sách JSON:
         - html_columns: HTML ➜ Markdown
         - json_columns: list dict ➜ dict con
         - list_columns: chuỗi dạng list ➜ list thực
+        - workers: số process chuyển đổi song song theo từng khối chunk_size dòng (None / 1: chạy trong process hiện tại)
+        - as_dict: trả về list dict thay vì list chuỗi JSON (không cần json.loads lại)
         """
         clean_df = df.copy()
         clean_df = clean_df.dropna(axis=1, how='all') 
         clean_df = clean_df.drop(columns=drop_columns, errors='ignore') 
-        
-        for col in html_columns:
-            clean_df[col] = clean_df[col].apply(lambda x: self.convert_html_to_markdown(x))
-
-        for col in json_columns:
-            clean_df[col] = clean_df[col].apply(lambda x: self.convert_list_dict_to_json(x))
-
-        for col in list_columns:
-            clean_df[col] = clean_df[col].apply(lambda x: self.parse_list_string(x))
-                
+        # Cột ngày tháng chuẩn hóa trên cả cột (pd.to_datetime suy ra format từ toàn bộ cột)
         clean_df = self.normalize_datetime_columns(clean_df, datetime_columns)
 
-        return self.convert_df_to_list_json(clean_df)
+        for col in html_columns + json_columns + list_columns:
+            if col not in clean_df.columns:
+                raise KeyError(col)
+
+        records = clean_df.to_dict("records")
+        if workers and workers > 1 and len(records) > chunk_size:
+            markdown_cache_config = self.markdown_cache.config if self.markdown_cache is not None else None
+            if self.markdown_cache is not None:
+                self.markdown_cache.flush()
+            chunks = [
+                (records[i:i + chunk_size], html_columns, json_columns, list_columns, markdown_cache_config,
+                 self.fast_html)
+                for i in range(0, len(records), chunk_size)
+            ]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                documents = [doc for chunk in executor.map(_convert_chunk, chunks) for doc in chunk]
+        else:
+            documents = self.convert_records(records, html_columns, json_columns, list_columns)
+            if self.markdown_cache is not None:
+                self.markdown_cache.flush()
+
+        if as_dict:
+            return documents
+        return [json.dumps(doc, ensure_ascii=False) for doc in documents]
 
 
 
 if __name__ == "__main__":
         
+    import os
     import pandas as pd
     import json
 
@@ -135,19 +216,22 @@ if __name__ == "__main__":
     service_df = pd.read_csv(service_path, encoding="utf-8")
 
 
-    converter = convert_df_to_document()
+    from configs.config import load_config
+    markdown_cache_config = load_config().get("markdown_cache")
+    markdown_cache = MarkdownCache(**markdown_cache_config) if markdown_cache_config else None
+    converter = convert_df_to_document(markdown_cache=markdown_cache)
+    workers = os.cpu_count()
 
     product_documents = converter.convert(product_df, 
                                         html_columns=["description", "salient_features", "short_description"], 
                                         json_columns=["attributes"], 
                                         list_columns=['images', 'category_id'],
-                                        drop_columns=['services'])
+                                        drop_columns=['services'],
+                                        workers=workers, as_dict=True)
     service_documents = converter.convert(service_df, 
                                         html_columns=['description'],
-                                        datetime_columns=['created_at', 'updated_at'])
-
-    service_documents = [json.loads(doc) if isinstance(doc, str) else doc for doc in service_documents]
-    product_documents = [json.loads(doc) if isinstance(doc, str) else doc for doc in product_documents]
+                                        datetime_columns=['created_at', 'updated_at'],
+                                        workers=workers, as_dict=True)
 
     with open("data/products.json", "w", encoding="utf-8") as f:
         json.dump(product_documents, f, ensure_ascii=False, indent=2)
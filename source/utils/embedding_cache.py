@@ -0,0 +1,90 @@
+import re
+import threading
+import unicodedata
+import logging
+from contextlib import contextmanager
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from source.utils.ttl_cache import LRUTTLCache
+
+
+def normalize_query(text: str) -> str:
+    """
+    Chuẩn hóa câu hỏi trước khi làm key cache: Unicode NFC, bỏ khoảng trắng thừa, không phân biệt hoa thường.
+    """
+    text = unicodedata.normalize("NFC", text or "")
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.casefold()
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Bọc 1 model embeddings (vd: OpenAIEmbeddings) và cache vector của câu truy vấn.
+    - Key cache: (câu hỏi đã chuẩn hóa, tên model, số chiều)
+    - embed_documents không cache (dùng cho indexing), chỉ embed_query / aembed_query được cache
+    """
+    def __init__(self, embeddings: Embeddings, model_name: str, dimensions: int,
+                 max_size: int = 5000, ttl_seconds: float = None, persist_path: str = None, logger = None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.dimensions = dimensions
+        self.persist_path = persist_path
+        self.logger = logger or logging.getLogger(__name__)
+        self.cache = LRUTTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self._local = threading.local()
+
+        if self.persist_path:
+            try:
+                loaded = self.cache.load(self.persist_path)
+                self.logger.info(f"Đã nạp {loaded} query embeddings từ {self.persist_path}")
+            except Exception as e:
+                self.logger.warning(f"⚠️ Không thể nạp embedding cache từ {self.persist_path}: {e}")
+
+    def _make_key(self, text: str) -> str:
+        return f"{self.model_name}|{self.dimensions}|{normalize_query(text)}"
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    @contextmanager
+    def prefetched(self):
+        """
+        Câu hỏi đã được aembed_query trong thread này (đã tính hit / miss): embed_query bên trong không tính lại.
+        """
+        self._local.prefetched = True
+        try:
+            yield
+        finally:
+            self._local.prefetched = False
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._make_key(text)
+        vector = self.cache.get(key, count=not getattr(self._local, "prefetched", False))
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.set(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._make_key(text)
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            self.cache.set(key, vector)
+        return vector
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+    def save(self) -> None:
+        if not self.persist_path:
+            return
+        try:
+            self.cache.save(self.persist_path)
+            self.logger.info(f"Đã lưu {len(self.cache)} query embeddings xuống {self.persist_path}")
+        except Exception as e:
+            self.logger.error(f"❌ Lỗi khi lưu embedding cache: {e}")
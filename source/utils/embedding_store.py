@@ -0,0 +1,98 @@
+import sqlite3
+import threading
+from array import array
+from pathlib import Path
+
+
+class EmbeddingStore:
+    """
+    Lưu embedding của documents xuống SQLite để không phải embedding lại text không đổi:
+    - embeddings: hash của text đã embedding (kèm model, số chiều) -> vector
+    - pk_hashes: (collection, pk) -> hash của text hiện đang lưu trong Milvus
+    Vector của text cũ bị thay thế / xóa (text đổi, đổi EMBEDDING_TEXT_VERSION) được xóa khi không còn pk nào dùng.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "text_hash TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pk_hashes ("
+            "collection TEXT NOT NULL, pk TEXT NOT NULL, text_hash TEXT NOT NULL, PRIMARY KEY (collection, pk))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pk_hashes_text_hash ON pk_hashes (text_hash)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+
+    def _select_in(self, query: str, params: list, values: list) -> list:
+        rows = []
+        values = list(set(values))
+        with self._lock:
+            for i in range(0, len(values), 500):
+                chunk = values[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(self.conn.execute(query.format(placeholders=placeholders), params + chunk).fetchall())
+        return rows
+
+    def get_vectors(self, text_hashes: list) -> dict:
+        rows = self._select_in("SELECT text_hash, vector FROM embeddings WHERE text_hash IN ({placeholders})", [], text_hashes)
+        return {text_hash: array("f", vector).tolist() for text_hash, vector in rows}
+
+    def set_vectors(self, items: dict) -> None:
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (text_hash, vector) VALUES (?, ?)",
+                [(text_hash, array("f", vector).tobytes()) for text_hash, vector in items.items()],
+            )
+            self.conn.commit()
+
+    def get_pk_hashes(self, collection: str, pks: list) -> dict:
+        rows = self._select_in(
+            "SELECT pk, text_hash FROM pk_hashes WHERE collection = ? AND pk IN ({placeholders})", [collection], pks
+        )
+        return dict(rows)
+
+    def set_pk_hashes(self, collection: str, items: dict) -> None:
+        previous = self.get_pk_hashes(collection, list(items))
+        replaced = {text_hash for pk, text_hash in previous.items() if text_hash != items[pk]}
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pk_hashes (collection, pk, text_hash) VALUES (?, ?, ?)",
+                [(collection, pk, text_hash) for pk, text_hash in items.items()],
+            )
+            self._delete_orphans(replaced)
+            self.conn.commit()
+
+    def _delete_orphans(self, text_hashes: set) -> None:
+        # Chỉ xóa vector không còn pk nào dùng (nhiều pk có thể cùng text), vector của index khác
+        # (vd. truy vấn mẫu của SQLPromptBuilder) không nằm trong text_hashes nên không bị xóa
+        text_hashes = list(text_hashes)
+        for i in range(0, len(text_hashes), 500):
+            chunk = text_hashes[i:i + 500]
+            self.conn.execute(
+                f"DELETE FROM embeddings WHERE text_hash IN ({','.join('?' * len(chunk))}) "
+                "AND NOT EXISTS (SELECT 1 FROM pk_hashes WHERE pk_hashes.text_hash = embeddings.text_hash)",
+                chunk,
+            )
+
+    def get_meta(self, key: str):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+            self.conn.commit()
+
+    def delete_pk(self, collection: str, pk: str) -> None:
+        previous = self.get_pk_hashes(collection, [pk])
+        with self._lock:
+            self.conn.execute("DELETE FROM pk_hashes WHERE collection = ? AND pk = ?", (collection, pk))
+            self._delete_orphans(set(previous.values()))
+            self.conn.commit()
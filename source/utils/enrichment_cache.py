@@ -0,0 +1,80 @@
+import json
+import sqlite3
+import threading
+import time
+import hashlib
+from pathlib import Path
+
+from source.utils.content_hash import content_hash
+
+# Các trường được LLM dùng để trích xuất cột mới, chỉ khi các trường này đổi mới cần gọi lại LLM
+ENRICHMENT_SOURCE_FIELDS = ["name", "short_description", "description", "salient_features", "attributes"]
+
+
+def prompt_version(template: str) -> str:
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:12]
+
+
+class EnrichmentCache:
+    """
+    Cache SQLite các cột LLM đã trích xuất (length, width, power, ...) cho từng sản phẩm.
+    Key = hash(ENRICHMENT_SOURCE_FIELDS + phiên bản prompt + model), nên sản phẩm chỉ đổi giá / ảnh
+    sẽ dùng lại kết quả cũ mà không cần gọi LLM.
+    """
+    def __init__(self, path: str, prompt_version: str, model_name: str):
+        self.path = path
+        self.prompt_version = prompt_version
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS enrichment_cache ("
+            "key TEXT PRIMARY KEY, sku TEXT, columns TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def make_key(self, product: dict) -> str:
+        return content_hash(product, ENRICHMENT_SOURCE_FIELDS, extra=f"{self.prompt_version}|{self.model_name}|")
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Trả về {key: các cột đã trích xuất} cho các key có trong cache.
+        """
+        unique_keys = list(set(keys))
+        found = {}
+        with self._lock:
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, columns FROM enrichment_cache WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update({key: json.loads(columns) for key, columns in rows})
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def set_many(self, items: list) -> None:
+        """
+        items: list các tuple (key, sku, các cột đã trích xuất)
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO enrichment_cache (key, sku, columns, created_at) VALUES (?, ?, ?, ?)",
+                [(key, sku, json.dumps(columns, ensure_ascii=False), now) for key, sku, columns in items],
+            )
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,367 @@
+"""
+Chuyển HTML (Magento PageBuilder) sang Markdown trong 1 lần parse bằng html.parser.HTMLParser,
+cho kết quả giống convert_df_to_document._markdownify_bs (BeautifulSoup + markdownify) nhưng không dựng soup 2 lần.
+
+- Chỉ hỗ trợ các thẻ hay gặp trong dữ liệu sản phẩm / dịch vụ (SUPPORTED_TAGS), gặp thẻ khác, comment,
+  doctype hoặc charref lạ thì trả về None để gọi lại đường BeautifulSoup
+- Làm sạch giống bản gốc: bỏ <style>, <img>, <figure> rỗng (data-pb-style không ảnh hưởng Markdown)
+- Phần chuyển Markdown là bản rút gọn của markdownify.MarkdownConverter với heading_style="ATX", bullets="-"
+
+Kết quả giống hệt bản gốc được kiểm tra trong tests/test_fast_markdown.py; đo tốc độ trên các file CSV:
+    python -m source.utils.fast_markdown
+"""
+import re
+from html.parser import HTMLParser
+
+from bs4.dammit import EntitySubstitution
+
+SUPPORTED_TAGS = {
+    "p", "div", "span", "strong", "b", "em", "i", "br", "ul", "li", "a",
+    "h1", "h2", "h3", "h4", "h5", "h6", "figure", "img", "style",
+}
+# Thẻ rỗng theo HTMLTreeBuilder của BeautifulSoup
+_VOID_TAGS = {"br", "img"}
+_BLOCK_TAGS = {
+    "p", "blockquote", "article", "div", "section", "ol", "ul", "li",
+    "dl", "dt", "dd", "table", "thead", "tbody", "tfoot", "tr", "td", "th",
+}
+_ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+re_html_heading = re.compile(r"h(\d+)")
+re_line_with_content = re.compile(r"^(.*)", flags=re.MULTILINE)
+re_whitespace = re.compile(r"[\t ]+")
+re_all_whitespace = re.compile(r"[\t \r\n]+")
+re_newline_whitespace = re.compile(r"[\t \r\n]*[\r\n][\t \r\n]*")
+re_extract_newlines = re.compile(r"^(\n*)((?:.*[^\n])?)(\n*)$", flags=re.DOTALL)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _Text:
+    __slots__ = ("segments", "text", "parent", "prev", "next")
+    name = None
+
+    def __init__(self, text, parent):
+        self.segments = [text]
+        self.text = text
+        self.parent = parent
+        self.prev = self.next = None
+
+
+class _Element:
+    __slots__ = ("name", "attrs", "children", "parent", "prev", "next")
+
+    def __init__(self, name, attrs, parent):
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+        self.parent = parent
+        self.prev = self.next = None
+
+
+def _collapse_whitespace(text):
+    # Giống BeautifulSoup.endData: chuỗi chỉ gồm khoảng trắng ASCII thành "\n" hoặc " "
+    if text.strip(_ASCII_SPACES) == "":
+        return "\n" if "\n" in text else " "
+    return text
+
+
+class _TreeBuilder(HTMLParser):
+    """
+    Dựng cây rút gọn với cùng các sự kiện và quy tắc đóng thẻ như BeautifulSoupHTMLParser.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.root = _Element("[document]", {}, None)
+        self.stack = [self.root]
+        self.data = []
+        self.already_closed_empty_element = []
+
+    def end_data(self):
+        if self.data:
+            text = _collapse_whitespace("".join(self.data))
+            self.data = []
+            self.stack[-1].children.append(_Text(text, self.stack[-1]))
+
+    def _start(self, tag, attrs):
+        if tag not in SUPPORTED_TAGS:
+            raise _Unsupported(tag)
+        self.end_data()
+        element = _Element(tag, {k: ("" if v is None else v) for k, v in attrs}, self.stack[-1])
+        self.stack[-1].children.append(element)
+        return element
+
+    def handle_starttag(self, tag, attrs):
+        element = self._start(tag, attrs)
+        if tag in _VOID_TAGS:
+            self.already_closed_empty_element.append(tag)
+        else:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in self.already_closed_empty_element:
+            self.already_closed_empty_element.remove(tag)
+            return
+        self.end_data()
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].name == tag:
+                del self.stack[i:]
+                break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.data.append(character if character is not None else "&%s" % name)
+
+    def handle_charref(self, name):
+        try:
+            code = int(name[1:], 16) if name[:1] in ("x", "X") else int(name)
+        except ValueError:
+            raise _Unsupported("charref")
+        # Khoảng 128-159 (windows-1252), surrogate, mã không hợp lệ: để BeautifulSoup xử lý
+        if code < 32 or 127 <= code < 160 or 0xD800 <= code <= 0xDFFF or code > 0x10FFFF:
+            raise _Unsupported("charref")
+        self.data.append(chr(code))
+
+    def handle_comment(self, data):
+        raise _Unsupported("comment")
+
+    def handle_decl(self, decl):
+        raise _Unsupported("decl")
+
+    def handle_pi(self, data):
+        raise _Unsupported("pi")
+
+    def unknown_decl(self, data):
+        raise _Unsupported("decl")
+
+    def build(self, html):
+        self.feed(html)
+        self.close()
+        self.end_data()
+        return self.root
+
+
+def _has_text(element):
+    for child in element.children:
+        if child.name is None:
+            if child.text.strip():
+                return True
+        elif _has_text(child):
+            return True
+    return False
+
+
+def _clean(element):
+    """
+    Bỏ <style>, <img>, <figure> không có chữ; gộp các đoạn text liền nhau như khi parse lại HTML đã làm sạch.
+    """
+    children = []
+    for child in element.children:
+        if child.name in ("style", "img"):
+            continue
+        if child.name is not None:
+            _clean(child)
+            if child.name == "figure" and not _has_text(child):
+                continue
+        if child.name is None and children and children[-1].name is None:
+            children[-1].segments.extend(child.segments)
+            continue
+        children.append(child)
+
+    for i, child in enumerate(children):
+        if child.name is None:
+            child.text = _collapse_whitespace("".join(child.segments))
+        child.prev = children[i - 1] if i > 0 else None
+        child.next = children[i + 1] if i + 1 < len(children) else None
+    element.children = children
+
+
+def _remove_inside(el):
+    if el is None or not el.name:
+        return False
+    return re_html_heading.match(el.name) is not None or el.name in _BLOCK_TAGS
+
+
+def _remove_outside(el):
+    return _remove_inside(el) or (el is not None and el.name == "pre")
+
+
+def _chomp(text):
+    prefix = " " if text and text[0] == " " else ""
+    suffix = " " if text and text[-1] == " " else ""
+    return prefix, suffix, text.strip()
+
+
+def _next_block_content_sibling(el):
+    el = el.next
+    while el is not None:
+        if el.name is not None or el.text.strip() != "":
+            return el
+        el = el.next
+    return None
+
+
+def _process_text(el):
+    text = re_newline_whitespace.sub("\n", el.text)
+    text = re_whitespace.sub(" ", text)
+    text = text.replace("*", r"\*").replace("_", r"\_")
+
+    if _remove_outside(el.prev) or (_remove_inside(el.parent) and el.prev is None):
+        text = text.lstrip(" \t\r\n")
+    if _remove_outside(el.next) or (_remove_inside(el.parent) and el.next is None):
+        text = text.rstrip()
+    return text
+
+
+def _process_tag(node, parent_tags):
+    remove_inside = _remove_inside(node)
+    children = []
+    for el in node.children:
+        if el.name is None and el.text.strip() == "":
+            if remove_inside and (el.prev is None or el.next is None):
+                continue
+            if _remove_outside(el.prev) or _remove_outside(el.next):
+                continue
+        children.append(el)
+
+    child_tags = parent_tags | {node.name}
+    if re_html_heading.match(node.name) is not None:
+        child_tags = child_tags | {"_inline"}
+
+    child_strings = [
+        _process_text(el) if el.name is None else _process_tag(el, child_tags)
+        for el in children
+    ]
+
+    # Gộp xuống dòng ở ranh giới giữa các phần tử con (tối đa 2 dòng)
+    updated = [""]
+    for child_string in child_strings:
+        if not child_string:
+            continue
+        leading_nl, content, trailing_nl = re_extract_newlines.match(child_string).groups()
+        if updated[-1] and leading_nl:
+            prev_trailing_nl = updated.pop()
+            leading_nl = "\n" * min(2, max(len(prev_trailing_nl), len(leading_nl)))
+        updated.extend([leading_nl, content, trailing_nl])
+    text = "".join(updated)
+
+    return _convert_tag(node, text, parent_tags)
+
+
+def _convert_tag(el, text, parent_tags):
+    name = el.name
+    inline = "_inline" in parent_tags
+
+    if name == "[document]":
+        return text.strip("\n")
+
+    if name == "p":
+        if inline:
+            return " " + text.strip(" \t\r\n") + " "
+        text = text.strip(" \t\r\n")
+        return "\n\n%s\n\n" % text if text else ""
+
+    if name == "div":
+        if inline:
+            return " " + text.strip() + " "
+        text = text.strip()
+        return "\n\n%s\n\n" % text if text else ""
+
+    if name in ("strong", "b", "em", "i"):
+        markup = "**" if name in ("strong", "b") else "*"
+        prefix, suffix, text = _chomp(text)
+        if not text:
+            return ""
+        return "%s%s%s%s%s" % (prefix, markup, text, markup, suffix)
+
+    if name == "br":
+        if inline:
+            return text + " " if text else " "
+        return "  \n" + text
+
+    if name == "a":
+        prefix, suffix, text = _chomp(text)
+        if not text:
+            return ""
+        href = el.attrs.get("href")
+        title = el.attrs.get("title")
+        if text.replace(r"\_", "_") == href and not title:
+            return "<%s>" % href
+        title_part = ' "%s"' % title.replace('"', r"\"") if title else ""
+        return "%s[%s](%s%s)%s" % (prefix, text, href, title_part, suffix) if href else text
+
+    match = re_html_heading.match(name)
+    if match:
+        if inline:
+            return text
+        n = max(1, min(6, int(match.group(1))))
+        text = re_all_whitespace.sub(" ", text.strip())
+        return "\n\n%s %s\n\n" % ("#" * n, text)
+
+    if name == "ul":
+        next_sibling = _next_block_content_sibling(el)
+        before_paragraph = next_sibling is not None and next_sibling.name not in ("ul", "ol")
+        if "li" in parent_tags:
+            return "\n" + text.rstrip()
+        return "\n\n" + text + ("\n" if before_paragraph else "")
+
+    if name == "li":
+        text = (text or "").strip()
+        if not text:
+            return "\n"
+        # bullets="-" nên mọi cấp lồng nhau đều dùng "-"
+        text = re_line_with_content.sub(lambda m: "  " + m.group(1) if m.group(1) else "", text)
+        return "- " + text[2:] + "\n"
+
+    # span, figure: giữ nguyên nội dung
+    return text
+
+
+def fast_markdownify(html: str):
+    """
+    HTML → Markdown (chưa qua bước hậu xử lý của convert_html_to_markdown).
+    Trả về None nếu HTML có cấu trúc chưa hỗ trợ, khi đó cần dùng đường BeautifulSoup.
+    """
+    try:
+        root = _TreeBuilder().build(html)
+    except Exception:
+        return None
+    _clean(root)
+    return _process_tag(root, set())
+
+
+if __name__ == "__main__":
+    import time
+    import pandas as pd
+    from source.utils.convert_df_to_document import convert_df_to_document
+
+    samples = []
+    for path, columns in [
+        ("data/data_products_29_2_2025.csv", ["description", "salient_features", "short_description"]),
+        ("data/data_service_29_2_2025.csv", ["description"]),
+    ]:
+        df = pd.read_csv(path, encoding="utf-8")
+        for column in columns:
+            samples.extend(value for value in df[column].dropna() if value)
+
+    converter = convert_df_to_document(fast_html=False)
+    start = time.perf_counter()
+    for html in samples:
+        converter._markdownify_bs(html)
+    bs_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fallbacks = sum(1 for html in samples if fast_markdownify(html) is None)
+    fast_seconds = time.perf_counter() - start
+
+    print(f"Số đoạn HTML: {len(samples)}, fallback: {fallbacks}")
+    print(f"BeautifulSoup + markdownify: {len(samples) / bs_seconds:.0f} đoạn/s")
+    print(f"Fast path: {len(samples) / fast_seconds:.0f} đoạn/s ({bs_seconds / fast_seconds:.1f}x)")
@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+from elasticsearch import Elasticsearch
+
+
+class IndexGeneration:
+    """
+    Số thế hệ (generation) của 1 index Elasticsearch, thay đổi mỗi khi dữ liệu trong index thay đổi.
+    - Lưu trong `_meta` của mapping nên mọi process (Kafka consumer, retrieval_app) đều đọc được
+    - Giá trị là time.time_ns() tại thời điểm thay đổi → luôn khác giá trị cũ, không cần đọc-rồi-tăng
+    - Phía đọc chỉ hỏi lại ES sau mỗi check_interval giây
+    - Phía ghi cập nhật `_meta` (1 lần cập nhật cluster state) tối đa 1 lần mỗi settle_seconds:
+      các lần bump trong khoảng đó được gộp vào 1 lần ghi ở cuối khoảng
+    """
+    def __init__(self, es: Elasticsearch, index_name: str, check_interval: float = 5.0, settle_seconds: float = 2.0, logger = None):
+        self.es = es
+        self.index_name = index_name
+        self.check_interval = check_interval
+        self.settle_seconds = settle_seconds
+        self.logger = logger or logging.getLogger(__name__)
+        self._generation = 0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._written_at = None   # time.monotonic() của lần ghi _meta gần nhất
+        self._timer = None        # lần ghi đang đợi hết khoảng settle_seconds
+
+    def bump(self) -> int:
+        """
+        Đánh dấu index vừa thay đổi, gọi sau mỗi lần thêm / xóa document.
+        """
+        with self._lock:
+            if self._timer is not None:
+                # Đã có 1 lần ghi đang đợi, lần ghi đó sẽ ghi generation mới hơn
+                return self._generation
+            delay = 0.0
+            if self._written_at is not None:
+                delay = self._written_at + self.settle_seconds - time.monotonic()
+            if delay > 0:
+                # Timer không phải daemon: process vẫn ghi nốt generation trước khi thoát
+                self._timer = threading.Timer(delay, self._write)
+                self._timer.start()
+                return self._generation
+            # Giữ chỗ khoảng settle_seconds để các thread bump cùng lúc không cùng ghi
+            self._written_at = time.monotonic()
+        return self._write()
+
+    def _write(self) -> int:
+        generation = time.time_ns()
+        try:
+            self.es.indices.put_mapping(index=self.index_name, meta={"generation": generation})
+        except Exception as e:
+            self.logger.warning(f"⚠️ Không thể cập nhật generation của index {self.index_name}: {e}")
+        with self._lock:
+            self._generation = generation
+            self._checked_at = time.monotonic()
+            self._written_at = self._checked_at
+            self._timer = None
+        return generation
+
+    def current(self) -> int:
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._generation
+
+        try:
+            resp = self.es.indices.get_mapping(index=self.index_name)
+            mappings = next(iter(resp.values()), {}).get("mappings", {})
+            self._generation = mappings.get("_meta", {}).get("generation", 0)
+        except Exception as e:
+            self.logger.warning(f"⚠️ Không thể đọc generation của index {self.index_name}: {e}")
+        self._checked_at = now
+        return self._generation
+
+    def is_settled(self, generation: int) -> bool:
+        """
+        Index đã refresh sau lần thay đổi gần nhất hay chưa (kết quả đọc trước đó có thể vẫn là dữ liệu cũ).
+        """
+        return time.time_ns() - generation >= self.settle_seconds * 1e9
@@ -1,8 +1,11 @@
 # modules/llm_invoker.py
 from langchain_core.messages import BaseMessage
 from langchain_openai import ChatOpenAI 
-from typing import List, AsyncGenerator
+from typing import List, AsyncGenerator, Optional, Tuple
+import asyncio
 import logging
+import random
+import openai
 
 logger = logging.getLogger("llm_invoker")
 
@@ -23,4 +26,45 @@ async def invoke_llm_for_full_response(llm: ChatOpenAI,messages: List[BaseMessag
             return response.content.strip()
         return str(response).strip()
     except Exception as e:
-        logger.exception(f"Error calling LLM for full response: {e}")
\ No newline at end of file
+        logger.exception(f"Error calling LLM for full response: {e}")
+
+async def invoke_llm_with_usage(llm: ChatOpenAI, messages: List[BaseMessage]) -> Tuple[Optional[str], dict]:
+    """Như invoke_llm_for_full_response nhưng trả thêm usage_metadata (số token input / output / cache)."""
+    try:
+        response = await llm.ainvoke(messages)
+        usage = getattr(response, 'usage_metadata', None) or {}
+        if hasattr(response, 'content'):
+            return response.content.strip(), usage
+        return str(response).strip(), usage
+    except Exception as e:
+        logger.exception(f"Error calling LLM for full response: {e}")
+        return None, {}
+
+def is_retryable_llm_error(error: Exception) -> bool:
+    """Lỗi tạm thời của API (429, 5xx, timeout, mất kết nối) thì nên gọi lại."""
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+async def invoke_llm_with_retry(llm: ChatOpenAI, messages: List[BaseMessage], max_retries: int = 5,
+                                base_delay: float = 1.0, max_delay: float = 60.0) -> str:
+    """
+    Gọi LLM và thử lại với exponential backoff (có jitter) khi gặp lỗi 429/5xx.
+    Khác invoke_llm_for_full_response: lỗi cuối cùng được raise ra cho nơi gọi xử lý.
+    """
+    attempt = 0
+    while True:
+        try:
+            response = await llm.ainvoke(messages)
+            if hasattr(response, 'content'):
+                return response.content.strip()
+            return str(response).strip()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable_llm_error(e):
+                raise
+            delay = min(base_delay * (2 ** attempt), max_delay) * (0.5 + random.random() / 2)
+            attempt += 1
+            logger.warning(f"LLM call failed ({e}), retry {attempt}/{max_retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
@@ -0,0 +1,111 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from importlib import metadata
+from pathlib import Path
+
+from source.utils.ttl_cache import LRUTTLCache
+
+# Tăng khi đổi logic convert_html_to_markdown để không dùng lại kết quả cũ
+MARKDOWN_CONVERTER_VERSION = "1"
+
+
+def _package_version(name: str) -> str:
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def converter_version() -> str:
+    # Kết quả phụ thuộc cả phiên bản markdownify / beautifulsoup4
+    return f"{MARKDOWN_CONVERTER_VERSION}|markdownify={_package_version('markdownify')}|bs4={_package_version('beautifulsoup4')}"
+
+
+class MarkdownCache:
+    """
+    Cache kết quả HTML → Markdown theo hash(HTML gốc + phiên bản converter):
+    - Tầng 1: LRUTTLCache trong bộ nhớ
+    - Tầng 2 (tùy chọn, persist_path): SQLite, dùng chung giữa các process / các lần chạy
+    Nhiều sản phẩm dùng chung đoạn HTML mẫu, và batch đồng bộ gửi lại HTML không đổi nên phần lớn lần gọi là hit.
+    """
+    def __init__(self, max_size: int = 20000, ttl_seconds: float = None, persist_path: str = None,
+                 flush_every: int = 500):
+        self.config = {"max_size": max_size, "ttl_seconds": ttl_seconds, "persist_path": persist_path,
+                       "flush_every": flush_every}
+        self.flush_every = flush_every
+        self._pending = []
+        self.version = converter_version()
+        self.memory = LRUTTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self.persist_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.conn = None
+        if persist_path:
+            Path(persist_path).parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(persist_path, check_same_thread=False, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS markdown_cache ("
+                "key TEXT PRIMARY KEY, markdown TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self.conn.commit()
+
+    def make_key(self, html: str) -> str:
+        return hashlib.sha256(f"{self.version}|{html}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None or self.conn is None:
+            if value is None:
+                with self._lock:
+                    self.misses += 1
+            return value
+
+        with self._lock:
+            row = self.conn.execute("SELECT markdown FROM markdown_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.persist_hits += 1
+        self.memory.set(key, row[0])
+        return row[0]
+
+    def set(self, key: str, markdown: str) -> None:
+        self.memory.set(key, markdown)
+        if self.conn is None:
+            return
+        with self._lock:
+            self._pending.append((key, markdown, time.time()))
+            if len(self._pending) < self.flush_every:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        """
+        Ghi các kết quả mới xuống SQLite (gom nhiều dòng vào 1 transaction).
+        """
+        if self.conn is None:
+            return
+        with self._lock:
+            if not self._pending:
+                return
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO markdown_cache (key, markdown, created_at) VALUES (?, ?, ?)", self._pending
+            )
+            self.conn.commit()
+            self._pending = []
+
+    def stats(self) -> dict:
+        memory_stats = self.memory.stats()
+        total = memory_stats["hits"] + self.persist_hits + self.misses
+        return {
+            "memory_hits": memory_stats["hits"],
+            "persist_hits": self.persist_hits,
+            "misses": self.misses,
+            "hit_rate": round((memory_stats["hits"] + self.persist_hits) / total, 4) if total else 0.0,
+            "size": memory_stats["size"],
+            "evictions": memory_stats["evictions"],
+        }
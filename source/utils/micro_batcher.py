@@ -0,0 +1,93 @@
+import time
+from collections import defaultdict, deque
+
+
+class MicroBatcher:
+    """
+    Gom bản ghi của 1 topic thành batch, flush khi đạt 1 trong 3 giới hạn:
+    - max_records: số bản ghi
+    - max_bytes: tổng kích thước message (byte, đã serialize)
+    - max_linger_ms: thời gian bản ghi đầu tiên trong batch đã đợi
+    Lúc ít message, batch được flush sau tối đa max_linger_ms (độ trễ có giới hạn);
+    lúc tải cao, batch đầy nhanh theo max_records / max_bytes nên kích thước batch lớn hơn.
+    """
+    def __init__(self, topic: str, max_records: int = 100, max_bytes: int = 1048576, max_linger_ms: int = 2000):
+        self.topic = topic
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_linger_ms = max_linger_ms
+
+        self._reset()
+        self.flushes = defaultdict(int)          # lý do flush -> số lần
+        self.batch_sizes = deque(maxlen=1000)    # (số bản ghi, số byte) của các batch gần nhất
+        self.linger_ms = deque(maxlen=1000)      # thời gian batch đợi trước khi flush
+        self.latencies_ms = deque(maxlen=1000)   # thời gian từ lúc nhận tới lúc batch xử lý xong
+
+    def _reset(self):
+        self.records = []
+        self.offsets = defaultdict(list)
+        self.size_bytes = 0
+        self.first_at = None
+
+    def add(self, tp, offset: int, records: list, size_bytes: int = 0) -> None:
+        if self.first_at is None:
+            self.first_at = time.time()
+        self.records.extend(records)
+        self.offsets[tp].append(offset)
+        self.size_bytes += size_bytes or 0
+
+    def flush_reason(self):
+        """
+        Lý do cần flush ("records", "bytes", "linger") hoặc None nếu batch chưa đạt giới hạn nào.
+        """
+        if not self.records:
+            return None
+        if len(self.records) >= self.max_records:
+            return "records"
+        if self.size_bytes >= self.max_bytes:
+            return "bytes"
+        if (time.time() - self.first_at) * 1000 >= self.max_linger_ms:
+            return "linger"
+        return None
+
+    def time_to_linger_ms(self):
+        """
+        Số ms còn lại trước khi batch hiện tại hết thời gian đợi (None nếu batch rỗng), dùng làm timeout cho poll().
+        """
+        if not self.records:
+            return None
+        return max(0, int(self.max_linger_ms - (time.time() - self.first_at) * 1000))
+
+    def drain(self, reason: str = "manual"):
+        """
+        Lấy batch hiện tại: trả về (records, offsets, thời điểm nhận bản ghi đầu tiên) và bắt đầu batch mới.
+        """
+        records, offsets, first_at = self.records, dict(self.offsets), self.first_at
+        self.flushes[reason] += 1
+        self.batch_sizes.append((len(records), self.size_bytes))
+        self.linger_ms.append((time.time() - first_at) * 1000)
+        self._reset()
+        return records, offsets, first_at
+
+    def record_latency(self, first_at: float) -> None:
+        self.latencies_ms.append((time.time() - first_at) * 1000)
+
+    @staticmethod
+    def _percentile(values, q):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+
+    def stats(self) -> dict:
+        sizes = [records for records, _ in self.batch_sizes]
+        return {
+            "topic": self.topic,
+            "flushes": dict(self.flushes),
+            "avg_batch_records": round(sum(sizes) / len(sizes), 1) if sizes else 0.0,
+            "avg_batch_bytes": round(sum(b for _, b in self.batch_sizes) / len(sizes)) if sizes else 0,
+            "linger_ms_p50": self._percentile(self.linger_ms, 0.5),
+            "linger_ms_p95": self._percentile(self.linger_ms, 0.95),
+            "latency_ms_p50": self._percentile(self.latencies_ms, 0.5),
+            "latency_ms_p95": self._percentile(self.latencies_ms, 0.95),
+        }
@@ -0,0 +1,81 @@
+import logging
+import threading
+from collections import defaultdict, deque
+
+from langchain_openai import ChatOpenAI
+
+DEFAULT_TIERS = [
+    {"name": "mini", "model": "model_4_1_mini", "temperature": 0.1},
+    {"name": "full", "model": "model_4_1", "temperature": 0.1},
+]
+
+
+class ModelTier:
+    def __init__(self, name: str, llm):
+        self.name = name
+        self.llm = llm
+        self.outcomes = defaultdict(int)         # success / empty / error -> số lần
+        self.latencies_ms = deque(maxlen=1000)   # thời gian sinh SQL + kiểm tra + chạy của các lần gần nhất
+
+
+class ModelCascade:
+    """
+    Thứ tự các model dùng để sinh SQL: model nhỏ, nhanh trước, chỉ chuyển lên model lớn hơn
+    khi SQL không hợp lệ, chạy lỗi hoặc không có kết quả.
+    Ghi nhận tỉ lệ thành công và độ trễ của từng tầng để điều chỉnh thứ tự trong config (sql_cascade).
+    """
+    def __init__(self, tiers: list, logger=None):
+        if not tiers:
+            raise ValueError("ModelCascade cần ít nhất 1 tầng model")
+        self.tiers = [ModelTier(name, llm) for name, llm in tiers]
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, llm_config: dict, tiers_config: list = None, logger=None):
+        tiers = [
+            (
+                tier["name"],
+                ChatOpenAI(
+                    model=llm_config[tier["model"]],
+                    openai_api_key=llm_config["openai_api_key"],
+                    temperature=tier.get("temperature", 0.1),
+                ),
+            )
+            for tier in tiers_config or DEFAULT_TIERS
+        ]
+        return cls(tiers, logger)
+
+    @property
+    def first(self):
+        return self.tiers[0].llm
+
+    @property
+    def last(self):
+        return self.tiers[-1].llm
+
+    def record(self, tier: ModelTier, outcome: str, latency_seconds: float) -> None:
+        with self._lock:
+            tier.outcomes[outcome] += 1
+            tier.latencies_ms.append(latency_seconds * 1000)
+
+    @staticmethod
+    def _percentile(values, q):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+
+    def stats(self) -> dict:
+        result = {}
+        with self._lock:
+            for tier in self.tiers:
+                attempts = sum(tier.outcomes.values())
+                result[tier.name] = {
+                    "attempts": attempts,
+                    "outcomes": dict(tier.outcomes),
+                    "success_rate": round(tier.outcomes["success"] / attempts, 4) if attempts else 0.0,
+                    "latency_ms_p50": self._percentile(tier.latencies_ms, 0.5),
+                    "latency_ms_p95": self._percentile(tier.latencies_ms, 0.95),
+                }
+        return result
@@ -0,0 +1,163 @@
+import io
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class PostgresPool:
+    """
+    Pool kết nối PostgreSQL dùng chung cho các sync handler (mục postgres trong config.yaml).
+    - Kiểm tra kết nối trước khi dùng (đã đóng / idle lâu thì chạy SELECT 1), kết nối hỏng được bỏ và tạo lại
+    - Mất kết nối khi đang chạy query: kết nối bị loại khỏi pool, lần gọi sau (vd. SyncPipeline thử lại bước) dùng kết nối mới
+    - Số kết nối đang dùng không vượt quá maxconn: thread khác đợi thay vì lỗi PoolError
+    """
+    def __init__(self, connection: dict, minconn: int = 1, maxconn: int = 8, health_check_interval: float = 30.0,
+                 max_retries: int = 3, retry_base_delay: float = 1.0, logger=None):
+        self.connection = connection
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.health_check_interval = health_check_interval
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._pool = None
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        # Tạo pool lúc dùng lần đầu: consumer vẫn khởi động được khi DB tạm thời không kết nối được
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(self.minconn, self.maxconn, **self.connection)
+            return self._pool
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.time() - self._last_used.get(id(conn), 0) < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        for attempt in range(self.max_retries + 1):
+            try:
+                pool = self._get_pool()
+                conn = pool.getconn()
+                if self._is_healthy(conn):
+                    return conn
+                self.logger.warning("⚠️ Kết nối PostgreSQL không còn hoạt động, tạo kết nối mới")
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+                if not conn.closed:
+                    return conn
+            except psycopg2.OperationalError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_base_delay * (2 ** attempt)
+                self.logger.warning(f"⚠️ Không kết nối được PostgreSQL: {e}. Thử lại sau {delay:.1f}s")
+                time.sleep(delay)
+        raise psycopg2.OperationalError("Không lấy được kết nối PostgreSQL")
+
+    @contextmanager
+    def connection(self):
+        """
+        Mượn 1 kết nối trong pool: commit khi thành công, rollback khi lỗi,
+        bỏ kết nối khỏi pool nếu lỗi do mất kết nối.
+        """
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._checkout()
+            try:
+                yield conn
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self._release(conn, broken=True)
+                conn = None
+                raise
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+        finally:
+            if conn is not None:
+                self._release(conn, broken=conn.closed)
+            self._slots.release()
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                yield cur
+
+    def _release(self, conn, broken: bool = False) -> None:
+        if broken:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.time()
+        try:
+            self._pool.putconn(conn, close=broken)
+        except Exception as e:
+            self.logger.warning(f"⚠️ Không trả được kết nối về pool: {e}")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+def _copy_text(value) -> str:
+    """
+    Giá trị theo định dạng text của COPY: NULL = \\N, escape \\, tab, xuống dòng.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_upsert(cur, table: str, columns: list, rows: list, conflict_columns: list, update_columns: list = None) -> None:
+    """
+    Ghi nhiều dòng bằng COPY vào bảng tạm rồi merge vào bảng chính bằng 1 câu INSERT ... ON CONFLICT.
+    Nhanh hơn nhiều so với execute_values khi batch lớn (lần nạp toàn bộ catalogue).
+    rows: list tuple theo thứ tự columns, các key trong conflict_columns không được trùng nhau trong rows.
+    """
+    if update_columns is None:
+        update_columns = [column for column in columns if column not in conflict_columns]
+    staging = f"sync_staging_{uuid.uuid4().hex[:8]}"
+    column_list = ", ".join(f'"{column}"' for column in columns)
+
+    # Bảng tạm chỉ có kiểu dữ liệu của các cột cần ghi, không kèm constraint của bảng chính
+    cur.execute(f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {column_list} FROM {table} WITH NO DATA")
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_text(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN", buffer)
+
+    updates = ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in update_columns)
+    conflict = ", ".join(f'"{column}"' for column in conflict_columns)
+    cur.execute(
+        f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging} "
+        f"ON CONFLICT ({conflict}) DO UPDATE SET {updates}"
+    )
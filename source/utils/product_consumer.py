@@ -1,13 +1,23 @@
+import argparse
 import json
-from kafka import KafkaConsumer
-import psycopg2
-from psycopg2.extras import execute_values, execute_batch
+import time
+from collections import defaultdict
+import os
+from kafka import KafkaConsumer, ConsumerRebalanceListener
+from kafka.structs import OffsetAndMetadata
+from psycopg2.extras import execute_values
 from configs.data_config import KafkaConfig
 from configs.logging_config import setup_logging
 from configs.config import load_config
 from source.models.elastic_indexing import Elastic_Indexing
 from source.models.vector_indexing import MilvusVectorStore
 from source.utils.convert_df_to_document import convert_df_to_document
+from source.utils.markdown_cache import MarkdownCache
+from source.utils.micro_batcher import MicroBatcher
+from source.utils.retry_queue import RetryQueue, RetryWorker
+from source.utils.pg_pool import PostgresPool, copy_upsert
+from source.utils.sync_pipeline import SyncPipeline, OffsetTracker
+from source.utils.sync_rows import product_row, product_values, service_row, service_values, row_hash, PRODUCT_JSON_COLUMNS, SERVICE_JSON_COLUMNS, PRODUCT_COLUMNS, SERVICE_COLUMNS
 from elasticsearch import Elasticsearch, helpers
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 import pandas as pd
@@ -18,7 +28,8 @@ config = load_config()
 logger = setup_logging("Elastic_Indexing")
 
 # Set up preprocessor
-preprocessor = convert_df_to_document()
+markdown_cache = MarkdownCache(**config["markdown_cache"]) if config.get("markdown_cache") else None
+preprocessor = convert_df_to_document(markdown_cache=markdown_cache)
 
 # SET UP elastic_handler
 llm = ChatOpenAI(
@@ -30,7 +41,9 @@ llm = ChatOpenAI(
 es_host = config['elasticsearch']['host']
 es = Elasticsearch(es_host)
 
-elastic_handler = Elastic_Indexing("saleforce_products", es, config["product_fields"], llm, recreate_index=False, logger=logger)
+elastic_handler = Elastic_Indexing(config["elasticsearch"]["product_index"], es, config["product_fields"], llm,
+                                   recreate_index=False, logger=logger, enrichment_config=config.get("enrichment"),
+                                   settle_seconds=config.get("sql_cache", {}).get("settle_seconds", 2))
 
 
 
@@ -50,6 +63,8 @@ product_milvus_handler = MilvusVectorStore(
     openai_key=config["llm"]["openai_api_key"],
     recreate_collection=False,
     logger=logger,
+    ingest_config=config.get("milvus_ingest"),
+    embedding_exclude_fields=config.get("milvus_ingest", {}).get("product_embedding_exclude_fields"),
 )
 
 service_milvus_handler = MilvusVectorStore(
@@ -60,8 +75,87 @@ service_milvus_handler = MilvusVectorStore(
     openai_key=config["llm"]["openai_api_key"],
     recreate_collection=False,
     logger=logger,
+    ingest_config=config.get("milvus_ingest"),
 )
-    
+
+# Pool kết nối PostgreSQL dùng chung cho ProductSyncHandler / ServiceSyncHandler
+postgres_config = config["postgres"]
+pg_pool = PostgresPool(postgres_config["connection"], logger=logger, **postgres_config.get("pool", {}))
+# Batch từ bulk_threshold dòng trở lên được ghi bằng COPY vào bảng tạm + INSERT ... ON CONFLICT
+bulk_threshold = postgres_config.get("bulk_threshold", 500)
+
+# Hàng đợi retry cho bản ghi lỗi enrichment / ES / Milvus (bỏ trống retry_queue.path để tắt)
+retry_config = config.get("retry_queue", {})
+retry_queue = None
+if retry_config.get("path"):
+    retry_queue = RetryQueue(
+        retry_config["path"],
+        max_attempts=retry_config.get("max_attempts", 8),
+        base_delay=retry_config.get("base_delay", 30),
+        max_delay=retry_config.get("max_delay", 3600),
+        lease_seconds=retry_config.get("lease_seconds", 600),
+    )
+
+
+def _track_failures(kind, key_field, state):
+    """
+    Sau khi ghi PostgreSQL: bỏ khỏi hàng đợi retry các key đã đồng bộ xong, đưa các key lỗi (enrichment / ES / Milvus)
+    vào hàng đợi. Khi batch đang được chạy lại từ hàng đợi (state["retry"]), RetryWorker tự cập nhật số lần thử.
+    Output: {key lỗi: mô tả lỗi}
+    """
+    failed = dict(state.get("failed", {}))
+    for key in state.get("enrich_failed", []):
+        failed.setdefault(str(key), "enrichment: trích xuất cột thất bại")
+    if retry_queue is None or state.get("retry"):
+        return failed
+
+    records = {str(record.get(key_field)): record for record in state["records"]}
+    retry_queue.discard(kind, [key for key in records if key not in failed])
+    for key, error in failed.items():
+        if key in records:
+            retry_queue.push(kind, {key: records[key]}, error)
+    if failed:
+        logger.warning(f"⚠️ Đưa {len(failed)} bản ghi {kind} lỗi vào hàng đợi retry")
+    return failed
+
+
+def _park_batch(kind, key_field, state, error):
+    """
+    on_failure của SyncPipeline: batch lỗi hết số lần thử được đưa vào hàng đợi retry để không chặn consumer.
+    Batch chạy lại từ hàng đợi thì không đưa lại, RetryWorker tự cập nhật số lần thử.
+    """
+    if retry_queue is None or state.get("retry"):
+        return False
+    records = state.get("records") or state["batch"]
+    retry_queue.push(kind, {record.get(key_field): record for record in records if record.get(key_field)}, error)
+    return True
+
+
+def _drop_stale_retries(kind, key_field, records):
+    """
+    Bỏ các bản ghi retry đã cũ: key đã được đồng bộ thành công (không còn trong hàng đợi) hoặc đã có payload
+    mới hơn từ Kafka trong lúc chờ, để payload cũ không ghi đè dữ liệu mới trên ES / Milvus / PostgreSQL.
+    """
+    queued = retry_queue.payloads(kind, [str(record.get(key_field)) for record in records])
+    fresh = [record for record in records if queued.get(str(record.get(key_field))) == record]
+    if len(fresh) < len(records):
+        logger.info(f"⚠️ Bỏ {len(records) - len(fresh)} bản ghi {kind} retry đã cũ (đã có dữ liệu mới hơn)")
+    return fresh
+
+
+def _retry_through_pipeline(pipeline, key_field, records):
+    """
+    Handler của RetryWorker: chạy lại các bản ghi từ hàng đợi retry qua SyncPipeline, nên batch retry
+    đợi / chặn các batch Kafka có cùng SKU / id như mọi batch khác. Output: list key vẫn lỗi.
+    """
+    keys = {str(record.get(key_field)) for record in records}
+    batch = pipeline.submit(records, {}, keys, state={"force": True, "retry": True})
+    batch.finished.wait()
+    if batch.error:
+        return list(keys)
+    return list(batch.state.get("failures", {}))
+
+
 class KafkaConfig:
     BROKER = "10.221.194.133:9092"
     # Thêm topic mới "vcc-sync-menu" cùng với "vcc-sync-product"
@@ -74,104 +168,148 @@ class ProductSyncHandler:
         self.preprocess = preprocessor
         self.milvus_handler = product_milvus_handler
         self.elastic_handler = elastic_handler
-        self.conn = psycopg2.connect(
-            host="10.248.243.162",
-            port=5432,
-            user="ai_chatbot_admin",
-            password="Vcc#2024#",
-            dbname="ai_services"
-        )
-        self.conn.autocommit = True
-
-    def sku_exists(self, sku):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM m2_datasets.data_products WHERE sku = %s LIMIT 1", (sku,))
-            return cur.fetchone() is not None
-
-    def is_changed(self, sku, new_data):
-        """So sánh dữ liệu mới với DB hiện tại"""
-        query = "SELECT * FROM m2_datasets.data_products WHERE sku = %s"
-        with self.conn.cursor() as cur:
-            cur.execute(query, (sku,))
-            row = cur.fetchone()
-            if not row:
-                return False
+        self.retry_queue = retry_queue
+        self.pool = pg_pool
 
-            colnames = [desc[0] for desc in cur.description]
-            db_data = dict(zip(colnames, row))
-
-            # Các trường cần so sánh
-            fields_to_compare = [
-            "id", "name", "price", "thumbnail", "images", "weight", 
-            "short_description", "description", "salient_features",  "attributes"
-            ]
-            for field in fields_to_compare:
-                if str(db_data.get(field)) != str(new_data.get(field)):
-                    return True
-            return False
-
-    def delete_by_sku(self, sku):
-        with self.conn.cursor() as cur:
-            cur.execute("DELETE FROM m2_datasets.data_products WHERE sku = %s", (sku,))
-        
-        self.elastic_handler.delete_by_sku(sku)
-        self.milvus_handler.delete_by_id(sku)
-
-    def insert_product_batch(self, batch_data):
-        if not batch_data:
-            return
+    def _row_changed(self, db_data, new_data):
+        """
+        So sánh content_hash đã lưu với hash của payload mới. Dòng chưa có hash (chưa backfill) coi như thay đổi.
+        """
+        stored_hash = db_data.get("content_hash")
+        return stored_hash is None or stored_hash != row_hash(product_row(new_data), PRODUCT_JSON_COLUMNS)
 
-        new_records = []
-        update_records = []
+    def fetch_existing(self, skus):
+        """
+        Lấy content_hash của nhiều SKU trong 1 query. Output: {sku: {"sku": ..., "content_hash": ...}}
+        """
+        if not skus:
+            return {}
+        query = "SELECT sku, content_hash FROM m2_datasets.data_products WHERE sku = ANY(%s)"
+        with self.pool.cursor() as cur:
+            cur.execute(query, (list(skus),))
+            colnames = [desc[0] for desc in cur.description]
+            return {row[0]: dict(zip(colnames, row)) for row in cur.fetchall()}
 
+    def classify_batch(self, batch_data):
+        """
+        Phân loại batch thành (mới, thay đổi, không đổi) với 1 query duy nhất tới Postgres.
+        SKU xuất hiện nhiều lần trong batch chỉ giữ bản ghi cuối cùng.
+        """
+        latest = {}
         for data in batch_data:
             sku = data.get("sku")
-            if not sku:
-                continue
+            if sku:
+                latest[sku] = data
 
-            if not self.sku_exists(sku):
+        existing = self.fetch_existing(list(latest))
+        new_records, update_records, unchanged_records = [], [], []
+        for sku, data in latest.items():
+            if sku not in existing:
                 new_records.append(data)
-            elif self.is_changed(sku, data):
-                self.delete_by_sku(sku)
+            elif self._row_changed(existing[sku], data):
                 update_records.append(data)
-
-        merged_data = new_records + update_records
-
-        if not merged_data:
+            else:
+                unchanged_records.append(data)
+        return new_records, update_records, unchanged_records
+
+    # Các stage xử lý 1 batch, dùng cho cả insert_product_batch (chạy tuần tự) và SyncPipeline (chạy song song)
+    def diff_stage(self, state):
+        if state.get("retry"):
+            state["batch"] = _drop_stale_retries("product", "sku", state["batch"])
+        new_records, update_records, unchanged_records = self.classify_batch(state["batch"])
+        state["records"] = new_records + update_records
+        if state.get("force"):
+            # Chạy lại từ hàng đợi retry: xử lý cả bản ghi có hash không đổi (vd. đã ghi nhưng lỗi enrichment)
+            state["records"] += unchanged_records
+        state["failed"] = {}
+
+        if not state["records"]:
             logger.info("⚠️ Không có dữ liệu mới hoặc cập nhật để insert.")
-            return
-
-        logger.info(f"✅ Số lượng dữ liệu mới: {len(new_records)}, cập nhật: {len(update_records)}")
-
-        # PostgreSQL insert
-        self._insert_to_postgres(merged_data)
-
-        # Preprocessing
-        df = pd.DataFrame(merged_data)
+        else:
+            logger.info(f"✅ Số lượng dữ liệu mới: {len(new_records)}, cập nhật: {len(update_records)}")
+        return state
+
+    def preprocess_stage(self, state):
+        if not state["records"]:
+            return state
+        df = pd.DataFrame(state["records"])
         product_documents = self.preprocess.convert(df, 
                                         html_columns=["description", "salient_features", "short_description"], 
                                         json_columns=["attributes"], 
                                         list_columns=['images', 'category_id'],
-                                        drop_columns=['services'])
-        
-        # Elasticsearch add document
-        product_documents = [json.loads(doc) if isinstance(doc, str) else doc for doc in product_documents] # list[dict]
-        extra_col_product_documents = self.elastic_handler.create_extra_column_json(product_documents)
-        self.elastic_handler.add_documents(extra_col_product_documents)
-        
-        
-        # Milvus add document
-        product_documents = [json.dumps(item, ensure_ascii=False) for item in product_documents]        # list[str]
-        product_documents = [Document(page_content=text) for text in product_documents]
-        self.milvus_handler.add_documents(product_documents)
-
-        
+                                        drop_columns=['services'],
+                                        as_dict=True)
+        state["documents"] = product_documents # list[dict]
+        return state
+
+    def enrich_stage(self, state):
+        if not state["records"]:
+            return state
+        # Sản phẩm lỗi enrichment vẫn được index (chưa có cột mới) và được đưa vào hàng đợi retry sau bước persist
+        state["enriched"], failed = self.elastic_handler.create_extra_column_json(state["documents"], return_failed=True)
+        state["enrich_failed"] = [state["documents"][i].get("sku") for i in failed]
+        return state
+
+    def elastic_stage(self, state):
+        if not state["records"]:
+            return state
+        failed_items = self.elastic_handler.upsert_documents(state["enriched"])
+        for err in failed_items:
+            state["failed"][str(err["index"].get("_id"))] = f"elasticsearch: {err['index'].get('error')}"
+        return state
+
+    def milvus_stage(self, state):
+        if not state["records"]:
+            return state
+        product_documents = [
+            Document(page_content=json.dumps(item, ensure_ascii=False), metadata={"pk": item.get("sku", "")})
+            for item in state["documents"]
+        ]
+        result = self.milvus_handler.upsert_documents(product_documents)
+        for pk in result["failed"]:
+            state["failed"].setdefault(str(pk), "milvus: ghi thất bại")
+        return state
+
+    def persist_stage(self, state):
+        """
+        Ghi PostgreSQL (kèm content_hash) sau cùng: nếu ES / Milvus lỗi, lần xử lý lại vẫn thấy bản ghi là "thay đổi".
+        SKU lỗi ES / Milvus không được ghi, được đưa vào hàng đợi retry.
+        """
+        if not state["records"]:
+            return state
+        records = [record for record in state["records"] if str(record.get("sku")) not in state["failed"]]
+        if records:
+            self._insert_to_postgres(records)
+        state["failures"] = _track_failures("product", "sku", state)
+        return state
+
+    def stages(self):
+        return [
+            ("diff", self.diff_stage),
+            ("preprocess", self.preprocess_stage),
+            ("enrich", self.enrich_stage),
+            ("elastic", self.elastic_stage),
+            ("milvus", self.milvus_stage),
+            ("persist", self.persist_stage),
+        ]
+
+    def insert_product_batch(self, batch_data):
+        if not batch_data:
+            return
+
+        # ES / Milvus upsert theo SKU, PostgreSQL ON CONFLICT DO UPDATE → không cần xóa trước khi cập nhật
+        state = {"batch": batch_data}
+        for _, stage in self.stages():
+            state = stage(state)
+
+    def park_batch(self, state, error):
+        return _park_batch("product", "sku", state, error)
 
     def _insert_to_postgres(self, batch_data):
         query = """
         INSERT INTO m2_datasets.data_products (
             "id", "name", "sku", "price", "thumbnail", "images", "category_id", "weight", 
-            "short_description", "description", "salient_features", "services", "attributes"
+            "short_description", "description", "salient_features", "services", "attributes", "content_hash"
         ) VALUES %s
         ON CONFLICT ("sku") DO UPDATE SET 
             "name" = EXCLUDED."name",
@@ -184,30 +322,19 @@ class ProductSyncHandler:
             "description" = EXCLUDED."description",
             "salient_features" = EXCLUDED."salient_features",
             "services" = EXCLUDED."services",
-            "attributes" = EXCLUDED."attributes";
+            "attributes" = EXCLUDED."attributes",
+            "content_hash" = EXCLUDED."content_hash";
         """
 
-        values = [
-            (
-                data.get("id"),
-                data.get("name"),
-                data.get("sku"),
-                data.get("price"),
-                data.get("thumbnail"),
-                json.dumps(data.get("images", [])),
-                json.dumps(data.get("categoryId", [])),
-                data.get("weight"),
-                data.get("shortDescription"),
-                data.get("description"),
-                data.get("salientFeatures"),
-                json.dumps(data.get("services", [])),
-                json.dumps(data.get("attributes", []))
-            )
-            for data in batch_data
-        ]
+        values = [product_values(product_row(data)) for data in batch_data]
 
-        with self.conn.cursor() as cur:
-            execute_values(cur, query, values)
+        with self.pool.cursor() as cur:
+            if len(values) >= bulk_threshold:
+                copy_upsert(cur, "m2_datasets.data_products", PRODUCT_COLUMNS + ["content_hash"], values,
+                            conflict_columns=["sku"],
+                            update_columns=[c for c in PRODUCT_COLUMNS + ["content_hash"] if c not in ("id", "sku")])
+            else:
+                execute_values(cur, query, values)
 
 
 
@@ -215,86 +342,113 @@ class ServiceSyncHandler:
     def __init__(self):
         self.preprocess = preprocessor
         self.milvus_handler = service_milvus_handler
-        self.conn = psycopg2.connect(
-            host="10.248.243.162",
-            port=5432,
-            user="ai_chatbot_admin",
-            password="Vcc#2024#",
-            dbname="ai_services"
-        )
-        self.conn.autocommit = True
-
-    def id_exists(self, id):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM m2_datasets.data_services WHERE id = %s LIMIT 1", (id,))
-            return cur.fetchone() is not None
-
-    def is_changed(self, id, new_data):
-        query = "SELECT * FROM m2_datasets.data_services WHERE id = %s"
-        with self.conn.cursor() as cur:
-            cur.execute(query, (id,))
-            row = cur.fetchone()
-            if not row:
-                return False
-
-            colnames = [desc[0] for desc in cur.description]
-            db_data = dict(zip(colnames, row))
-
-            # Chỉ so sánh các trường liên quan
-            fields = [
-                "id", "created_at", "updated_at", "code", "description", "menu_code", "name", "order",
-                "price", "type", "status", "unit", "value_type", "vat"
-            ]
-            for field in fields:
-                if str(db_data.get(field)) != str(new_data.get(field)):
-                    return True
-            return False
-
-    def delete_by_id(self, id):
-        with self.conn.cursor() as cur:
-            cur.execute("DELETE FROM m2_datasets.data_services WHERE id = %s", (id,))
-        self.milvus_handler.delete_by_id(id)
+        self.retry_queue = retry_queue
+        self.pool = pg_pool
 
-    def insert_service_batch(self, batch_data):
-        if not batch_data:
-            return
+    def _row_changed(self, db_data, new_data):
+        stored_hash = db_data.get("content_hash")
+        return stored_hash is None or stored_hash != row_hash(service_row(new_data), SERVICE_JSON_COLUMNS)
 
-        new_records = []
-        update_records = []
+    def fetch_existing(self, ids):
+        """
+        Lấy content_hash của nhiều service trong 1 query. Output: {str(id): {"id": ..., "content_hash": ...}}
+        """
+        if not ids:
+            return {}
+        query = "SELECT id, content_hash FROM m2_datasets.data_services WHERE id = ANY(%s)"
+        with self.pool.cursor() as cur:
+            cur.execute(query, (list(ids),))
+            colnames = [desc[0] for desc in cur.description]
+            return {str(row[0]): dict(zip(colnames, row)) for row in cur.fetchall()}
 
+    def classify_batch(self, batch_data):
+        """
+        Phân loại batch thành (mới, thay đổi, không đổi) với 1 query duy nhất tới Postgres.
+        """
+        latest = {}
         for data in batch_data:
             id = data.get("id")
-            if not id:
-                continue
+            if id:
+                latest[str(id)] = data
 
-            if not self.id_exists(id):
+        existing = self.fetch_existing([data["id"] for data in latest.values()])
+        new_records, update_records, unchanged_records = [], [], []
+        for id, data in latest.items():
+            if id not in existing:
                 new_records.append(data)
-            elif self.is_changed(id, data):
-                self.delete_by_id(id)
+            elif self._row_changed(existing[id], data):
                 update_records.append(data)
-
-        merged_data = new_records + update_records
-
-        if not merged_data:
+            else:
+                unchanged_records.append(data)
+        return new_records, update_records, unchanged_records
+
+    def diff_stage(self, state):
+        if state.get("retry"):
+            state["batch"] = _drop_stale_retries("service", "id", state["batch"])
+        new_records, update_records, unchanged_records = self.classify_batch(state["batch"])
+        state["records"] = new_records + update_records
+        if state.get("force"):
+            state["records"] += unchanged_records
+        state["failed"] = {}
+
+        if not state["records"]:
             logger.info("⚠️ Không có dữ liệu mới hoặc cập nhật để insert.")
-            return
-
-        logger.info(f"✅ Số lượng dịch vụ mới: {len(new_records)}, cập nhật: {len(update_records)}")
+        else:
+            logger.info(f"✅ Số lượng dịch vụ mới: {len(new_records)}, cập nhật: {len(update_records)}")
+        return state
+
+    def preprocess_stage(self, state):
+        if not state["records"]:
+            return state
+        df = pd.DataFrame(state["records"])
+        state["documents"] = self.preprocess.convert(df, drop_columns=[], as_dict=True)
+        return state
+
+    def milvus_stage(self, state):
+        if not state["records"]:
+            return state
+        service_docs = [
+            Document(page_content=json.dumps(item, ensure_ascii=False), metadata={"pk": item.get("id", "")})
+            for item in state["documents"]
+        ]
+        result = self.milvus_handler.upsert_documents(service_docs)
+        for pk in result["failed"]:
+            state["failed"].setdefault(str(pk), "milvus: ghi thất bại")
+        return state
+
+    def persist_stage(self, state):
+        if not state["records"]:
+            return state
+        records = [record for record in state["records"] if str(record.get("id")) not in state["failed"]]
+        if records:
+            self._insert_to_postgres(records)
+        state["failures"] = _track_failures("service", "id", state)
+        return state
+
+    def stages(self):
+        return [
+            ("diff", self.diff_stage),
+            ("preprocess", self.preprocess_stage),
+            ("milvus", self.milvus_stage),
+            ("persist", self.persist_stage),
+        ]
 
-        self._insert_to_postgres(merged_data)
+    def insert_service_batch(self, batch_data):
+        if not batch_data:
+            return
 
-        df = pd.DataFrame(merged_data)
-        service_docs = self.preprocess.convert(df, drop_columns=[])
+        state = {"batch": batch_data}
+        for _, stage in self.stages():
+            state = stage(state)
 
-        service_docs = [json.dumps(item, ensure_ascii=False) for item in service_docs]
-        service_docs = [Document(page_content=doc) for doc in service_docs]
-        self.milvus_handler.add_documents(service_docs)
+    def park_batch(self, state, error):
+        return _park_batch("service", "id", state, error)
 
     def _insert_to_postgres(self, batch_data):
         query = """
         INSERT INTO m2_datasets.data_services (
             id, created_at, updated_at, code, description, menu_code, name, "order",
-            price, type, status, unit, value_type, vat
+            price, type, status, unit, value_type, vat, content_hash
         ) VALUES %s
         ON CONFLICT (id) DO UPDATE SET
             created_at = EXCLUDED.created_at,
@@ -309,112 +463,283 @@ class ServiceSyncHandler:
             status = EXCLUDED.status,
             unit = EXCLUDED.unit,
             value_type = EXCLUDED.value_type,
-            vat = EXCLUDED.vat
+            vat = EXCLUDED.vat,
+            content_hash = EXCLUDED.content_hash
         """
 
-        values = [
-            (
-                data.get("id"),
-                datetime.fromisoformat(data.get("created_at")) if data.get("created_at") else None,
-                datetime.fromisoformat(data.get("updated_at")) if data.get("updated_at") else None,
-                data.get("code"),
-                data.get("description"),
-                data.get("menu_code"),
-                data.get("name"),
-                data.get("order"),
-                data.get("price"),
-                data.get("type"),
-                data.get("status"),
-                data.get("unit"),
-                data.get("value_type"),
-                data.get("vat")
-            )
-            for data in batch_data
-        ]
+        values = [service_values(service_row(data)) for data in batch_data]
+
+        with self.pool.cursor() as cur:
+            if len(values) >= bulk_threshold:
+                copy_upsert(cur, "m2_datasets.data_services", SERVICE_COLUMNS + ["content_hash"], values,
+                            conflict_columns=["id"])
+            else:
+                execute_values(cur, query, values)
+
+
+
+
+
 
-        with self.conn.cursor() as cur:
-            execute_values(cur, query, values)
+def _offset_and_metadata(offset):
+    # kafka-python >= 2.1 thêm trường leader_epoch vào OffsetAndMetadata
+    try:
+        return OffsetAndMetadata(offset, None, -1)
+    except TypeError:
+        return OffsetAndMetadata(offset, None)
 
 
+def _parse_message(topic, data):
+    """
+    Lấy list bản ghi từ 1 message Kafka, trả về None nếu message rỗng / không hợp lệ.
+    """
+    if not data:
+        logger.info(f"⚠️ [{topic}] Message rỗng, bỏ qua...")
+        return None
+
+    # Parse dữ liệu
+    if isinstance(data, dict):
+        raw_data = data.get("data", data)
+    elif isinstance(data, list):
+        raw_data = data
+    else:
+        logger.info(f"[{topic}] Dữ liệu không hợp lệ, bỏ qua...")
+        return None
+
+    if isinstance(raw_data, str):
+        try:
+            raw_data = json.loads(raw_data)
+        except json.JSONDecodeError:
+            logger.warning(f"⚠️ [{topic}] Dữ liệu không hợp lệ JSON, bỏ qua...")
+            return None
+
+    return raw_data if isinstance(raw_data, list) else [raw_data]
+
+
+class _RebalanceListener(ConsumerRebalanceListener):
+    """
+    Khi bị thu hồi partition: xử lý nốt các batch đang gom / đang chạy và commit offset trước khi
+    consumer khác trong group nhận partition, tránh xử lý trùng.
+    """
+    def __init__(self, on_revoked, on_assigned):
+        self._on_revoked = on_revoked
+        self._on_assigned = on_assigned
 
+    def on_partitions_revoked(self, revoked):
+        self._on_revoked(revoked)
 
+    def on_partitions_assigned(self, assigned):
+        self._on_assigned(assigned)
 
 
-def process_kafka_messages():
+def process_kafka_messages(stop_event=None, report_status=None, worker_id=None):
     """
-    Lắng nghe Kafka topics và xử lý từng loại dữ liệu:
-    - Product → ProductSyncHandler
-    - Service → ServiceSyncHandler
+    Lắng nghe Kafka topics và xử lý từng loại dữ liệu qua SyncPipeline:
+    - Product → ProductSyncHandler (diff → preprocess → enrich → ES → Milvus → PostgreSQL)
+    - Service → ServiceSyncHandler (diff → preprocess → Milvus → PostgreSQL)
+    Mỗi topic có 1 MicroBatcher (max_records / max_bytes / max_linger_ms),
+    offset chỉ được commit khi batch chứa message đã qua hết các bước.
+
+    stop_event: Event để dừng vòng lặp (dùng khi chạy nhiều worker qua sync_supervisor)
+    report_status: hàm nhận dict trạng thái (partition, lag, số batch đang xử lý) sau mỗi stats_interval_seconds
     """
+    pipeline_config = config.get("sync_pipeline", {})
     consumer = KafkaConsumer(
-        *KafkaConfig.TOPIC_ALL,  # bao gồm cả "vcc-sync-product", "vcc-sync-service"
         bootstrap_servers=[KafkaConfig.BROKER],
         group_id=KafkaConfig.KAFKA_GROUP,
+        client_id=f"{KafkaConfig.KAFKA_GROUP}-{worker_id if worker_id is not None else os.getpid()}",
         value_deserializer=lambda x: json.loads(x.decode("utf-8")),
         auto_offset_reset="earliest",
-        enable_auto_commit=True,
+        enable_auto_commit=False,
     )
 
     product_handler = ProductSyncHandler()
     service_handler = ServiceSyncHandler()
 
-    batch_products = []
-    batch_services = []
-
-    batch_size = 10  # tùy chỉnh
+    pipelines = {
+        "vcc-sync-product": SyncPipeline("product", product_handler.stages(), pipeline_config, logger,
+                                         on_failure=product_handler.park_batch),
+        "b2c_sync_service_topic": SyncPipeline("service", service_handler.stages(), pipeline_config, logger,
+                                               on_failure=service_handler.park_batch),
+    }
+    retry_worker = None
+    if retry_queue is not None:
+        product_pipeline, service_pipeline = pipelines["vcc-sync-product"], pipelines["b2c_sync_service_topic"]
+        retry_worker = RetryWorker(
+            retry_queue,
+            {
+                "product": lambda records: _retry_through_pipeline(product_pipeline, "sku", records),
+                "service": lambda records: _retry_through_pipeline(service_pipeline, "id", records),
+            },
+            poll_interval=retry_config.get("poll_interval", 10),
+            batch_size=retry_config.get("batch_size", 50),
+            logger=logger,
+        ).start()
+    key_fields = {"vcc-sync-product": "sku", "b2c_sync_service_topic": "id"}
+    batching_config = pipeline_config.get("batching", {})
+    batchers = {
+        topic: MicroBatcher(topic, **{**batching_config.get("default", {}), **batching_config.get(topic, {})})
+        for topic in pipelines
+    }
+    tracker = OffsetTracker()
+
+    poll_timeout_ms = pipeline_config.get("poll_timeout_ms", 1000)
+    stats_interval = pipeline_config.get("stats_interval_seconds", 60)
+    rebalance_timeout = pipeline_config.get("rebalance_timeout", 120)
+    last_stats = time.time()
+    paused = False
+    failed_partitions = set()   # partition có batch lỗi hết số lần thử: dừng nhận message tới khi khởi động lại
+
+    def flush(topic, reason):
+        batcher = batchers[topic]
+        if not batcher.records:
+            return
+        records, offsets, received_at = batcher.drain(reason)
+        keys = {str(record.get(key_fields[topic])) for record in records}
+        pipelines[topic].submit(records, offsets, keys, received_at)
+
+    def collect_and_commit():
+        for topic, pipeline in pipelines.items():
+            for done in pipeline.drain_completed():
+                batchers[topic].record_latency(done.received_at)
+                if done.error:
+                    # Giữ offset chưa commit để batch được xử lý lại khi consumer khởi động lại
+                    # (batch retry không có offset, RetryWorker tự cập nhật hàng đợi)
+                    if not done.offsets:
+                        continue
+                    # Offset của batch còn pending nên partition không commit tiếp được:
+                    # tạm dừng hẳn partition thay vì tiếp tục nhận message mà không commit
+                    failed = set(done.offsets) & consumer.assignment()
+                    failed_partitions.update(failed)
+                    if failed:
+                        consumer.pause(*failed)
+                    logger.error(
+                        f"❌ [{pipeline.name}] Batch {done.batch_id} thất bại: {done.error}. Dừng nhận message và commit "
+                        f"offset của partition {sorted(f'{tp.topic}-{tp.partition}' for tp in failed)} tới khi khởi động "
+                        f"lại consumer, batch sẽ được xử lý lại từ offset đã commit"
+                    )
+                    continue
+                tracker.done(done.offsets)
+        offsets = tracker.committable()
+        if offsets:
+            consumer.commit({tp: _offset_and_metadata(offset) for tp, offset in offsets.items()})
+            tracker.mark_committed(offsets)
+
+    def on_revoked(revoked):
+        logger.info(f"🔀 Rebalance: bị thu hồi {len(revoked)} partition, xử lý nốt các batch đang chạy ...")
+        for topic in pipelines:
+            flush(topic, "rebalance")
+        for pipeline in pipelines.values():
+            pipeline.wait_idle(timeout=rebalance_timeout)
+        collect_and_commit()
+        tracker.forget(revoked)
+        # Consumer mới nhận partition sẽ đọc lại từ offset đã commit (trước batch lỗi)
+        failed_partitions.difference_update(revoked)
+
+    def on_assigned(assigned):
+        logger.info(f"🔀 Rebalance: được giao {len(assigned)} partition: {sorted(f'{tp.topic}-{tp.partition}' for tp in assigned)}")
+
+    def status():
+        lag = {}
+        for tp in consumer.assignment():
+            highwater = consumer.highwater(tp)
+            if highwater is not None:
+                lag[f"{tp.topic}-{tp.partition}"] = max(0, highwater - consumer.position(tp))
+        return {
+            "worker_id": worker_id,
+            "pid": os.getpid(),
+            "time": time.time(),
+            "partitions": len(lag),
+            "lag": lag,
+            "total_lag": sum(lag.values()),
+            "paused": paused,
+            "failed_partitions": sorted(f"{tp.topic}-{tp.partition}" for tp in failed_partitions),
+            "pending_batches": {pipeline.name: pipeline.pending() for pipeline in pipelines.values()},
+        }
+
+    consumer.subscribe(KafkaConfig.TOPIC_ALL,  # bao gồm cả "vcc-sync-product", "vcc-sync-service"
+                       listener=_RebalanceListener(on_revoked, on_assigned))
 
     try:
         logger.info("🔄 Bắt đầu lắng nghe Kafka messages ...")
-        for message in consumer:
-            topic = message.topic
-            data = message.value
-
-            logger.info(f"📩 Nhận message từ topic [{topic}]: {data}")
-
-            if not data:
-                logger.info(f"⚠️ [{topic}] Message rỗng, bỏ qua...")
-                continue
-
-            # Parse dữ liệu
-            if isinstance(data, dict):
-                raw_data = data.get("data", data)
-            elif isinstance(data, list):
-                raw_data = data
-            else:
-                logger.info(f"[{topic}] Dữ liệu không hợp lệ, bỏ qua...")
-                continue
-
-            if isinstance(raw_data, str):
-                try:
-                    raw_data = json.loads(raw_data)
-                except json.JSONDecodeError:
-                    logger.warning(f"⚠️ [{topic}] Dữ liệu không hợp lệ JSON, bỏ qua...")
-                    continue
-
-            data_list = raw_data if isinstance(raw_data, list) else [raw_data]
-
-            # Phân loại xử lý theo topic
-            if topic == "vcc-sync-product":
-                batch_products.extend(data_list)
-                if len(batch_products) >= batch_size:
-                    product_handler.insert_product_batch(batch_products)
-                    batch_products = []
-
-            elif topic == "b2c_sync_service_topic":
-                batch_services.extend(data_list)
-                if len(batch_services) >= batch_size:
-                    service_handler.insert_service_batch(batch_services)
-                    batch_services = []
+        while stop_event is None or not stop_event.is_set():
+            collect_and_commit()
+
+            # Áp lực ngược: pipeline đầy thì tạm dừng nhận message nhưng vẫn poll để giữ kết nối với group
+            full = any(pipeline.is_full() for pipeline in pipelines.values())
+            if full:
+                # pause lại mỗi vòng để cả partition mới được giao sau rebalance cũng bị tạm dừng
+                consumer.pause(*consumer.assignment())
+                if not paused:
+                    logger.info("⏸️ Pipeline đầy, tạm dừng nhận message")
+                paused = True
+            elif paused:
+                consumer.resume(*(consumer.paused() - failed_partitions))
+                paused = False
+                logger.info("▶️ Tiếp tục nhận message")
+
+            # Không đợi poll() lâu hơn thời gian linger còn lại của batch đang gom
+            lingers = [ms for ms in (b.time_to_linger_ms() for b in batchers.values()) if ms is not None]
+            records = consumer.poll(timeout_ms=min([poll_timeout_ms] + lingers))
+
+            for tp, messages in records.items():
+                for message in messages:
+                    topic = message.topic
+                    tracker.add(tp, message.offset)
+                    logger.info(f"📩 Nhận message từ topic [{topic}]: {message.value}")
+
+                    data_list = _parse_message(topic, message.value)
+                    if data_list is None or topic not in pipelines:
+                        tracker.done({tp: [message.offset]})
+                        continue
+
+                    batchers[topic].add(tp, message.offset, data_list, message.serialized_value_size)
+                    reason = batchers[topic].flush_reason()
+                    if reason:
+                        flush(topic, reason)
+
+            for topic, batcher in batchers.items():
+                reason = batcher.flush_reason()
+                if reason:
+                    flush(topic, reason)
+
+            if time.time() - last_stats >= stats_interval:
+                for topic, pipeline in pipelines.items():
+                    logger.info(f"📊 [{pipeline.name}] {pipeline.stats()} | batching: {batchers[topic].stats()}")
+                if retry_queue is not None:
+                    logger.info(f"📊 Hàng đợi retry: {retry_queue.stats()}")
+                if markdown_cache is not None:
+                    logger.info(f"📊 Markdown cache: {markdown_cache.stats()}")
+                if failed_partitions:
+                    logger.error(
+                        f"❌ Partition đang dừng do batch lỗi: "
+                        f"{sorted(f'{tp.topic}-{tp.partition}' for tp in failed_partitions)}, cần khởi động lại consumer"
+                    )
+                if report_status:
+                    report_status(status())
+                last_stats = time.time()
 
     except KeyboardInterrupt:
         logger.info("🛑 Dừng listener Kafka...")
     finally:
-        # Flush dữ liệu còn lại
-        if batch_products:
-            product_handler.insert_product_batch(batch_products)
-        if batch_services:
-            service_handler.insert_service_batch(batch_services)
+        # Flush dữ liệu còn lại và đợi pipeline xử lý xong trước khi commit lần cuối
+        # Dừng retry worker trước: batch retry đang chạy cần pipeline để chạy xong
+        if retry_worker is not None:
+            retry_worker.stop()
+        for topic in pipelines:
+            flush(topic, "shutdown")
+        for pipeline in pipelines.values():
+            pipeline.close(timeout=pipeline_config.get("shutdown_timeout", 300))
+        collect_and_commit()
         consumer.close()
 
 if __name__ == "__main__":
-    process_kafka_messages()
+    parser = argparse.ArgumentParser(description="Đồng bộ sản phẩm / dịch vụ từ Kafka")
+    parser.add_argument("--reembed", action="store_true",
+                        help="embedding lại các document Milvus có text embedding đã đổi rồi thoát")
+    args = parser.parse_args()
+    if args.reembed:
+        product_milvus_handler.reembed_outdated()
+        service_milvus_handler.reembed_outdated()
+    else:
+        process_kafka_messages()
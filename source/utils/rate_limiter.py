@@ -0,0 +1,53 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+
+class AsyncRateLimiter:
+    """
+    Giới hạn số request và số token gửi tới LLM trong cửa sổ trượt 60 giây (RPM / TPM).
+    - requests_per_minute / tokens_per_minute: None = không giới hạn
+    - Trạng thái cửa sổ được giữ giữa các lần asyncio.run, nên dùng chung được cho nhiều batch
+    """
+    def __init__(self, requests_per_minute: int = None, tokens_per_minute: int = None, window_seconds: float = 60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window_seconds = window_seconds
+        self._events = deque()  # (thời điểm, số token)
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self._events and now - self._events[0][0] >= self.window_seconds:
+            _, tokens = self._events.popleft()
+            self._tokens_in_window -= tokens
+
+    def _try_acquire(self, tokens: int) -> float:
+        """
+        Ghi nhận request nếu còn hạn mức, trả về 0. Nếu không, trả về số giây cần chờ.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+
+            over_requests = self.requests_per_minute is not None and len(self._events) >= self.requests_per_minute
+            # Cho phép 1 request lớn hơn hạn mức TPM khi cửa sổ đang trống, tránh chờ vô hạn
+            over_tokens = (
+                self.tokens_per_minute is not None
+                and self._events
+                and self._tokens_in_window + tokens > self.tokens_per_minute
+            )
+            if not over_requests and not over_tokens:
+                self._events.append((now, tokens))
+                self._tokens_in_window += tokens
+                return 0.0
+
+            return max(self.window_seconds - (now - self._events[0][0]), 0.01)
+
+    async def acquire(self, tokens: int = 0) -> None:
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
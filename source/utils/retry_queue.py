@@ -0,0 +1,319 @@
+"""
+Hàng đợi retry bền vững (SQLite) cho các bản ghi đồng bộ bị lỗi (enrichment, Elasticsearch, Milvus).
+- retry_items: bản ghi đang chờ thử lại, mỗi (kind, key) chỉ giữ payload mới nhất
+- dead_letters: bản ghi đã thử quá max_attempts lần
+
+CLI:
+    python -m source.utils.retry_queue stats
+    python -m source.utils.retry_queue list [--dead] [--kind product] [--limit 50]
+    python -m source.utils.retry_queue replay --dead [--kind product] [--key SKU ...]
+    python -m source.utils.retry_queue purge --dead [--kind product] [--key SKU ...]
+"""
+import argparse
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from configs.config import load_config
+
+
+class RetryQueue:
+    def __init__(self, path: str, max_attempts: int = 8, base_delay: float = 30.0, max_delay: float = 3600.0,
+                 lease_seconds: float = 600.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Nhiều process consumer có thể dùng chung file → timeout đợi lock của SQLite
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        for table in ["retry_items", "dead_letters"]:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, payload TEXT NOT NULL, error TEXT, "
+                "attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (kind, key))"
+            )
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    def push(self, kind: str, items: dict, error: str = "") -> None:
+        """
+        Đưa bản ghi lỗi từ luồng đồng bộ chính vào hàng đợi. items: {key: payload}.
+        Key đã có trong hàng đợi được thay payload mới nhất, giữ nguyên số lần thử.
+        """
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT INTO retry_items (kind, key, payload, error, attempts, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 0, ?, ?, ?) "
+                "ON CONFLICT (kind, key) DO UPDATE SET payload = excluded.payload, error = excluded.error, "
+                "updated_at = excluded.updated_at",
+                [
+                    (kind, str(key), json.dumps(payload, ensure_ascii=False, default=str), error,
+                     now + self._backoff(1), now, now)
+                    for key, payload in items.items()
+                ],
+            )
+
+    def discard(self, kind: str, keys: list) -> None:
+        """
+        Bỏ các key vừa được đồng bộ thành công ở luồng chính, để bản cũ trong hàng đợi không ghi đè bản mới.
+        """
+        if not keys:
+            return
+        with self._lock:
+            self.conn.executemany(
+                "DELETE FROM retry_items WHERE kind = ? AND key = ?", [(kind, str(key)) for key in keys]
+            )
+
+    def discard_claimed(self, kind: str, claimed: list) -> None:
+        """
+        Bỏ các bản ghi RetryWorker đã thử lại thành công. claimed: list (key, updated_at) lúc claim_due;
+        key đã được push payload mới hơn trong lúc thử lại (updated_at khác) thì giữ lại.
+        """
+        if not claimed:
+            return
+        with self._lock:
+            self.conn.executemany(
+                "DELETE FROM retry_items WHERE kind = ? AND key = ? AND updated_at = ?",
+                [(kind, str(key), updated_at) for key, updated_at in claimed],
+            )
+
+    def payloads(self, kind: str, keys: list) -> dict:
+        """
+        Payload hiện tại trong hàng đợi của các key. Output: {key: payload}, key không còn trong hàng đợi bị bỏ qua.
+        """
+        where, params = self._filter(kind, keys)
+        with self._lock:
+            rows = self.conn.execute(f"SELECT key, payload FROM retry_items{where}", params).fetchall()
+        return {key: json.loads(payload) for key, payload in rows}
+
+    def claim_due(self, limit: int = 50) -> list:
+        """
+        Lấy các bản ghi đến hạn thử lại và giữ chỗ (lease) để process khác không lấy trùng.
+        Output: list dict {kind, key, payload, attempts, updated_at}
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute(
+                    "SELECT kind, key, payload, attempts, updated_at FROM retry_items WHERE next_attempt_at <= ? "
+                    "ORDER BY next_attempt_at LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+                self.conn.executemany(
+                    "UPDATE retry_items SET next_attempt_at = ? WHERE kind = ? AND key = ?",
+                    [(now + self.lease_seconds, kind, key) for kind, key, _, _, _ in rows],
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return [
+            {"kind": kind, "key": key, "payload": json.loads(payload), "attempts": attempts, "updated_at": updated_at}
+            for kind, key, payload, attempts, updated_at in rows
+        ]
+
+    def mark_failed(self, kind: str, keys: list, error: str = "") -> int:
+        """
+        Tăng số lần thử và hẹn lần thử tiếp theo theo exponential backoff;
+        quá max_attempts thì chuyển sang dead_letters. Output: số bản ghi bị chuyển sang dead_letters.
+        """
+        now = time.time()
+        dead = 0
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for key in keys:
+                    row = self.conn.execute(
+                        "SELECT attempts FROM retry_items WHERE kind = ? AND key = ?", (kind, str(key))
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    attempts = row[0] + 1
+                    if attempts >= self.max_attempts:
+                        self.conn.execute(
+                            "INSERT OR REPLACE INTO dead_letters "
+                            "SELECT kind, key, payload, ?, ?, next_attempt_at, created_at, ? "
+                            "FROM retry_items WHERE kind = ? AND key = ?",
+                            (error, attempts, now, kind, str(key)),
+                        )
+                        self.conn.execute("DELETE FROM retry_items WHERE kind = ? AND key = ?", (kind, str(key)))
+                        dead += 1
+                    else:
+                        self.conn.execute(
+                            "UPDATE retry_items SET attempts = ?, error = ?, next_attempt_at = ?, updated_at = ? "
+                            "WHERE kind = ? AND key = ?",
+                            (attempts, error, now + self._backoff(attempts), now, kind, str(key)),
+                        )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return dead
+
+    def _filter(self, kind: str = None, keys: list = None):
+        clauses, params = [], []
+        if kind:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if keys:
+            clauses.append(f"key IN ({','.join('?' * len(keys))})")
+            params.extend(str(key) for key in keys)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def list(self, dead: bool = False, kind: str = None, limit: int = 50) -> list:
+        table = "dead_letters" if dead else "retry_items"
+        where, params = self._filter(kind)
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT kind, key, error, attempts, next_attempt_at, updated_at FROM {table}{where} "
+                "ORDER BY updated_at DESC LIMIT ?",
+                params + [limit],
+            ).fetchall()
+        columns = ["kind", "key", "error", "attempts", "next_attempt_at", "updated_at"]
+        return [dict(zip(columns, row)) for row in rows]
+
+    def replay(self, dead: bool = True, kind: str = None, keys: list = None) -> int:
+        """
+        Đưa bản ghi về hàng đợi để thử lại ngay: dead letters (dead=True) được reset số lần thử,
+        bản ghi đang chờ (dead=False) được đẩy lịch thử lại về hiện tại.
+        """
+        now = time.time()
+        where, params = self._filter(kind, keys)
+        with self._lock:
+            if not dead:
+                return self.conn.execute(
+                    f"UPDATE retry_items SET next_attempt_at = ?{where}",
+                    [now] + params,
+                ).rowcount
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                count = self.conn.execute(
+                    "INSERT OR REPLACE INTO retry_items "
+                    f"SELECT kind, key, payload, error, 0, ?, created_at, ? FROM dead_letters{where}",
+                    [now, now] + params,
+                ).rowcount
+                self.conn.execute(f"DELETE FROM dead_letters{where}", params)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return count
+
+    def purge(self, dead: bool = True, kind: str = None, keys: list = None) -> int:
+        table = "dead_letters" if dead else "retry_items"
+        where, params = self._filter(kind, keys)
+        with self._lock:
+            return self.conn.execute(f"DELETE FROM {table}{where}", params).rowcount
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            pending = self.conn.execute("SELECT kind, COUNT(*) FROM retry_items GROUP BY kind").fetchall()
+            due = self.conn.execute("SELECT COUNT(*) FROM retry_items WHERE next_attempt_at <= ?", (now,)).fetchone()[0]
+            dead = self.conn.execute("SELECT kind, COUNT(*) FROM dead_letters GROUP BY kind").fetchall()
+        return {"pending": dict(pending), "due": due, "dead": dict(dead)}
+
+
+class RetryWorker:
+    """
+    Thread nền lấy bản ghi đến hạn trong RetryQueue và gọi handler theo kind, tách khỏi luồng consume chính.
+    handlers: {kind: hàm nhận list payload, trả về list key vẫn lỗi}
+    """
+    def __init__(self, retry_queue: RetryQueue, handlers: dict, poll_interval: float = 10.0, batch_size: int = 50,
+                 logger=None):
+        self.retry_queue = retry_queue
+        self.handlers = handlers
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.logger = logger or logging.getLogger(__name__)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="retry-worker", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def run_once(self) -> int:
+        items = self.retry_queue.claim_due(self.batch_size)
+        by_kind = defaultdict(list)
+        for item in items:
+            by_kind[item["kind"]].append(item)
+
+        for kind, kind_items in by_kind.items():
+            keys = [item["key"] for item in kind_items]
+            handler = self.handlers.get(kind)
+            if handler is None:
+                self.retry_queue.mark_failed(kind, keys, f"Không có handler cho kind {kind}")
+                continue
+            try:
+                failed = {str(key) for key in handler([item["payload"] for item in kind_items])}
+                error = "Vẫn lỗi khi thử lại"
+            except Exception as e:
+                failed, error = set(keys), str(e)
+
+            succeeded = [item for item in kind_items if item["key"] not in failed]
+            self.retry_queue.discard_claimed(kind, [(item["key"], item["updated_at"]) for item in succeeded])
+            dead = self.retry_queue.mark_failed(kind, list(failed), error) if failed else 0
+            self.logger.info(
+                f"🔁 Retry [{kind}]: {len(succeeded)} thành công, {len(failed)} lỗi, {dead} chuyển sang dead letter"
+            )
+        return len(items)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                processed = self.run_once()
+            except Exception as e:
+                self.logger.error(f"❌ Lỗi retry worker: {e}")
+                processed = 0
+            if not processed:
+                self._stop.wait(self.poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Xem / thử lại các bản ghi đồng bộ bị lỗi")
+    parser.add_argument("command", choices=["stats", "list", "replay", "purge"])
+    parser.add_argument("--dead", action="store_true", help="thao tác trên dead letters thay vì hàng đợi retry")
+    parser.add_argument("--kind", choices=["product", "service"])
+    parser.add_argument("--key", nargs="*", help="SKU / id cần thao tác")
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    retry_config = load_config().get("retry_queue", {})
+    retry_queue = RetryQueue(
+        retry_config.get("path", "cache/retry_queue.sqlite"),
+        max_attempts=retry_config.get("max_attempts", 8),
+    )
+    if args.command == "stats":
+        print(json.dumps(retry_queue.stats(), ensure_ascii=False, indent=2))
+    elif args.command == "list":
+        for item in retry_queue.list(dead=args.dead, kind=args.kind, limit=args.limit):
+            print(json.dumps(item, ensure_ascii=False))
+    elif args.command == "replay":
+        print(f"Đã đưa {retry_queue.replay(dead=args.dead, kind=args.kind, keys=args.key)} bản ghi về hàng đợi retry")
+    elif args.command == "purge":
+        print(f"Đã xóa {retry_queue.purge(dead=args.dead, kind=args.kind, keys=args.key)} bản ghi")
+
+
+if __name__ == "__main__":
+    main()
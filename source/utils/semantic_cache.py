@@ -0,0 +1,123 @@
+import re
+import threading
+import logging
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def _extract_numbers(text: str) -> set:
+    return set(re.findall(r"\d+(?:[.,]\d+)?", text or ""))
+
+
+class SemanticSQLCache:
+    """
+    Cache SQL theo độ tương đồng ngữ nghĩa của câu hỏi (cosine similarity giữa các embedding).
+    - Lưu index vector trong bộ nhớ gồm các câu hỏi đã trả lời thành công và câu SQL tương ứng
+    - Tái sử dụng SQL khi similarity >= threshold và các con số trong 2 câu hỏi giống nhau
+      (vd: "giá dưới 1 triệu" và "giá dưới 2 triệu" rất giống nhau nhưng SQL khác nhau)
+    - Thống kê hit rate, phân bố similarity; mỗi lần hit được ghi vào audit log để rà soát hit sai
+    """
+    def __init__(self, embeddings: Embeddings, threshold: float = 0.95, max_size: int = 2000,
+                 logger = None, audit_logger = None):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_size = max_size
+        self.logger = logger or logging.getLogger(__name__)
+        self.audit_logger = audit_logger or self.logger
+        self._lock = threading.Lock()
+        self._questions = []
+        self._sqls = []
+        self._vectors = None  # ma trận (n, dim) đã chuẩn hóa L2
+
+        self.lookups = 0
+        self.hits = 0
+        self.false_hits = 0
+        self.similarity_histogram = [0] * 10  # 10 khoảng [0, 0.1), ..., [0.9, 1.0]
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _search(self, vector: np.ndarray):
+        with self._lock:
+            if self._vectors is None or len(self._questions) == 0:
+                return None, 0.0, None
+            similarities = self._vectors @ vector
+            best = int(np.argmax(similarities))
+            return self._questions[best], float(similarities[best]), self._sqls[best]
+
+    def _record(self, question: str, matched_question, similarity: float, sql_query):
+        self.lookups += 1
+        if matched_question is None:
+            return None
+
+        bucket = min(max(int(similarity * 10), 0), 9)
+        self.similarity_histogram[bucket] += 1
+
+        if similarity < self.threshold or _extract_numbers(question) != _extract_numbers(matched_question):
+            return None
+
+        self.hits += 1
+        self.audit_logger.info(
+            f"[semantic_sql_cache] hit similarity={similarity:.4f} | question={question!r} "
+            f"| matched={matched_question!r} | sql={sql_query!r}"
+        )
+        return sql_query
+
+    async def alookup(self, question: str):
+        """
+        Tìm SQL đã lưu cho câu hỏi tương tự. Trả về câu SQL hoặc None nếu không có câu đủ giống.
+        """
+        vector = self._normalize(await self.embeddings.aembed_query(question))
+        matched_question, similarity, sql_query = self._search(vector)
+        return self._record(question, matched_question, similarity, sql_query)
+
+    async def aadd(self, question: str, sql_query: str) -> None:
+        """
+        Lưu câu hỏi đã trả lời thành công cùng câu SQL đã chạy được.
+        """
+        vector = self._normalize(await self.embeddings.aembed_query(question))
+        with self._lock:
+            if question in self._questions:
+                return
+            self._questions.append(question)
+            self._sqls.append(sql_query)
+            row = vector.reshape(1, -1)
+            self._vectors = row if self._vectors is None else np.vstack([self._vectors, row])
+
+            # Bỏ các câu hỏi cũ nhất khi vượt quá max_size
+            overflow = len(self._questions) - self.max_size
+            if overflow > 0:
+                del self._questions[:overflow]
+                del self._sqls[:overflow]
+                self._vectors = self._vectors[overflow:]
+
+    def report_false_hit(self, question: str, sql_query: str, reason) -> None:
+        """
+        Ghi nhận SQL lấy từ cache nhưng chạy lỗi cho câu hỏi mới, và loại câu SQL đó khỏi cache.
+        """
+        self.false_hits += 1
+        self.audit_logger.warning(
+            f"[semantic_sql_cache] false hit | question={question!r} | sql={sql_query!r} | reason={reason}"
+        )
+        with self._lock:
+            keep = [i for i, sql in enumerate(self._sqls) if sql != sql_query]
+            self._questions = [self._questions[i] for i in keep]
+            self._sqls = [self._sqls[i] for i in keep]
+            self._vectors = self._vectors[keep] if keep else None
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._questions),
+            "threshold": self.threshold,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "false_hits": self.false_hits,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "similarity_histogram": {
+                f"{i / 10:.1f}-{(i + 1) / 10:.1f}": count
+                for i, count in enumerate(self.similarity_histogram)
+            },
+        }
@@ -0,0 +1,48 @@
+import threading
+from source.utils.ttl_cache import LRUTTLCache
+from source.utils.embedding_cache import normalize_query
+
+
+class SQLResultCache:
+    """
+    Cache 2 tầng cho /sql_retrieval:
+    - Tầng 1: câu hỏi đã chuẩn hóa -> câu SQL đã chạy thành công
+    - Tầng 2: (SQL, generation của index) -> kết quả đã đọc qua cursor ({"columns", "rows", "truncated"})
+    Cả 2 tầng bị xóa khi generation của index thay đổi (dữ liệu được thêm / xóa).
+    """
+    def __init__(self, max_size: int = 2000, ttl_seconds: float = 3600):
+        self.sql_cache = LRUTTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self.result_cache = LRUTTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self.generation = None
+        self._lock = threading.Lock()
+
+    def sync_generation(self, generation: int) -> None:
+        with self._lock:
+            if generation == self.generation:
+                return
+            if self.generation is not None:
+                self.sql_cache.clear()
+                self.result_cache.clear()
+            self.generation = generation
+
+    def get_sql(self, question: str):
+        return self.sql_cache.get(normalize_query(question))
+
+    def set_sql(self, question: str, sql_query: str) -> None:
+        self.sql_cache.set(normalize_query(question), sql_query)
+
+    def invalidate_sql(self, question: str) -> None:
+        self.sql_cache.pop(normalize_query(question))
+
+    def get_result(self, sql_query: str, generation: int):
+        return self.result_cache.get(f"{generation}|{sql_query}")
+
+    def set_result(self, sql_query: str, generation: int, result: dict) -> None:
+        self.result_cache.set(f"{generation}|{sql_query}", result)
+
+    def stats(self) -> dict:
+        return {
+            "generation": self.generation,
+            "sql": self.sql_cache.stats(),
+            "result": self.result_cache.stats(),
+        }
@@ -0,0 +1,255 @@
+"""
+Ghép prompt sinh SQL cho từng câu hỏi:
+- Chỉ đưa vào các truy vấn mẫu và mô tả cột liên quan nhất (theo cosine similarity với embedding câu hỏi),
+  dùng index embedding dựng sẵn của truy vấn mẫu / mô tả cột (lưu trong EmbeddingStore)
+- Phần hướng dẫn cố định đứng đầu prompt, phần thay đổi theo câu hỏi đứng cuối (prompt caching)
+- Thống kê token (input / cache / output) của từng request và tổng
+Index được dựng khi khởi động app (abuild_index), vector đã có trong EmbeddingStore không cần embedding lại.
+"""
+import asyncio
+import contextvars
+import hashlib
+import logging
+import re
+import threading
+
+import numpy as np
+
+re_sql_sample = re.compile(r"#\s*Query\s*\d+:\s*(.+?)\s*\n\s*Trả về:\s*\"(.+?)\",?\s*$", flags=re.MULTILINE)
+re_column_line = re.compile(r"^(\w+) \((\w+)\): .+$", flags=re.MULTILINE)
+re_identifier = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+SELECTED_COLUMNS_PLACEHOLDER = "<SELECTED_COLUMNS>"
+
+_request_usage = contextvars.ContextVar("sql_prompt_request_usage", default=None)
+
+
+class RequestUsage:
+    """
+    Token của các lần gọi LLM trong 1 request /sql_retrieval (kể cả các ứng viên chạy song song).
+    """
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.prompt_chars = 0
+        self.full_prompt_chars = 0
+
+
+class SQLPromptBuilder:
+    """
+    table_config: cấu hình bảng của BaseElasticSQLRetriever (prompt, mô tả cột, truy vấn mẫu, cột SELECT).
+    embeddings: None hoặc dynamic=False thì dùng nguyên prompt đầy đủ (tất cả truy vấn mẫu và cột).
+    Cả 2 chế độ dùng chung 1 template (SQL_GENERATION_PROMPT / SQL_DOUBLE_CHECK_PROMPT), chỉ khác phần cột / truy vấn mẫu.
+    """
+    def __init__(self, table_config: dict, embeddings=None, model_name: str = "", dimensions: int = 0,
+                 dynamic: bool = True, top_k_samples: int = 3, top_k_columns: int = 10,
+                 always_columns: list = None, embedding_store=None, logger=None):
+        self.config = table_config
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.dimensions = dimensions
+        self.dynamic = dynamic and embeddings is not None
+        self.top_k_samples = top_k_samples
+        self.top_k_columns = top_k_columns
+        self.always_columns = always_columns or ["name", "price"]
+        self.embedding_store = embedding_store
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.samples = [(question, sql) for question, sql in re_sql_sample.findall(table_config["SQL_SAMPLES"])]
+        self.columns = [(match.group(1), match.group(0)) for match in re_column_line.finditer(table_config["COLUMN_INFO"])]
+        self._column_names = {name for name, _ in self.columns}
+
+        self._sample_vectors = None  # ma trận (số mẫu, dim) đã chuẩn hóa L2
+        self._column_vectors = None
+        self._index_lock = asyncio.Lock()
+
+        self._lock = threading.Lock()
+        self.totals = RequestUsage()
+        self.requests = 0
+
+    # ---------- index embedding ----------
+    def _text_hash(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}|{self.dimensions}|{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    async def _embed_texts(self, texts: list) -> np.ndarray:
+        hashes = [self._text_hash(text) for text in texts]
+        stored = self.embedding_store.get_vectors(hashes) if self.embedding_store is not None else {}
+        missing = [text for text, text_hash in zip(texts, hashes) if text_hash not in stored]
+        if missing:
+            vectors = await self.embeddings.aembed_documents(missing)
+            new_vectors = {self._text_hash(text): vector for text, vector in zip(missing, vectors)}
+            if self.embedding_store is not None:
+                self.embedding_store.set_vectors(new_vectors)
+            stored.update(new_vectors)
+        return self._normalize([stored[text_hash] for text_hash in hashes])
+
+    async def abuild_index(self) -> None:
+        async with self._index_lock:
+            if self._sample_vectors is not None:
+                return
+            self._column_vectors = await self._embed_texts([line for _, line in self.columns])
+            self._sample_vectors = await self._embed_texts([question for question, _ in self.samples])
+            self.logger.info(f"✅ Đã dựng index embedding cho {len(self.samples)} truy vấn mẫu, {len(self.columns)} cột")
+
+    # ---------- chọn truy vấn mẫu / cột ----------
+    def _compact_sql(self, sql: str) -> str:
+        return sql.replace(f"SELECT {self.config['SELECTED_COLUMNS']} FROM", f"SELECT {SELECTED_COLUMNS_PLACEHOLDER} FROM")
+
+    def expand_sql(self, sql_query: str) -> str:
+        """
+        LLM chép nguyên dạng viết tắt của truy vấn mẫu: đổi lại thành danh sách cột đầy đủ.
+        """
+        if not sql_query or SELECTED_COLUMNS_PLACEHOLDER not in sql_query:
+            return sql_query
+        return sql_query.replace(SELECTED_COLUMNS_PLACEHOLDER, self.config["SELECTED_COLUMNS"])
+
+    def _referenced_columns(self, sql_query: str) -> set:
+        # Cột dùng trong WHERE / ORDER BY ... (bỏ phần SELECT danh sách cột cố định)
+        tail = sql_query.split(" FROM ", 1)[-1] if sql_query else ""
+        return {word for word in re_identifier.findall(tail) if word in self._column_names}
+
+    async def _select(self, question: str, extra_sql: str = None):
+        await self.abuild_index()
+        vector = self._normalize(await self.embeddings.aembed_query(question))
+
+        sample_order = np.argsort(-(self._sample_vectors @ vector))[:self.top_k_samples]
+        samples = [self.samples[i] for i in sorted(sample_order)]
+
+        column_order = np.argsort(-(self._column_vectors @ vector))[:self.top_k_columns]
+        keep = {self.columns[i][0] for i in column_order} | set(self.always_columns)
+        for _, sql in samples:
+            keep |= self._referenced_columns(sql)
+        if extra_sql:
+            keep |= self._referenced_columns(extra_sql)
+        # Giữ thứ tự cột như mô tả gốc
+        columns = [line for name, line in self.columns if name in keep]
+        return samples, columns
+
+    def _format_samples(self, samples: list) -> str:
+        return "\n\n".join(
+            f"# Query {i}: {question}\n  Trả về:     \"{self._compact_sql(sql)}\","
+            for i, (question, sql) in enumerate(samples, 1)
+        )
+
+    def _static_values(self) -> dict:
+        return {
+            "table_name": self.config["TABLE_NAME"],
+            "table_description": self.config["TABLE_DESCRIPTION"],
+            "selected_columns": self.config["SELECTED_COLUMNS"],
+        }
+
+    def _full_generation_prompt(self, question: str) -> str:
+        return self.config["SQL_GENERATION_PROMPT"].format(
+            question=question,
+            columns_info=self.config["COLUMN_INFO"],
+            sql_samples=self.config["SQL_SAMPLES"],
+            **self._static_values(),
+        )
+
+    def _full_double_check_prompt(self, question: str, previous_sql, sql_error) -> str:
+        return self.config["SQL_DOUBLE_CHECK_PROMPT"].format(
+            question=question,
+            columns_info=self.config["COLUMN_INFO"],
+            previous_sql=previous_sql,
+            sql_error=sql_error,
+            **self._static_values(),
+        )
+
+    async def generation_prompt(self, question: str) -> str:
+        full_prompt = self._full_generation_prompt(question)
+        prompt = full_prompt
+        if self.dynamic:
+            try:
+                samples, columns = await self._select(question)
+                prompt = self.config["SQL_GENERATION_PROMPT"].format(
+                    question=question,
+                    columns_info="\n".join(columns),
+                    sql_samples=self._format_samples(samples),
+                    **self._static_values(),
+                )
+            except Exception as e:
+                self.logger.warning(f"⚠️ Không chọn được truy vấn mẫu / cột, dùng prompt đầy đủ: {e}")
+        self._record_prompt(prompt, full_prompt)
+        return prompt
+
+    async def double_check_prompt(self, question: str, previous_sql, sql_error) -> str:
+        full_prompt = self._full_double_check_prompt(question, previous_sql, sql_error)
+        prompt = full_prompt
+        if self.dynamic:
+            try:
+                _, columns = await self._select(question, extra_sql=previous_sql)
+                prompt = self.config["SQL_DOUBLE_CHECK_PROMPT"].format(
+                    question=question,
+                    columns_info="\n".join(columns),
+                    previous_sql=previous_sql,
+                    sql_error=sql_error,
+                    **self._static_values(),
+                )
+            except Exception as e:
+                self.logger.warning(f"⚠️ Không chọn được cột liên quan, dùng prompt đầy đủ: {e}")
+        self._record_prompt(prompt, full_prompt)
+        return prompt
+
+    # ---------- thống kê token ----------
+    def begin_request(self) -> RequestUsage:
+        usage = RequestUsage()
+        _request_usage.set(usage)
+        return usage
+
+    def _targets(self):
+        usage = _request_usage.get()
+        return [self.totals] if usage is None else [self.totals, usage]
+
+    def _record_prompt(self, prompt: str, full_prompt: str) -> None:
+        with self._lock:
+            for target in self._targets():
+                target.prompt_chars += len(prompt)
+                target.full_prompt_chars += len(full_prompt)
+
+    def record_usage(self, usage_metadata: dict) -> None:
+        """
+        Cộng token của 1 lần gọi LLM (AIMessage.usage_metadata) vào request hiện tại và tổng.
+        """
+        usage_metadata = usage_metadata or {}
+        cached = (usage_metadata.get("input_token_details") or {}).get("cache_read", 0) or 0
+        with self._lock:
+            for target in self._targets():
+                target.calls += 1
+                target.input_tokens += usage_metadata.get("input_tokens", 0)
+                target.cached_tokens += cached
+                target.output_tokens += usage_metadata.get("output_tokens", 0)
+
+    def end_request(self, usage: RequestUsage, question: str) -> None:
+        with self._lock:
+            self.requests += 1
+        if usage.calls == 0:
+            return
+        self.logger.info(
+            f"📊 Token sinh SQL | question={question!r} | {usage.calls} lần gọi LLM | input {usage.input_tokens} "
+            f"(cache {usage.cached_tokens}) | output {usage.output_tokens} | prompt {usage.prompt_chars} ký tự "
+            f"(đầy đủ {usage.full_prompt_chars})"
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            totals = self.totals
+            return {
+                "dynamic": self.dynamic,
+                "requests": self.requests,
+                "llm_calls": totals.calls,
+                "input_tokens": totals.input_tokens,
+                "cached_input_tokens": totals.cached_tokens,
+                "output_tokens": totals.output_tokens,
+                "avg_input_tokens_per_request": round(totals.input_tokens / self.requests, 1) if self.requests else 0.0,
+                "prompt_chars_ratio": round(totals.prompt_chars / totals.full_prompt_chars, 4)
+                if totals.full_prompt_chars else 1.0,
+            }
+
@@ -0,0 +1,133 @@
+import logging
+import threading
+
+RESULT_HEADER = "Các kết quả được lấy ra từ database:\n"
+
+
+def format_item(idx: int, item: dict) -> str:
+    """
+    Đoạn text của 1 dòng kết quả, ghép nối tiếp sau RESULT_HEADER cho ra đúng định dạng paser_resp.
+    """
+    return f"\nMục {idx}:" + "".join(f"\n{k}: {v}" for k, v in item.items()) + "\n"
+
+
+def truncated_note(count: int) -> str:
+    return f"\n(Kết quả đã được cắt bớt, chỉ hiển thị {count} mục đầu tiên)"
+
+
+def iter_result_text(result: dict):
+    """
+    Định dạng lại kết quả dạng rows ({"columns", "rows", "truncated"}) thành từng đoạn text.
+    """
+    yield RESULT_HEADER
+    for idx, item in enumerate(result["rows"], 1):
+        yield format_item(idx, item)
+    if result.get("truncated"):
+        yield truncated_note(len(result["rows"]))
+
+
+def format_result(result: dict) -> str:
+    return "".join(iter_result_text(result))
+
+
+class SQLResultStream:
+    """
+    Đọc kết quả ES SQL theo từng trang (cursor), thay cho việc chỉ lấy trang đầu tiên:
+    - Dừng khi đủ max_rows dòng hoặc phần text đã định dạng vượt max_bytes, và đánh dấu truncated
+    - Cursor được đóng (clear_cursor) khi dừng sớm hoặc khi close() được gọi (vd. client ngắt kết nối),
+      kể cả khi close() chạy lúc 1 thread khác đang đọc trang tiếp theo
+    - Định dạng từng dòng ngay khi đọc được để trả về dần (streaming), không giữ toàn bộ text trong bộ nhớ
+    resp: response trang đầu tiên của es.sql.query(format="json").
+    """
+    def __init__(self, es, resp, max_rows: int = 500, max_bytes: int = 262144, logger=None):
+        self.es = es
+        self.columns = [c["name"] for c in resp["columns"]]
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._rows = resp.get("rows", [])
+        self.cursor = resp.get("cursor")
+        self._lock = threading.Lock()
+        self._closed = False
+        self.count = 0
+        self.bytes = 0
+        self.pages = 1
+        self.truncated = False
+
+    def is_empty(self) -> bool:
+        # Chỉ đúng trước khi bắt đầu đọc: trang đầu không có dòng nào và không còn trang sau
+        return not self._rows and not self.cursor
+
+    def items(self):
+        """
+        Sinh lần lượt (item, text) trong giới hạn max_rows / max_bytes, item là dict các cột khác None.
+        """
+        try:
+            while True:
+                for row in self._rows:
+                    if self._closed:
+                        return
+                    if self.count >= self.max_rows:
+                        self.truncated = True
+                        return
+                    item = {k: v for k, v in zip(self.columns, row) if v is not None}
+                    text = format_item(self.count + 1, item)
+                    size = len(text.encode("utf-8"))
+                    if self.count and self.bytes + size > self.max_bytes:
+                        self.truncated = True
+                        return
+                    self.count += 1
+                    self.bytes += size
+                    yield item, text
+
+                with self._lock:
+                    if self._closed or not self.cursor:
+                        return
+                    cursor = self.cursor
+                resp = self.es.sql.query(cursor=cursor, format="json")
+                with self._lock:
+                    closed = self._closed
+                    if not closed:
+                        self._rows = resp.get("rows", [])
+                        self.cursor = resp.get("cursor")
+                        self.pages += 1
+                if closed:
+                    # close() chạy trong lúc đang đọc trang: cursor mới trả về không còn ai đóng
+                    self._clear_cursor(resp.get("cursor"))
+                    return
+        finally:
+            self.close()
+
+    def iter_text(self):
+        yield RESULT_HEADER
+        for _, text in self.items():
+            yield text
+        if self.truncated:
+            yield truncated_note(self.count)
+
+    def collect(self) -> dict:
+        rows = [item for item, _ in self.items()]
+        return {"columns": self.columns, "rows": rows, "truncated": self.truncated}
+
+    def close(self) -> None:
+        # Trang cuối ES tự đóng cursor, chỉ cần clear khi dừng trước khi đọc hết
+        with self._lock:
+            self._closed = True
+            cursor, self.cursor = self.cursor, None
+            self._rows = []
+        self._clear_cursor(cursor)
+
+    def _clear_cursor(self, cursor) -> None:
+        if not cursor:
+            return
+        try:
+            self.es.sql.clear_cursor(cursor=cursor)
+        except Exception as e:
+            self.logger.warning(f"⚠️ Không đóng được cursor ES SQL: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
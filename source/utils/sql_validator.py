@@ -0,0 +1,284 @@
+import difflib
+import logging
+import re
+
+from source.utils.ttl_cache import LRUTTLCache
+
+SQL_KEYWORDS = {
+    "SELECT", "FROM", "WHERE", "AND", "OR", "NOT", "AS", "ORDER", "BY", "ASC", "DESC", "LIMIT", "TOP",
+    "GROUP", "HAVING", "NULL", "IS", "IN", "LIKE", "RLIKE", "ESCAPE", "BETWEEN", "TRUE", "FALSE", "DISTINCT",
+    "ALL", "CASE", "WHEN", "THEN", "ELSE", "END", "NULLS", "FIRST", "LAST", "INTERVAL", "PIVOT", "FOR",
+    "YEAR", "YEARS", "MONTH", "MONTHS", "DAY", "DAYS", "HOUR", "HOURS", "MINUTE", "MINUTES", "SECOND", "SECONDS",
+    "BOOLEAN", "BYTE", "SHORT", "INTEGER", "INT", "LONG", "BIGINT", "DOUBLE", "FLOAT", "REAL", "KEYWORD",
+    "TEXT", "VARCHAR", "DATE", "DATETIME", "TIME", "IP",
+}
+
+# Hàm ES SQL (SHOW FUNCTIONS), gồm cả dạng viết tắt
+SQL_FUNCTIONS = {
+    # aggregate
+    "AVG", "COUNT", "FIRST", "FIRST_VALUE", "LAST", "LAST_VALUE", "MAX", "MIN", "SUM", "KURTOSIS", "MAD",
+    "PERCENTILE", "PERCENTILE_RANK", "SKEWNESS", "STDDEV_POP", "STDDEV_SAMP", "SUM_OF_SQUARES", "VAR_POP", "VAR_SAMP",
+    "HISTOGRAM",
+    # full-text
+    "MATCH", "QUERY", "SCORE",
+    # math
+    "ABS", "CBRT", "CEIL", "CEILING", "E", "EXP", "EXPM1", "FLOOR", "LOG", "LOG10", "MOD", "PI", "POWER", "RANDOM",
+    "RAND", "ROUND", "SIGN", "SIGNUM", "SQRT", "TRUNCATE", "TRUNC", "ACOS", "ASIN", "ATAN", "ATAN2", "COS", "COSH",
+    "COT", "DEGREES", "RADIANS", "SIN", "SINH", "TAN",
+    # string
+    "ASCII", "BIT_LENGTH", "CHAR", "CHAR_LENGTH", "CHARACTER_LENGTH", "CONCAT", "INSERT", "LCASE", "LEFT", "LENGTH",
+    "LOCATE", "LTRIM", "OCTET_LENGTH", "POSITION", "REPEAT", "REPLACE", "RIGHT", "RTRIM", "SPACE", "STARTS_WITH",
+    "SUBSTRING", "TRIM", "UCASE",
+    # conditional, type
+    "COALESCE", "GREATEST", "IFNULL", "IIF", "ISNULL", "LEAST", "NULLIF", "NVL", "CAST", "CONVERT",
+    # date / time
+    "CURRENT_DATE", "CURDATE", "CURRENT_TIME", "CURTIME", "CURRENT_TIMESTAMP", "NOW", "TODAY", "DATE_ADD", "DATEADD",
+    "TIMESTAMPADD", "DATE_DIFF", "DATEDIFF", "TIMESTAMPDIFF", "DATE_FORMAT", "DATE_PARSE", "DATETIME_FORMAT",
+    "DATETIME_PARSE", "FORMAT", "DATE_PART", "DATEPART", "DATE_TRUNC", "DATETRUNC", "EXTRACT", "TIME_PARSE",
+    "DAY_OF_MONTH", "DAYOFMONTH", "DOM", "DAY_OF_WEEK", "DAYOFWEEK", "DOW", "DAY_OF_YEAR", "DAYOFYEAR", "DOY",
+    "DAY_NAME", "DAYNAME", "HOUR_OF_DAY", "IDOW", "ISO_DAY_OF_WEEK", "ISODAYOFWEEK", "ISO_WEEK_OF_YEAR",
+    "ISOWEEKOFYEAR", "IWOY", "MINUTE_OF_DAY", "MINUTE_OF_HOUR", "MONTH_NAME", "MONTHNAME", "MONTH_OF_YEAR",
+    "QUARTER", "SECOND_OF_MINUTE", "WEEK_OF_YEAR", "WEEK", "YEAR", "MONTH", "DAY", "HOUR", "MINUTE", "SECOND",
+}
+
+re_sql_token = re.compile(
+    r"""(?P<string>'(?:[^']|'')*')"""
+    r"""|(?P<quoted>"(?:[^"]|"")*")"""
+    r"""|(?P<backquoted>`[^`]*`)"""
+    r"""|(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)"""
+    r"""|(?P<word>[A-Za-z_@][A-Za-z0-9_@.]*)"""
+    r"""|(?P<unclosed>['"`])"""
+)
+re_code_fence = re.compile(r"^```(?:sql)?\s*|\s*```$", flags=re.IGNORECASE)
+re_column_info = re.compile(r"^(\w+) \((\w+)\)", flags=re.MULTILINE)
+
+
+def parse_column_info(column_info: str) -> dict:
+    """
+    Lấy tên cột -> kiểu từ mô tả cột trong prompt (dạng "price (float): ...").
+    """
+    return {name: column_type for name, column_type in re_column_info.findall(column_info)}
+
+
+class SQLValidator:
+    """
+    Kiểm tra câu SQL do LLM sinh ra trước khi chạy:
+    1. Kiểm tra cục bộ theo danh sách cột: sửa tên cột sai hoa/thường, chuỗi đặt trong nháy kép,
+       báo lỗi cột (kèm tên cột gần giống) / hàm không tồn tại, thiếu dấu nháy đóng
+    2. es.sql.translate: ES kiểm tra cú pháp, kiểu dữ liệu mà không chạy truy vấn.
+       Câu SQL chỉ bị chặn khi translate lỗi, lỗi cục bộ được gửi kèm cho bước LLM sửa SQL
+    Query DSL sau khi translate được cache theo câu SQL để lần sau chạy thẳng qua _search (dùng shard request cache).
+    """
+    def __init__(self, es, table_name: str, columns: dict, max_size: int = 2000, ttl_seconds: float = None,
+                 close_match_cutoff: float = 0.85, search_enabled: bool = True, logger=None):
+        self.es = es
+        self.table_name = table_name
+        self.columns = columns  # tên cột -> kiểu dữ liệu trong index
+        self._columns_lower = {name.lower(): name for name in columns}
+        self.close_match_cutoff = close_match_cutoff
+        self.logger = logger or logging.getLogger(__name__)
+        self.search_enabled = search_enabled
+        self.translations = LRUTTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+
+        self.repaired = 0
+        self.rejected = 0
+        self.search_hits = 0
+
+    def _resolve_column(self, name: str):
+        # Chỉ tự sửa hoa/thường, tên gần giống (vd. battery_capacity) có thể là nhiều cột khác nhau
+        if name in self.columns:
+            return name
+        return self._columns_lower.get(name.lower())
+
+    def _unknown_column(self, name: str) -> str:
+        matches = difflib.get_close_matches(name.lower(), list(self._columns_lower), n=3, cutoff=self.close_match_cutoff)
+        if matches:
+            return f"Cột không tồn tại: {name} (có phải: {', '.join(self._columns_lower[m] for m in matches)}?)"
+        return f"Cột không tồn tại: {name}"
+
+    @staticmethod
+    def _identifier(token):
+        """
+        (tên, là từ khóa SQL) của token tên (từ hoặc tên trong nháy kép), (None, False) với token khác.
+        """
+        if token.group("word"):
+            return token.group("word"), token.group("word").upper() in SQL_KEYWORDS
+        if token.group("quoted"):
+            return token.group("quoted")[1:-1].replace('""', '"'), False
+        return None, False
+
+    def _split_qualifier(self, word: str, aliases: set):
+        # "p.name" / "products.name" -> ("p.", "name") khi p là alias của bảng
+        qualifier, _, name = word.partition(".")
+        if name and (qualifier.lower() in aliases or qualifier.lower() == self.table_name.lower()):
+            return qualifier + ".", name
+        return "", word
+
+    def check(self, sql_query: str):
+        """
+        Kiểm tra / sửa câu SQL cục bộ.
+        Output: (câu SQL đã sửa, danh sách lỗi không tự sửa được)
+        """
+        sql = re_code_fence.sub("", sql_query.strip()).strip().rstrip(";").strip()
+        sql = sql.replace("“", '"').replace("”", '"').replace("‘", "'").replace("’", "'")
+
+        tokens = list(re_sql_token.finditer(sql))
+        aliases = set()
+        for previous, token in zip(tokens, tokens[1:]):
+            name, is_keyword = self._identifier(token)
+            if name is None or is_keyword:
+                continue
+            gap = sql[previous.end():token.start()].strip()
+            previous_word, previous_keyword = self._identifier(previous)
+            # "expr AS alias" hoặc alias viết liền sau biểu thức: "AVG(price) avg_price", "price gia", "FROM products p"
+            if (previous_keyword and previous_word.upper() == "AS" and not gap) or gap.endswith(")") or (
+                not gap and not previous_keyword
+            ):
+                aliases.add(name.lower())
+
+        errors = []
+        parts = []
+        last = 0
+        previous_word = None
+        for token in tokens:
+            text = token.group(0)
+            replacement = text
+            after_from = (previous_word or "").upper() == "FROM"
+
+            if token.group("unclosed"):
+                errors.append(f"Thiếu dấu {text} đóng")
+            elif token.group("quoted"):
+                name, _ = self._identifier(token)
+                column = self._resolve_column(name)
+                if after_from:
+                    if name.lower() == self.table_name.lower():
+                        replacement = f'"{self.table_name}"'
+                    else:
+                        errors.append(f"Bảng không tồn tại: {name}")
+                elif name.lower() in aliases:
+                    pass
+                elif column is not None:
+                    replacement = f'"{column}"'
+                elif (previous_word or "").upper() != "AS":
+                    # LLM hay đặt chuỗi trong nháy kép, ES SQL hiểu đó là tên cột
+                    replacement = "'" + name.replace("'", "''") + "'"
+                previous_word = name
+            elif token.group("word"):
+                word = text
+                upper = word.upper()
+                is_call = sql[token.end():].lstrip().startswith("(")
+                if is_call and upper in SQL_FUNCTIONS:
+                    pass
+                elif is_call and upper not in SQL_KEYWORDS:
+                    errors.append(f"Hàm không được hỗ trợ: {word}")
+                elif after_from:
+                    if word.lower() == self.table_name.lower():
+                        replacement = self.table_name
+                    else:
+                        errors.append(f"Bảng không tồn tại: {word}")
+                elif upper in SQL_KEYWORDS or word.lower() in aliases:
+                    pass
+                else:
+                    qualifier, name = self._split_qualifier(word, aliases)
+                    column = self._resolve_column(name)
+                    if column is None:
+                        errors.append(self._unknown_column(word))
+                    else:
+                        replacement = qualifier + column
+                previous_word = word
+
+            if replacement != text:
+                parts.append(sql[last:token.start()])
+                parts.append(replacement)
+                last = token.end()
+        parts.append(sql[last:])
+        repaired_sql = "".join(parts)
+
+        if repaired_sql != sql_query:
+            self.repaired += 1
+        return repaired_sql, errors
+
+    def translate(self, sql_query: str):
+        """
+        Query DSL tương ứng câu SQL (es.sql.translate), có cache.
+        """
+        entry = self.translations.get(sql_query)
+        if entry is not None:
+            return entry["dsl"]
+        dsl = dict(self.es.sql.translate(query=sql_query))
+        self.translations.set(sql_query, {"dsl": dsl, "columns": None})
+        return dsl
+
+    def validate(self, sql_query: str):
+        """
+        Output: (câu SQL đã sửa, None) nếu hợp lệ, hoặc (câu SQL, mô tả lỗi) để gửi cho bước LLM sửa SQL.
+        """
+        sql, errors = self.check(sql_query)
+        try:
+            self.translate(sql)
+        except Exception as e:
+            # Lỗi cục bộ (cột gợi ý, ...) đi kèm lỗi của ES để bước LLM sửa SQL dùng
+            self.rejected += 1
+            return sql, "; ".join(errors + [str(e)])
+        if errors:
+            # Kiểm tra cục bộ không bao quát hết cú pháp ES SQL: ES translate được thì vẫn chạy
+            self.logger.warning(f"⚠️ Kiểm tra cục bộ báo lỗi nhưng ES SQL translate thành công: {errors} | {sql}")
+        return sql, None
+
+    def remember_columns(self, sql_query: str, columns: list) -> None:
+        """
+        Ghi nhận tên cột kết quả của câu SQL (lấy từ lần chạy qua ES SQL) để các lần sau chạy qua _search.
+        """
+        entry = self.translations.get(sql_query)
+        if entry is not None and entry["columns"] is None:
+            entry["columns"] = columns
+
+    def _search_fields(self, entry):
+        # Chỉ chạy qua _search khi kết quả ES SQL là các cột lấy thẳng từ document
+        dsl, columns = entry["dsl"], entry["columns"]
+        if columns is None or "aggregations" in dsl or "script_fields" in dsl or "fields" not in dsl:
+            return None
+        fields = [field["field"] if isinstance(field, dict) else field for field in dsl["fields"]]
+        if fields != columns or any(self.columns.get(field) in (None, "date") for field in fields):
+            return None
+        return fields
+
+    def search(self, sql_query: str, max_rows: int):
+        """
+        Chạy câu SQL đã translate trước đó qua _search (request_cache=true).
+        Output: response cùng dạng es.sql.query (columns, rows), hoặc None nếu câu SQL không chạy được theo cách này.
+        """
+        entry = self.translations.get(sql_query) if self.search_enabled else None
+        if entry is None:
+            return None
+        fields = self._search_fields(entry)
+        if fields is None:
+            return None
+
+        body = dict(entry["dsl"])
+        # Lấy dư 1 dòng để SQLResultStream biết kết quả bị cắt bớt
+        body["size"] = min(body.get("size", max_rows + 1), max_rows + 1)
+        resp = self.es.search(index=self.table_name, body=body, request_cache=True)
+
+        rows = []
+        for hit in resp["hits"]["hits"]:
+            values = hit.get("fields", {})
+            row = []
+            for field in fields:
+                value = values.get(field)
+                if value is not None and len(value) > 1:
+                    # ES SQL báo lỗi với cột nhiều giá trị, để ES SQL xử lý như cũ
+                    return None
+                row.append(value[0] if value else None)
+            rows.append(row)
+
+        self.search_hits += 1
+        return {"columns": [{"name": field} for field in fields], "rows": rows}
+
+    def stats(self) -> dict:
+        return {
+            "repaired": self.repaired,
+            "rejected": self.rejected,
+            "search_hits": self.search_hits,
+            "translations": self.translations.stats(),
+        }
@@ -0,0 +1,99 @@
+"""
+Migration cho các bảng đồng bộ từ Kafka (m2_datasets.data_products / data_services):
+- Thêm cột content_hash + index (key, content_hash) để so sánh thay đổi chỉ bằng hash
+- Backfill content_hash cho các dòng đã có
+
+Chạy:
+    python -m source.utils.sync_migrations
+    python -m source.utils.sync_migrations --table products --batch-size 2000
+"""
+import argparse
+import psycopg2
+from psycopg2.extras import execute_values
+from configs.config import load_config
+from configs.logging_config import setup_logging
+from source.utils.sync_rows import row_hash, PRODUCT_COLUMNS, PRODUCT_JSON_COLUMNS, SERVICE_COLUMNS, SERVICE_JSON_COLUMNS
+
+TABLES = {
+    "products": {
+        "table": "m2_datasets.data_products",
+        "key": "sku",
+        "columns": PRODUCT_COLUMNS,
+        "json_columns": PRODUCT_JSON_COLUMNS,
+        "index": "data_products_sku_content_hash_idx",
+    },
+    "services": {
+        "table": "m2_datasets.data_services",
+        "key": "id",
+        "columns": SERVICE_COLUMNS,
+        "json_columns": SERVICE_JSON_COLUMNS,
+        "index": "data_services_id_content_hash_idx",
+    },
+}
+
+
+def add_content_hash_column(conn, spec, logger) -> None:
+    with conn.cursor() as cur:
+        cur.execute(f"ALTER TABLE {spec['table']} ADD COLUMN IF NOT EXISTS content_hash TEXT")
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS {spec['index']} ON {spec['table']} ({spec['key']}, content_hash)"
+        )
+    conn.commit()
+    logger.info(f"✅ Đã thêm cột content_hash và index {spec['index']} cho {spec['table']}")
+
+
+def backfill_content_hash(conn, spec, batch_size, logger) -> int:
+    """
+    Tính content_hash cho các dòng chưa có hash, cùng cách tính với lúc ghi từ Kafka (sync_rows.row_hash).
+    """
+    columns = ", ".join(f'"{column}"' for column in spec["columns"])
+    updated = 0
+    with conn.cursor(name=f"backfill_{spec['index']}", withhold=True) as read_cur:
+        read_cur.itersize = batch_size
+        read_cur.execute(f"SELECT {columns} FROM {spec['table']} WHERE content_hash IS NULL")
+        while True:
+            rows = read_cur.fetchmany(batch_size)
+            if not rows:
+                break
+
+            values = []
+            for row in rows:
+                data = dict(zip(spec["columns"], row))
+                values.append((data[spec["key"]], row_hash(data, spec["json_columns"])))
+
+            with conn.cursor() as write_cur:
+                execute_values(
+                    write_cur,
+                    f"UPDATE {spec['table']} AS t SET content_hash = v.content_hash "
+                    f"FROM (VALUES %s) AS v(key, content_hash) WHERE t.{spec['key']} = v.key",
+                    values,
+                    page_size=batch_size,
+                )
+            conn.commit()
+            updated += len(values)
+            logger.info(f"Backfill {spec['table']}: {updated} dòng")
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Thêm và backfill cột content_hash cho các bảng sync")
+    parser.add_argument("--table", choices=["products", "services", "all"], default="all")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    config = load_config()
+    logger = setup_logging("Sync_Migrations")
+    conn = psycopg2.connect(**config["postgres"]["connection"])
+    try:
+        names = list(TABLES) if args.table == "all" else [args.table]
+        for name in names:
+            spec = TABLES[name]
+            add_content_hash_column(conn, spec, logger)
+            updated = backfill_content_hash(conn, spec, args.batch_size, logger)
+            logger.info(f"✅ Đã backfill content_hash cho {updated} dòng trong {spec['table']}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
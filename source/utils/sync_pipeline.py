@@ -0,0 +1,287 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+
+class OffsetTracker:
+    """
+    Theo dõi offset Kafka của các message đang được pipeline xử lý.
+    Offset commit được cho mỗi partition = offset nhỏ nhất còn đang xử lý (hoặc offset lớn nhất đã thấy + 1),
+    nên message chỉ được commit khi nó và mọi message trước nó trong partition đã xử lý xong.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(set)
+        self._max_seen = {}
+        self._committed = {}
+
+    def add(self, tp, offset: int) -> None:
+        with self._lock:
+            self._pending[tp].add(offset)
+            self._max_seen[tp] = max(offset, self._max_seen.get(tp, -1))
+
+    def done(self, offsets: dict) -> None:
+        """
+        offsets: {TopicPartition: list offset} đã xử lý xong
+        """
+        with self._lock:
+            for tp, tp_offsets in offsets.items():
+                self._pending[tp].difference_update(tp_offsets)
+
+    def committable(self) -> dict:
+        """
+        Trả về {TopicPartition: offset cần commit} cho các partition có offset mới so với lần commit trước.
+        """
+        result = {}
+        with self._lock:
+            for tp, max_seen in self._max_seen.items():
+                pending = self._pending[tp]
+                offset = min(pending) if pending else max_seen + 1
+                if offset > self._committed.get(tp, -1):
+                    result[tp] = offset
+        return result
+
+    def mark_committed(self, offsets: dict) -> None:
+        with self._lock:
+            self._committed.update(offsets)
+
+    def forget(self, partitions) -> None:
+        """
+        Bỏ theo dõi các partition bị thu hồi khi rebalance.
+        """
+        with self._lock:
+            for tp in partitions:
+                self._pending.pop(tp, None)
+                self._max_seen.pop(tp, None)
+                self._committed.pop(tp, None)
+
+
+class PipelineBatch:
+    def __init__(self, batch_id: int, records: list, offsets: dict, keys: set, received_at: float = None):
+        self.batch_id = batch_id
+        self.state = {"batch": records}
+        self.offsets = offsets      # {TopicPartition: list offset}
+        self.keys = keys            # SKU / id trong batch, dùng để giữ thứ tự ghi cho cùng 1 bản ghi
+        self.error = None
+        self.finished = threading.Event()   # set khi batch xong (thành công hoặc lỗi)
+        self.submitted_at = time.time()
+        self.received_at = received_at or self.submitted_at   # lúc nhận bản ghi đầu tiên, để đo độ trễ end-to-end
+
+
+class Stage:
+    """
+    1 bước trong pipeline: hàng đợi có giới hạn + nhóm worker thread riêng.
+    Khi hàng đợi của bước sau đầy, worker bị chặn ở put() → áp lực ngược truyền dần về consumer.
+    """
+    def __init__(self, name: str, func, workers: int = 1, queue_size: int = 4):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.threads = []
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+
+class SyncPipeline:
+    """
+    Pipeline nhiều bước cho các batch đồng bộ từ Kafka (diff → preprocess → enrich → ES → Milvus → PostgreSQL).
+    - Mỗi bước có hàng đợi giới hạn và worker riêng, nên LLM chậm không làm dừng việc nhận message
+    - Batch có SKU / id trùng với batch đang xử lý sẽ đợi batch đó xong để không ghi đè dữ liệu mới bằng dữ liệu cũ
+    - Batch lỗi ở 1 bước được thử lại với backoff; batch xong (thành công hoặc lỗi) được đưa vào hàng đợi completed
+      để thread consumer cập nhật offset (consumer Kafka không an toàn khi dùng từ nhiều thread)
+    """
+    def __init__(self, name: str, stages: list, config: dict = None, logger=None, on_failure=None):
+        """
+        stages: list (tên bước, hàm nhận state và trả về state)
+        config: mục sync_pipeline trong config.yaml
+        on_failure: hàm (state, lỗi) gọi khi batch lỗi hết số lần thử, trả về True nếu đã chuyển batch
+                    sang hàng đợi retry (khi đó offset được commit như batch thành công)
+        """
+        config = config or {}
+        self.name = name
+        self.logger = logger or logging.getLogger(__name__)
+        self.on_failure = on_failure
+        self.max_in_flight = config.get("max_in_flight", 8)
+        self.max_retries = config.get("max_retries", 3)
+        self.retry_base_delay = config.get("retry_base_delay", 1.0)
+        stage_workers = config.get("stage_workers", {})
+        queue_size = config.get("queue_size", 4)
+
+        self.stages = [
+            Stage(stage_name, func, stage_workers.get(stage_name, 1), queue_size)
+            for stage_name, func in stages
+        ]
+        self.completed = queue.Queue()
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._in_flight = {}
+        self._closed = False
+
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker, args=(index,), name=f"{name}-{stage.name}-{i}", daemon=True
+                )
+                thread.start()
+                stage.threads.append(thread)
+
+    def is_full(self) -> bool:
+        with self._lock:
+            return len(self._waiting) + len(self._in_flight) >= self.max_in_flight
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._waiting) + len(self._in_flight)
+
+    def submit(self, records: list, offsets: dict, keys: set, received_at: float = None,
+               state: dict = None) -> PipelineBatch:
+        """
+        Đưa 1 batch vào pipeline. Không chặn: consumer cần kiểm tra is_full() để tạm dừng nhận message.
+        state: các giá trị thêm vào state ban đầu của batch (vd. cờ retry của RetryWorker)
+        """
+        batch = PipelineBatch(next(self._ids), records, offsets, set(keys), received_at)
+        batch.state.update(state or {})
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"Pipeline {self.name} đã đóng")
+            self._waiting.append(batch)
+        self._dispatch()
+        return batch
+
+    def _dispatch(self) -> None:
+        """
+        Chuyển các batch đang đợi sang bước đầu tiên nếu không trùng key với batch đang xử lý
+        (hoặc với batch đứng trước nó trong hàng đợi, để giữ thứ tự theo key).
+        """
+        with self._lock:
+            blocked_keys = set()
+            for batch in self._in_flight.values():
+                blocked_keys |= batch.keys
+            remaining = []
+            for batch in self._waiting:
+                if batch.keys & blocked_keys:
+                    remaining.append(batch)
+                else:
+                    try:
+                        self.stages[0].queue.put_nowait(batch)
+                        self._in_flight[batch.batch_id] = batch
+                    except queue.Full:
+                        remaining.append(batch)
+                blocked_keys |= batch.keys
+            self._waiting = remaining
+
+    def _run_stage(self, stage: Stage, batch: PipelineBatch):
+        for attempt in range(self.max_retries + 1):
+            start = time.time()
+            try:
+                batch.state = stage.func(batch.state)
+                stage.busy_seconds += time.time() - start
+                stage.processed += 1
+                return True
+            except Exception as e:
+                stage.busy_seconds += time.time() - start
+                if attempt == self.max_retries:
+                    stage.failed += 1
+                    batch.error = f"{stage.name}: {e}"
+                    self.logger.error(
+                        f"❌ [{self.name}] Batch {batch.batch_id} lỗi ở bước {stage.name} sau {attempt + 1} lần thử: {e}"
+                    )
+                    return False
+                delay = self.retry_base_delay * (2 ** attempt)
+                self.logger.warning(
+                    f"⚠️ [{self.name}] Batch {batch.batch_id} lỗi ở bước {stage.name}: {e}. Thử lại sau {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+    def _worker(self, index: int) -> None:
+        stage = self.stages[index]
+        while True:
+            batch = stage.queue.get()
+            if batch is None:
+                break
+            if self._run_stage(stage, batch):
+                if index + 1 < len(self.stages):
+                    self.stages[index + 1].queue.put(batch)
+                    continue
+            elif self._park(batch):
+                batch.error = None
+            self._finish(batch)
+
+    def _park(self, batch: PipelineBatch) -> bool:
+        if self.on_failure is None:
+            return False
+        try:
+            parked = self.on_failure(batch.state, batch.error)
+        except Exception as e:
+            self.logger.error(f"❌ [{self.name}] Không đưa được batch {batch.batch_id} vào hàng đợi retry: {e}")
+            return False
+        if parked:
+            self.logger.warning(f"⚠️ [{self.name}] Batch {batch.batch_id} đã được chuyển sang hàng đợi retry")
+        return parked
+
+    def _finish(self, batch: PipelineBatch) -> None:
+        with self._lock:
+            self._in_flight.pop(batch.batch_id, None)
+        self.completed.put(batch)
+        batch.finished.set()
+        self._dispatch()
+
+    def drain_completed(self) -> list:
+        """
+        Lấy các batch đã xử lý xong (gọi từ thread consumer), đồng thời đẩy tiếp các batch đang đợi.
+        """
+        self._dispatch()
+        batches = []
+        while True:
+            try:
+                batches.append(self.completed.get_nowait())
+            except queue.Empty:
+                return batches
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """
+        Đợi tới khi không còn batch nào đang đợi / đang xử lý (dùng khi rebalance hoặc dừng consumer).
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.pending():
+            if deadline is not None and time.time() > deadline:
+                self.logger.warning(f"⚠️ [{self.name}] Hết thời gian đợi, còn {self.pending()} batch chưa xử lý xong")
+                return False
+            self._dispatch()
+            time.sleep(0.1)
+        return True
+
+    def close(self, timeout: float = None) -> None:
+        """
+        Ngừng nhận batch mới, đợi các batch đang xử lý xong rồi dừng worker.
+        Các batch đã xong vẫn nằm trong completed để drain_completed lấy.
+        """
+        with self._lock:
+            self._closed = True
+        self.wait_idle(timeout)
+
+        for stage in self.stages:
+            for _ in stage.threads:
+                stage.queue.put(None)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending(),
+            "stages": {
+                stage.name: {
+                    "workers": stage.workers,
+                    "queued": stage.queue.qsize(),
+                    "processed": stage.processed,
+                    "failed": stage.failed,
+                    "avg_seconds": round(stage.busy_seconds / max(1, stage.processed + stage.failed), 3),
+                }
+                for stage in self.stages
+            },
+        }
@@ -0,0 +1,75 @@
+import json
+from datetime import datetime
+from source.utils.content_hash import content_hash
+
+# Các cột được ghi vào m2_datasets.data_products / data_services (cùng thứ tự câu INSERT)
+PRODUCT_COLUMNS = [
+    "id", "name", "sku", "price", "thumbnail", "images", "category_id", "weight",
+    "short_description", "description", "salient_features", "services", "attributes"
+]
+PRODUCT_JSON_COLUMNS = ["images", "category_id", "services", "attributes"]
+
+SERVICE_COLUMNS = [
+    "id", "created_at", "updated_at", "code", "description", "menu_code", "name", "order",
+    "price", "type", "status", "unit", "value_type", "vat"
+]
+SERVICE_JSON_COLUMNS = []
+
+
+def product_row(data: dict) -> dict:
+    """
+    Chuyển payload Kafka của sản phẩm thành dict {cột Postgres: giá trị} (cột JSON chưa json.dumps).
+    """
+    return {
+        "id": data.get("id"),
+        "name": data.get("name"),
+        "sku": data.get("sku"),
+        "price": data.get("price"),
+        "thumbnail": data.get("thumbnail"),
+        "images": data.get("images", []),
+        "category_id": data.get("categoryId", []),
+        "weight": data.get("weight"),
+        "short_description": data.get("shortDescription"),
+        "description": data.get("description"),
+        "salient_features": data.get("salientFeatures"),
+        "services": data.get("services", []),
+        "attributes": data.get("attributes", []),
+    }
+
+
+def service_row(data: dict) -> dict:
+    """
+    Chuyển payload Kafka của dịch vụ thành dict {cột Postgres: giá trị}.
+    """
+    row = {column: data.get(column) for column in SERVICE_COLUMNS}
+    for column in ["created_at", "updated_at"]:
+        row[column] = datetime.fromisoformat(row[column]) if row[column] else None
+    return row
+
+
+def row_hash(row: dict, json_columns: list = None) -> str:
+    """
+    Hash nội dung của 1 dòng (dạng canonical JSON), dùng chung cho payload Kafka và dòng đọc từ Postgres.
+    Cột JSON đọc từ DB dạng chuỗi sẽ được parse lại trước khi hash.
+    """
+    normalized = dict(row)
+    for column in json_columns or []:
+        value = normalized.get(column)
+        if isinstance(value, str):
+            try:
+                normalized[column] = json.loads(value)
+            except json.JSONDecodeError:
+                pass
+    return content_hash(normalized)
+
+
+def product_values(row: dict) -> tuple:
+    """
+    Tuple giá trị theo PRODUCT_COLUMNS + content_hash để ghi vào Postgres.
+    """
+    values = [json.dumps(row[c]) if c in PRODUCT_JSON_COLUMNS else row[c] for c in PRODUCT_COLUMNS]
+    return tuple(values) + (row_hash(row, PRODUCT_JSON_COLUMNS),)
+
+
+def service_values(row: dict) -> tuple:
+    return tuple(row[c] for c in SERVICE_COLUMNS) + (row_hash(row, SERVICE_JSON_COLUMNS),)
@@ -0,0 +1,197 @@
+"""
+Chạy nhiều process consumer Kafka (process_kafka_messages) trong cùng group ai_b2c_product_group.
+Kafka chia partition cho từng process; mỗi process tự tạo kết nối PostgreSQL, client Elasticsearch / Milvus riêng.
+
+Chạy:
+    python -m source.utils.sync_supervisor
+    python -m source.utils.sync_supervisor --workers 4
+"""
+import argparse
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from configs.config import load_config
+from configs.logging_config import setup_logging
+
+
+def _worker_main(worker_id, stop_event, status_queue):
+    # Ctrl+C gửi tới cả nhóm process, để supervisor quyết định dừng qua stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # stop_event riêng của worker này: SIGTERM gửi tới 1 worker chỉ dừng worker đó (supervisor sẽ khởi động lại)
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+
+    # import trong process con: các client ES / Milvus được tạo lúc import product_consumer
+    from source.utils.product_consumer import process_kafka_messages
+    process_kafka_messages(stop_event=stop_event, report_status=status_queue.put, worker_id=worker_id)
+
+
+class SyncSupervisor:
+    """
+    - Khởi động N worker process (start method "spawn" để không dùng chung socket / connection với process cha)
+    - Khởi động lại worker bị chết, đợi lâu dần (exponential backoff) giữa các lần khởi động lại,
+      bỏ cuộc sau max_restarts lần liên tiếp (vd. Kafka không truy cập được, sai cấu hình)
+    - Gom trạng thái (partition, lag, batch đang xử lý) các worker gửi về và cảnh báo worker không báo trạng thái
+    - Khi dừng: báo các worker xử lý nốt batch, commit offset rồi mới thoát
+    """
+    def __init__(self, workers: int, config: dict = None, logger=None):
+        config = config or {}
+        self.workers = workers
+        self.logger = logger or logging.getLogger(__name__)
+        self.health_timeout = config.get("health_timeout", 180)
+        self.shutdown_timeout = config.get("shutdown_timeout", 300)
+        self.report_interval = config.get("stats_interval_seconds", 60)
+        self.restart_base_delay = config.get("restart_base_delay", 5)
+        self.restart_max_delay = config.get("restart_max_delay", 300)
+        self.max_restarts = config.get("max_restarts", 10)
+        # worker chạy được lâu hơn khoảng này mới chết thì đếm lại số lần khởi động lại từ 0
+        self.restart_reset_seconds = config.get("restart_reset_seconds", 600)
+
+        self.ctx = multiprocessing.get_context("spawn")
+        self.stop_event = self.ctx.Event()   # dừng cả nhóm, chỉ supervisor set
+        self.worker_stop_events = {}         # worker_id -> Event dừng riêng từng worker
+        self.status_queue = self.ctx.Queue()
+        self.processes = {}
+        self.started_at = {}
+        self.last_status = {}
+        self.restarts = {}      # worker_id -> số lần khởi động lại liên tiếp
+        self.restart_at = {}    # worker_id -> thời điểm khởi động lại worker đã chết
+        self.given_up = set()   # worker đã chết quá max_restarts lần, không khởi động lại nữa
+
+    def _start(self, worker_id):
+        self.worker_stop_events[worker_id] = self.ctx.Event()
+        process = self.ctx.Process(
+            target=_worker_main,
+            args=(worker_id, self.worker_stop_events[worker_id], self.status_queue),
+            name=f"sync-worker-{worker_id}",
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self.started_at[worker_id] = time.time()
+        self.logger.info(f"✅ Đã khởi động worker {worker_id} (pid {process.pid})")
+
+    def _collect_status(self):
+        while True:
+            try:
+                status = self.status_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.last_status[status["worker_id"]] = status
+
+    def _check_workers(self):
+        now = time.time()
+        for worker_id, process in list(self.processes.items()):
+            if self.stop_event.is_set():
+                return
+            if worker_id in self.given_up:
+                continue
+            if not process.is_alive():
+                self._restart(worker_id, process, now)
+                continue
+
+            last_seen = self.last_status.get(worker_id, {}).get("time", self.started_at[worker_id])
+            if now - last_seen > self.health_timeout:
+                self.logger.warning(
+                    f"⚠️ Worker {worker_id} (pid {process.pid}) không gửi trạng thái trong {now - last_seen:.0f}s"
+                )
+
+    def _restart(self, worker_id, process, now):
+        if worker_id not in self.restart_at:
+            # Lần đầu phát hiện worker chết: tính thời điểm khởi động lại
+            self.last_status.pop(worker_id, None)
+            if now - self.started_at[worker_id] >= self.restart_reset_seconds:
+                self.restarts[worker_id] = 0
+            attempts = self.restarts.get(worker_id, 0)
+            if attempts >= self.max_restarts:
+                self.given_up.add(worker_id)
+                self.logger.error(
+                    f"❌ Worker {worker_id} (pid {process.pid}) đã dừng với exitcode {process.exitcode} sau "
+                    f"{attempts} lần khởi động lại liên tiếp, không khởi động lại nữa"
+                )
+                if len(self.given_up) == len(self.processes):
+                    self.logger.error("❌ Tất cả worker đều không chạy được, dừng supervisor")
+                    self.stop_event.set()
+                return
+            delay = min(self.restart_base_delay * (2 ** attempts), self.restart_max_delay)
+            self.restart_at[worker_id] = now + delay
+            self.logger.error(
+                f"❌ Worker {worker_id} (pid {process.pid}) đã dừng với exitcode {process.exitcode}, "
+                f"khởi động lại sau {delay:.0f}s (lần {attempts + 1}/{self.max_restarts})"
+            )
+
+        if now >= self.restart_at[worker_id]:
+            del self.restart_at[worker_id]
+            self.restarts[worker_id] = self.restarts.get(worker_id, 0) + 1
+            self._start(worker_id)
+
+    def report(self) -> dict:
+        """
+        Trạng thái tổng hợp của các worker: lag từng worker và tổng lag của group.
+        """
+        workers = {
+            worker_id: {
+                "pid": status["pid"],
+                "partitions": status["partitions"],
+                "total_lag": status["total_lag"],
+                "paused": status["paused"],
+                "failed_partitions": status.get("failed_partitions", []),
+                "pending_batches": status["pending_batches"],
+                "seconds_since_report": round(time.time() - status["time"], 1),
+            }
+            for worker_id, status in sorted(self.last_status.items())
+        }
+        return {
+            "workers": workers,
+            "alive": sum(1 for process in self.processes.values() if process.is_alive()),
+            "given_up": sorted(self.given_up),
+            "total_lag": sum(worker["total_lag"] for worker in workers.values()),
+        }
+
+    def stop(self):
+        self.logger.info("🛑 Dừng các worker, đợi xử lý nốt các batch đang chạy ...")
+        self.stop_event.set()
+        for worker_stop_event in self.worker_stop_events.values():
+            worker_stop_event.set()
+        deadline = time.time() + self.shutdown_timeout
+        for worker_id, process in self.processes.items():
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                self.logger.warning(f"⚠️ Worker {worker_id} không dừng kịp, terminate")
+                process.terminate()
+                process.join()
+
+    def run(self):
+        for worker_id in range(self.workers):
+            self._start(worker_id)
+
+        last_report = time.time()
+        try:
+            while not self.stop_event.is_set():
+                time.sleep(1)
+                self._collect_status()
+                self._check_workers()
+                if time.time() - last_report >= self.report_interval:
+                    self.logger.info(f"📊 Supervisor: {self.report()}")
+                    last_report = time.time()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def main():
+    config = load_config()
+    supervisor_config = config.get("sync_pipeline", {})
+    parser = argparse.ArgumentParser(description="Chạy nhiều consumer Kafka đồng bộ sản phẩm / dịch vụ")
+    parser.add_argument("--workers", type=int, default=supervisor_config.get("workers", 2))
+    args = parser.parse_args()
+
+    logger = setup_logging("Sync_Supervisor")
+    supervisor = SyncSupervisor(args.workers, supervisor_config, logger)
+    signal.signal(signal.SIGTERM, lambda *_: supervisor.stop_event.set())
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
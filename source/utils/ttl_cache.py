@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class LRUTTLCache:
+    """
+    Cache trong bộ nhớ có giới hạn số phần tử:
+    - Loại bỏ phần tử ít được dùng gần nhất (LRU) khi vượt quá max_size
+    - Phần tử hết hạn sau ttl_seconds (None = không hết hạn)
+    - Đếm số lần hit / miss / eviction để theo dõi hiệu quả cache
+    Key phải là chuỗi nếu muốn lưu cache xuống file (save / load).
+    """
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()  # key -> (expire_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _is_expired(self, expire_at) -> bool:
+        return expire_at is not None and expire_at <= time.time()
+
+    def get(self, key, default=None, count: bool = True):
+        """
+        count=False: không tính vào hit / miss (vd. đọc lại giá trị vừa nạp trước vào cache)
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += count
+                return default
+
+            expire_at, value = item
+            if self._is_expired(expire_at):
+                del self._data[key]
+                self.misses += count
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += count
+            return value
+
+    def set(self, key, value, ttl_seconds: float = None) -> None:
+        ttl = ttl_seconds if ttl_seconds is not None else self.ttl_seconds
+        expire_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (expire_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[1] if item is not None else default
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and not self._is_expired(item[0])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def save(self, path: str) -> None:
+        """
+        Lưu các phần tử còn hạn xuống file JSON (ghi file tạm rồi đổi tên để tránh hỏng file).
+        """
+        with self._lock:
+            entries = [
+                [key, expire_at, value]
+                for key, (expire_at, value) in self._data.items()
+                if not self._is_expired(expire_at)
+            ]
+        p = Path(path)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = p.with_suffix(p.suffix + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        tmp_path.replace(p)
+
+    def load(self, path: str) -> int:
+        """
+        Nạp lại cache từ file JSON, bỏ qua các phần tử đã hết hạn. Trả về số phần tử đã nạp.
+        """
+        p = Path(path)
+        if not p.exists():
+            return 0
+        with open(p, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+
+        loaded = 0
+        with self._lock:
+            for key, expire_at, value in entries:
+                if self._is_expired(expire_at):
+                    continue
+                self._data[key] = (expire_at, value)
+                self._data.move_to_end(key)
+                loaded += 1
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return loaded
@@ -0,0 +1,33 @@
+"""
+EmbeddingStore: vector của text cũ được xóa khi không còn pk nào dùng.
+"""
+from source.utils.embedding_store import EmbeddingStore
+
+
+def make_store(tmp_path):
+    store = EmbeddingStore(str(tmp_path / "embeddings.sqlite"))
+    store.set_vectors({"old": [1.0], "shared": [2.0], "new": [3.0], "prompt": [4.0]})
+    store.set_pk_hashes("products", {"1": "old", "2": "shared"})
+    store.set_pk_hashes("services", {"9": "shared"})
+    return store
+
+
+def test_replaced_hash_is_deleted(tmp_path):
+    store = make_store(tmp_path)
+    store.set_pk_hashes("products", {"1": "new"})
+    assert set(store.get_vectors(["old", "new", "shared", "prompt"])) == {"new", "shared", "prompt"}
+
+
+def test_hash_still_used_by_other_pk_is_kept(tmp_path):
+    store = make_store(tmp_path)
+    store.set_pk_hashes("products", {"2": "new"})
+    assert "shared" in store.get_vectors(["shared"])
+
+    store.delete_pk("services", "9")
+    assert store.get_vectors(["shared"]) == {}
+
+
+def test_unchanged_hash_is_kept(tmp_path):
+    store = make_store(tmp_path)
+    store.set_pk_hashes("products", {"1": "old"})
+    assert "old" in store.get_vectors(["old"])
@@ -0,0 +1,103 @@
+"""
+Fast path HTML → Markdown (source.utils.fast_markdown) phải cho kết quả giống hệt
+BeautifulSoup + markdownify (convert_df_to_document._markdownify_bs), hoặc trả về None để dùng đường gốc.
+"""
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from source.utils import convert_df_to_document as convert_module
+from source.utils.convert_df_to_document import convert_df_to_document
+from source.utils.fast_markdown import fast_markdownify
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+CATALOGUE_HTML = [
+    # Magento PageBuilder: style, figure ảnh, data-pb-style
+    '<style>#html-body [data-pb-style=ABC]{display:none}</style>'
+    '<div data-content-type="row" data-appearance="contained" data-element="main">'
+    '<div data-enable-parallax="0" data-element="inner" data-pb-style="ABC">'
+    '<figure data-content-type="image" data-element="main"><img src="a.jpg" alt="Đèn"></figure>'
+    '<div data-content-type="text"><p><strong>Đèn năng lượng mặt trời</strong> công suất 200W</p></div>'
+    '</div></div>',
+    # Heading, danh sách, link, xuống dòng
+    '<h2>Thông số kỹ thuật</h2><ul><li>Công suất: 1500W</li><li>Dung tích: <b>1.7 lít</b></li>'
+    '<li>Bảo hành <a href="https://aiosmart.com.vn/bao-hanh">12 tháng</a></li></ul><p>Dòng 1<br>Dòng 2</p>',
+    # Danh sách lồng nhau, em / i, span, khoảng trắng thừa
+    '<div>  <ul>\n <li>Chảo <em>chống dính</em>\n<ul><li>Đường kính <i>26 cm</i></li></ul></li>\n</ul>  </div>'
+    '<p><span style="color:red">Giá&nbsp;tốt</span> &amp; miễn phí vận chuyển</p>',
+    # Figure có chữ được giữ lại, heading các cấp, charref hợp lệ
+    '<figure><span>Ảnh minh họa</span></figure><h1>A</h1><h3>B &#8211; C</h3><h6>D &#x2022; E</h6>',
+    # Thẻ không đóng, strong lồng trong heading
+    '<p>Đoạn 1<p>Đoạn 2 <strong>đậm<h4>Tiêu đề <strong>đậm</strong></h4>',
+]
+
+FALLBACK_HTML = [
+    '<table><tr><td>Thẻ chưa hỗ trợ</td></tr></table>',
+    '<p>Có comment<!-- ghi chú --></p>',
+    '<p>Charref lạ &#150; &#xD800;</p>',
+    '<!DOCTYPE html><p>Doctype</p>',
+]
+
+
+def _csv_samples():
+    samples = []
+    for name, columns in [
+        ("data_products_29_2_2025.csv", ["description", "salient_features", "short_description"]),
+        ("data_service_29_2_2025.csv", ["description"]),
+    ]:
+        path = DATA_DIR / name
+        if not path.exists():
+            continue
+        df = pd.read_csv(path, encoding="utf-8")
+        for column in columns:
+            samples.extend(value for value in df[column].dropna() if value)
+    return samples
+
+
+@pytest.fixture(scope="module")
+def converter():
+    return convert_df_to_document(fast_html=False)
+
+
+@pytest.mark.parametrize("html", CATALOGUE_HTML)
+def test_catalogue_html_matches_markdownify(converter, html):
+    result = fast_markdownify(html)
+    assert result is not None
+    assert result == converter._markdownify_bs(html)
+
+
+@pytest.mark.parametrize("html", FALLBACK_HTML)
+def test_unsupported_html_falls_back(html):
+    assert fast_markdownify(html) is None
+
+    fast = convert_df_to_document(fast_html=True)
+    slow = convert_df_to_document(fast_html=False)
+    assert fast.convert_html_to_markdown(html) == slow.convert_html_to_markdown(html)
+    assert fast.fast_html_fallbacks == 1
+
+
+def test_csv_catalogue_matches_markdownify(converter):
+    samples = _csv_samples()
+    if not samples:
+        pytest.skip("Không có file CSV dữ liệu mẫu")
+    mismatches = [
+        html for html in samples
+        if (result := fast_markdownify(html)) is not None and result != converter._markdownify_bs(html)
+    ]
+    assert not mismatches, mismatches[0][:500]
+
+
+def test_pool_worker_honours_fast_html(monkeypatch):
+    def fail(html):
+        raise AssertionError("fast path được gọi khi fast_html=False")
+
+    monkeypatch.setattr(convert_module, "fast_markdownify", fail)
+    records = [{"description": html} for html in CATALOGUE_HTML]
+    documents = convert_module._convert_chunk((records, ["description"], [], [], None, False))
+
+    converter = convert_df_to_document(fast_html=False)
+    assert [doc["description"] for doc in documents] == [
+        converter.convert_html_to_markdown(html) for html in CATALOGUE_HTML
+    ]
@@ -0,0 +1,72 @@
+"""
+SQLResultStream: cursor ES SQL luôn được đóng, kể cả khi close() chạy trong lúc đang đọc trang tiếp theo.
+"""
+import threading
+
+from source.utils.sql_stream import SQLResultStream
+
+
+class FakeSQL:
+    def __init__(self, pages):
+        self.pages = pages
+        self.cleared = []
+        self.fetching = threading.Event()
+        self.release = threading.Event()
+        self.block = False
+
+    def query(self, cursor, format):
+        if self.block:
+            self.fetching.set()
+            self.release.wait(5)
+        return self.pages[cursor]
+
+    def clear_cursor(self, cursor):
+        self.cleared.append(cursor)
+
+
+class FakeES:
+    def __init__(self, pages):
+        self.sql = FakeSQL(pages)
+
+
+PAGES = {
+    "c1": {"rows": [[2]], "cursor": "c2"},
+    "c2": {"rows": [[3]]},
+}
+
+
+def first_page():
+    return {"columns": [{"name": "a"}], "rows": [[1]], "cursor": "c1"}
+
+
+def test_reads_all_pages_without_clearing():
+    es = FakeES(PAGES)
+    result = SQLResultStream(es, first_page()).collect()
+    assert result["rows"] == [{"a": 1}, {"a": 2}, {"a": 3}]
+    assert es.sql.cleared == []
+
+
+def test_stopping_early_clears_cursor():
+    es = FakeES(PAGES)
+    stream = SQLResultStream(es, first_page(), max_rows=1)
+    assert stream.collect()["truncated"]
+    assert es.sql.cleared == ["c2"]
+
+
+def test_close_during_page_fetch_clears_new_cursor():
+    es = FakeES(PAGES)
+    es.sql.block = True
+    stream = SQLResultStream(es, first_page())
+    items = stream.items()
+    assert next(items)[0] == {"a": 1}
+
+    reader = threading.Thread(target=lambda: list(items))
+    reader.start()
+    assert es.sql.fetching.wait(5)
+    stream.close()
+    es.sql.release.set()
+    reader.join(5)
+
+    # c1 được đóng bởi close(), c2 do trang đang đọc trả về sau khi đã close
+    assert es.sql.cleared == ["c1", "c2"]
+    assert stream.cursor is None
@@ -0,0 +1,97 @@
+"""
+SQLValidator.check / validate: không chặn câu ES SQL hợp lệ, chỉ tự sửa hoa/thường và báo lỗi (kèm gợi ý) với tên gần giống.
+"""
+import re
+
+import pytest
+
+from configs.prompt import PRODUCT_COLUMN_INFO, PRODUCT_SQL_SAMPLES
+from source.utils.sql_validator import SQLValidator, parse_column_info
+
+SAMPLE_SQL = re.findall(r'Trả về:\s*"(.+?)",?\s*$', PRODUCT_SQL_SAMPLES, flags=re.MULTILINE)
+
+
+class FakeSQL:
+    def __init__(self, error=None):
+        self.error = error
+        self.translated = []
+
+    def translate(self, query):
+        self.translated.append(query)
+        if self.error:
+            raise RuntimeError(self.error)
+        return {"size": 10}
+
+
+class FakeES:
+    def __init__(self, error=None):
+        self.sql = FakeSQL(error)
+
+
+def make_validator(error=None):
+    return SQLValidator(FakeES(error), "products", parse_column_info(PRODUCT_COLUMN_INFO))
+
+
+def test_samples_are_parsed():
+    assert len(SAMPLE_SQL) == 10
+
+
+@pytest.mark.parametrize("sql", SAMPLE_SQL)
+def test_sample_queries_pass_unchanged(sql):
+    assert make_validator().check(sql) == (sql, [])
+
+
+@pytest.mark.parametrize("sql", [
+    'SELECT name, price FROM "products" WHERE price > 0',
+    "SELECT p.name FROM products AS p WHERE p.price > 0",
+    "SELECT products.name FROM products",
+    'SELECT name, price AS "Giá" FROM products ORDER BY "Giá" DESC',
+    "SELECT AVG(price) avg_price FROM products GROUP BY name ORDER BY avg_price",
+])
+def test_valid_es_sql_passes_unchanged(sql):
+    assert make_validator().check(sql) == (sql, [])
+
+
+def test_repairs_case_only():
+    sql, errors = make_validator().check("SELECT Name, PRICE FROM Products WHERE Battery_Capacity_W > 0")
+    assert sql == "SELECT name, price FROM products WHERE battery_capacity_W > 0"
+    assert errors == []
+
+
+def test_double_quoted_string_becomes_literal():
+    sql, errors = make_validator().check('SELECT name FROM products WHERE MATCH(name, "đèn")')
+    assert sql == "SELECT name FROM products WHERE MATCH(name, 'đèn')"
+    assert errors == []
+
+
+def test_near_miss_is_reported_with_suggestions():
+    sql = "SELECT name FROM products ORDER BY battery_capacity DESC"
+    repaired, errors = make_validator().check(sql)
+    assert repaired == sql
+    assert len(errors) == 1
+    assert "battery_capacity_W" in errors[0] and "battery_capacity_mAh" in errors[0]
+
+
+@pytest.mark.parametrize("sql, message", [
+    ("SELECT name FROM items", "Bảng không tồn tại: items"),
+    ("SELECT name FROM products WHERE colour = 'red'", "Cột không tồn tại: colour"),
+    ("SELECT name FROM products WHERE FOO(price) > 0", "Hàm không được hỗ trợ: FOO"),
+    ("SELECT name FROM products WHERE MATCH(name, 'đèn)", "Thiếu dấu ' đóng"),
+])
+def test_errors(sql, message):
+    _, errors = make_validator().check(sql)
+    assert message in errors
+
+
+def test_local_errors_do_not_reject_when_translate_succeeds():
+    validator = make_validator()
+    sql, error = validator.validate("SELECT name FROM products ORDER BY battery_capacity DESC")
+    assert error is None
+    assert validator.rejected == 0
+
+
+def test_rejects_when_translate_fails():
+    validator = make_validator(error="Unknown column [battery_capacity]")
+    _, error = validator.validate("SELECT name FROM products ORDER BY battery_capacity DESC")
+    assert "battery_capacity_mAh" in error and "Unknown column [battery_capacity]" in error
+    assert validator.rejected == 1